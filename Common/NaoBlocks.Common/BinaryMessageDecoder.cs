@@ -0,0 +1,202 @@
+﻿using Newtonsoft.Json;
+using System.Globalization;
+using System.Text;
+
+namespace NaoBlocks.Common
+{
+    /// <summary>
+    /// Decodes the compact binary frames that robots can send for state updates and debug messages.
+    /// </summary>
+    /// <remarks>
+    /// The format is negotiated when the robot authenticates (see wire.py in the Nao client for the layout.)
+    /// Each connection needs its own decoder, as the frames share a string table.
+    /// </remarks>
+    public class BinaryMessageDecoder
+    {
+        /// <summary>
+        /// The name of the format, as negotiated with the robot.
+        /// </summary>
+        public const string Format = "binary1";
+
+        /// <summary>
+        /// The format version, which is the first byte of every frame.
+        /// </summary>
+        public const byte Version = 1;
+
+        private const byte ResetFlag = 1;
+        private const byte NullTag = 0;
+        private const byte TrueTag = 1;
+        private const byte FalseTag = 2;
+        private const byte IntegerTag = 3;
+        private const byte FloatTag = 4;
+        private const byte StringTag = 5;
+        private const byte InternedTag = 6;
+
+        private readonly List<string> strings = new();
+
+        /// <summary>
+        /// Checks whether a message buffer contains a binary frame.
+        /// </summary>
+        /// <param name="data">The message buffer.</param>
+        /// <returns>True if the buffer is a binary frame, false otherwise (JSON messages always start with a brace.)</returns>
+        public static bool IsBinary(byte[] data)
+        {
+            return data.Length > 0 && data[0] == Version;
+        }
+
+        /// <summary>
+        /// Decodes a binary frame into a <see cref="ClientMessage"/>.
+        /// </summary>
+        /// <param name="data">The frame.</param>
+        /// <returns>The decoded <see cref="ClientMessage"/>.</returns>
+        /// <remarks>
+        /// The values are converted to strings in the same way as for JSON messages, and the debug events
+        /// are converted back to the JSON encoded "events" value, so the message can be processed in the
+        /// same way as a JSON message.
+        /// </remarks>
+        public ClientMessage Decode(byte[] data)
+        {
+            if (data.Length < 4) throw new ArgumentException("Insufficient data to decode", nameof(data));
+            if (data[0] != Version) throw new ArgumentException($"Unknown frame version {data[0]}", nameof(data));
+            try
+            {
+                return this.DecodeFrame(data);
+            }
+            catch (Exception error) when (error is IndexOutOfRangeException || error is ArgumentOutOfRangeException)
+            {
+                throw new ArgumentException("Frame is truncated", nameof(data));
+            }
+        }
+
+        private static ulong ReadVarint(byte[] data, ref int pos)
+        {
+            ulong result = 0;
+            var shift = 0;
+            while (true)
+            {
+                var value = data[pos++];
+                result |= (ulong)(value & 0x7f) << shift;
+                if (value < 0x80) return result;
+                shift += 7;
+            }
+        }
+
+        private static long ReadSigned(byte[] data, ref int pos)
+        {
+            var value = ReadVarint(data, ref pos);
+            return (long)(value >> 1) ^ -(long)(value & 1);
+        }
+
+        private static string ConvertToString(object? value)
+        {
+            // These match the values from a JSON message, where the values are read as the raw JSON text
+            switch (value)
+            {
+                case null:
+                    return string.Empty;
+
+                case bool flag:
+                    return flag ? "true" : "false";
+
+                case long number:
+                    return number.ToString(CultureInfo.InvariantCulture);
+
+                case double number:
+                    var text = number.ToString("R", CultureInfo.InvariantCulture);
+                    return text.IndexOfAny(new[] { '.', 'E', 'N', 'I' }) < 0 ? text + ".0" : text;
+
+                default:
+                    return value.ToString() ?? string.Empty;
+            }
+        }
+
+        private ClientMessage DecodeFrame(byte[] data)
+        {
+            if ((data[1] & ResetFlag) != 0) this.strings.Clear();
+            var message = new ClientMessage
+            {
+                Type = (ClientMessageType)(data[2] | (data[3] << 8))
+            };
+
+            var pos = 4;
+            message.ConversationId = (long)ReadVarint(data, ref pos);
+            var count = (int)ReadVarint(data, ref pos);
+            for (var loop = 0; loop < count; loop++)
+            {
+                var length = (int)ReadVarint(data, ref pos);
+                this.strings.Add(Encoding.UTF8.GetString(data, pos, length));
+                pos += length;
+            }
+
+            switch (message.Type)
+            {
+                case ClientMessageType.RobotStateUpdate:
+                    count = (int)ReadVarint(data, ref pos);
+                    for (var loop = 0; loop < count; loop++)
+                    {
+                        var key = this.strings[(int)ReadVarint(data, ref pos)];
+                        message.Values[key] = ConvertToString(this.ReadValue(data, ref pos));
+                    }
+                    break;
+
+                case ClientMessageType.RobotDebugMessage:
+                    count = (int)ReadVarint(data, ref pos);
+                    var events = new List<object?[]>();
+                    long time = 0;
+                    for (var loop = 0; loop < count; loop++)
+                    {
+                        var sourceId = this.ReadValue(data, ref pos);
+                        var status = this.ReadValue(data, ref pos);
+                        var function = this.ReadValue(data, ref pos);
+                        time += ReadSigned(data, ref pos);
+                        events.Add(new object?[] { sourceId, status, function, time });
+                    }
+                    message.Values["events"] = JsonConvert.SerializeObject(events, Formatting.None);
+                    break;
+
+                default:
+                    throw new ArgumentException($"Message type {message.Type} cannot be binary encoded", nameof(data));
+            }
+
+            return message;
+        }
+
+        private object? ReadValue(byte[] data, ref int pos)
+        {
+            var tag = data[pos++];
+            switch (tag)
+            {
+                case NullTag:
+                    return null;
+
+                case TrueTag:
+                    return true;
+
+                case FalseTag:
+                    return false;
+
+                case IntegerTag:
+                    return ReadSigned(data, ref pos);
+
+                case FloatTag:
+                    var bytes = new byte[8];
+                    Array.Copy(data, pos, bytes, 0, 8);
+                    if (!BitConverter.IsLittleEndian) Array.Reverse(bytes);
+                    pos += 8;
+                    return BitConverter.ToDouble(bytes, 0);
+
+                case StringTag:
+                    var length = (int)ReadVarint(data, ref pos);
+                    var text = Encoding.UTF8.GetString(data, pos, length);
+                    pos += length;
+                    return text;
+
+                case InternedTag:
+                    return this.strings[(int)ReadVarint(data, ref pos)];
+
+                default:
+                    throw new ArgumentException($"Unknown value tag {tag}", nameof(data));
+            }
+        }
+    }
+}
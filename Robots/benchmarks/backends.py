@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+""" Engine backend benchmark
+
+Compares the tree walking backend against the bytecode backend for the Nao engine.
+Both backends are run headless (using RobotMock) over the same synthetic programs.
+
+Usage: python backends.py [--repeat N]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'nao'))
+
+import logger
+from engine import Engine
+from programs import PROGRAMS
+
+
+class NullComms(object):
+    ''' Discards all messages from the engine. '''
+
+    def __init__(self):
+        self.count = 0
+
+    def send(self, msg_type, data):
+        self.count += 1
+
+
+def run_program(backend, ast, repeat):
+    ''' Runs a program multiple times and returns the best time (or the error message.) '''
+    comms = NullComms()
+    engine = Engine(comms, use_robot=False, backend=backend)
+    try:
+        program = engine.compile(ast)
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            engine.run(program)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        return '%8.2fms' % (best * 1000, )
+    except RuntimeError as e:
+        # Python 3 raises RecursionError, which is a subclass of RuntimeError
+        return 'failed: ' + type(e).__name__
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the engine backends.')
+    parser.add_argument('--repeat', help='The number of times to run each program', type=int, default=5)
+    args = parser.parse_args()
+
+    logger.configure(logger.NONE)
+    print('%-28s %-20s %-20s' % ('Program', Engine.TREE, Engine.VM))
+    for name, ast in PROGRAMS:
+        results = [run_program(backend, ast, args.repeat) for backend in (Engine.TREE, Engine.VM)]
+        print('%-28s %-20s %-20s' % (name, results[0], results[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+""" Message encoding benchmark
+
+Compares the binary encoding (wire.py) with JSON for the high-frequency robot messages: the state
+updates (501) and the batched debug messages (502). The messages are a synthetic program run: a few
+variables updated in a loop, and debug events for a small set of blocks, in batches of 25.
+
+For each encoding this reports the total bytes, the bytes per message and the time to encode and
+decode each message (in microseconds), as JSON.
+
+Usage: python encoding.py [--programs N] [--repeat N] [--output FILE]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'nao'))
+
+import wire
+
+# The shape of each synthetic program run
+VARIABLES = 5
+UPDATES = 200
+BLOCKS = 20
+BATCHES = 40
+BATCH_SIZE = 25
+
+
+def generate(programs):
+    ''' Generates the messages for a number of program runs, as (program, type, values) tuples. '''
+    messages = []
+    now = 1700000000000
+    for program in range(programs):
+        for update in range(UPDATES):
+            value = update if update % 3 else update * 0.5
+            messages.append((program, 501, {'name': 'variable' + str(update % VARIABLES), 'value': value}))
+        for batch in range(BATCHES):
+            events = []
+            for index in range(BATCH_SIZE):
+                block = (batch * BATCH_SIZE + index) // 2 % BLOCKS
+                status = 'start' if index % 2 == 0 else 'end'
+                now += 3
+                events.append(['block' + str(block) + '_' + str(program), status, 'function' + str(block % 7), now])
+            messages.append((program, 502, {'events': events}))
+    return messages
+
+
+def run_json(messages):
+    ''' Encodes and decodes the messages as JSON. '''
+    start = time.time()
+    frames = [wire.encode_json(msg_type, 1, values) for _, msg_type, values in messages]
+    encoded = time.time() - start
+    start = time.time()
+    for frame in frames:
+        message = json.loads(frame)
+        if message['type'] == 502:
+            json.loads(message['values']['events'])
+    decoded = time.time() - start
+    return frames, encoded, decoded
+
+
+def run_binary(messages):
+    ''' Encodes and decodes the messages in the binary encoding, starting a new table for each program. '''
+    encoder = wire.Encoder()
+    frames = []
+    start = time.time()
+    last_program = None
+    for program, msg_type, values in messages:
+        if program != last_program:
+            encoder.reset()
+            last_program = program
+        frames.append(encoder.encode(msg_type, 1, values))
+    encoded = time.time() - start
+    decoder = wire.Decoder()
+    start = time.time()
+    for frame in frames:
+        decoder.decode(frame)
+    decoded = time.time() - start
+    return frames, encoded, decoded
+
+
+def measure(name, run, messages, repeat):
+    ''' Measures an encoding, using the best of the runs. '''
+    best_encode = None
+    best_decode = None
+    frames = None
+    for _ in range(repeat):
+        frames, encoded, decoded = run(messages)
+        best_encode = encoded if best_encode is None else min(best_encode, encoded)
+        best_decode = decoded if best_decode is None else min(best_decode, decoded)
+
+    total = sum(len(frame) for frame in frames)
+    count = len(messages)
+    return {
+        'encoding': name,
+        'messages': count,
+        'bytes': total,
+        'bytesPerMessage': round(float(total) / count, 1),
+        'encodeMicroseconds': round(best_encode * 1e6 / count, 2),
+        'decodeMicroseconds': round(best_decode * 1e6 / count, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the binary and JSON message encodings.')
+    parser.add_argument('--programs', help='The number of program runs to generate', type=int, default=20)
+    parser.add_argument('--repeat', help='The number of times to run each encoding', type=int, default=5)
+    parser.add_argument('--output', help='The file to write the results to (defaults to stdout)')
+    args = parser.parse_args()
+
+    messages = generate(args.programs)
+
+    # Check the binary encoding round trips before timing it
+    decoder = wire.Decoder()
+    frames, _, _ = run_binary(messages)
+    for frame, (_, msg_type, values) in zip(frames, messages):
+        if decoder.decode(frame)['values'] != values:
+            raise AssertionError('Binary encoding did not round trip for a message of type ' + str(msg_type))
+
+    results = [
+        measure('json', run_json, messages, args.repeat),
+        measure(wire.FORMAT, run_binary, messages, args.repeat),
+    ]
+    results[1]['sizeRatio'] = round(float(results[1]['bytes']) / results[0]['bytes'], 3)
+
+    output = json.dumps({'programs': args.programs, 'repeat': args.repeat, 'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
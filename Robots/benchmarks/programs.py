@@ -0,0 +1,135 @@
+""" Synthetic programs for the benchmarks
+
+These are built in the same shape as the ASTs the server generates from Blockly programs, so
+the engines see the same node types, tokens and source ids as they do for real programs.
+Only blocks that both the Nao and mBot2 engines support are used.
+"""
+
+
+class SourceIds(object):
+    ''' Generates unique source ids, like the ones Blockly assigns to each block. '''
+
+    def __init__(self):
+        self._next = 0
+
+    def next(self):
+        self._next += 1
+        return 'b%05d' % (self._next, )
+
+
+_ids = SourceIds()
+
+
+def function(name, args=None, children=None):
+    return {'type': 'Function', 'token': {'type': 'Identifier', 'value': name}, 'sourceId': _ids.next(),
+            'arguments': args, 'children': children}
+
+
+def number(value):
+    return {'type': 'Constant', 'token': {'type': 'Number', 'value': str(value)}, 'sourceId': _ids.next()}
+
+
+def text(value):
+    return {'type': 'Constant', 'token': {'type': 'Text', 'value': value}, 'sourceId': _ids.next()}
+
+
+def variable(name):
+    return {'type': 'Variable', 'token': {'type': 'Variable', 'value': name}, 'sourceId': _ids.next()}
+
+
+def compound(children):
+    return {'type': 'Compound', 'token': {'type': 'Generated', 'value': 'if'}, 'sourceId': _ids.next(),
+            'children': children}
+
+
+def program(body, definitions=()):
+    return [function('reset')] + list(definitions) + [function('start', children=body), function('go')]
+
+
+def counting_loop(iterations):
+    ''' A loop that counts and checks a variable each iteration. '''
+    return program([
+        function('variable', [variable('count'), number(0)]),
+        function('loop', [number(iterations)], [
+            function('addTo', [variable('count'), number(1)]),
+            compound([
+                function('if', [function('equal', [variable('count'), number(iterations / 2)])], [
+                    function('variable', [variable('half'), variable('count')])]),
+                function('else', None, [
+                    function('variable', [variable('other'), function('round', [variable('count')])])]),
+            ]),
+        ]),
+    ])
+
+
+def while_loop(iterations):
+    ''' A while loop with a counter. '''
+    return program([
+        function('variable', [variable('count'), number(0)]),
+        function('while', [function('lessThan', [variable('count'), number(iterations)])], [
+            function('addTo', [variable('count'), number(1)]),
+        ]),
+    ])
+
+
+def nested_loops(depth):
+    ''' Loops nested inside each other, each running a single iteration. '''
+    body = [function('addTo', [variable('count'), number(1)])]
+    for _ in range(depth):
+        body = [function('loop', [number(1)], body)]
+    return program([function('variable', [variable('count'), number(0)])] + body)
+
+
+def if_chain(branches, iterations):
+    ''' A long if/else if/else chain, where each iteration matches a different branch. '''
+    chain = [function('if', [function('equal', [variable('value'), number(0)])], [
+        function('addTo', [variable('matched'), number(1)])])]
+    for branch in range(1, branches):
+        chain.append(function('elseif', [function('equal', [variable('value'), number(branch)])], [
+            function('addTo', [variable('matched'), number(1)])]))
+    chain.append(function('else', None, [function('addTo', [variable('missed'), number(1)])]))
+    return program([
+        function('variable', [variable('value'), number(0)]),
+        function('variable', [variable('matched'), number(0)]),
+        function('variable', [variable('missed'), number(0)]),
+        function('loop', [number(iterations)], [
+            compound(chain),
+            function('addTo', [variable('value'), number(1)]),
+        ]),
+    ])
+
+
+def many_variables(count, iterations):
+    ''' Defines and updates a large number of variables. '''
+    names = ['var%d' % (index, ) for index in range(count)]
+    return program(
+        [function('variable', [variable(name), number(0)]) for name in names] + [
+            function('loop', [number(iterations)], [
+                function('addTo', [variable(name), number(1)]) for name in names
+            ]),
+        ])
+
+
+def custom_functions(count, iterations):
+    ''' Calls user defined functions, each of which calls the previous one. '''
+    definitions = [function('function', [function('step0')], [function('addTo', [variable('count'), number(1)])])]
+    for index in range(1, count):
+        definitions.append(function('function', [function('step%d' % (index, ))], [
+            function('addTo', [variable('count'), number(1)]),
+            function('step%d' % (index - 1, )),
+        ]))
+    return program([
+        function('variable', [variable('count'), number(0)]),
+        function('loop', [number(iterations)], [function('step%d' % (count - 1, ))]),
+    ], definitions)
+
+
+PROGRAMS = [
+    ('counting loop', counting_loop(2000)),
+    ('while loop', while_loop(2000)),
+    ('nested loops (depth 50)', nested_loops(50)),
+    ('nested loops (depth 300)', nested_loops(300)),
+    ('if chain (20 branches)', if_chain(20, 200)),
+    ('many variables (100)', many_variables(100, 20)),
+    ('custom functions (10)', custom_functions(10, 200)),
+]
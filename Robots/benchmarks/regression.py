@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+""" Bulk regression runner
+
+Runs a corpus of student programs through the Nao engine on the simulated robot, using a pool of
+worker processes, and reports what each program did. The corpus is a directory of programs downloaded
+from the server (/api/v1/code/{user}/{program}), or files with just the nodes of a program.
+
+For each program this reports:
+* status: ok, error (the program raised an exception), steps (it ran out of steps), time (it ran out
+  of time) or invalid (the file could not be loaded or compiled)
+* errors: the error messages the engine sent to the server
+* calls: a hash of the sequence of calls made to the robot (including the arguments)
+* steps: the number of blocks executed
+* elapsed: how long the run took (in seconds)
+* estimate: how long the run would take on a robot (in seconds, from the virtual clock)
+
+The output also has the totals and the throughput for the whole corpus. Pass the output from an
+earlier run (e.g. from the engine before a change) as the baseline to list the programs that behave
+differently: the runner exits with 1 if there are any.
+
+Usage: python regression.py CORPUS [--backend tree|vm] [--jobs N] [--steps N] [--time SECONDS]
+                            [--output FILE] [--baseline FILE]
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'nao'))
+
+import logger
+from engine import Engine
+import recording
+import simulation
+
+# The fields that must match the baseline for a program to behave the same
+COMPARED = ('status', 'errors', 'calls', 'steps')
+
+
+class BudgetExceeded(Exception):
+    ''' Raised when a program runs out of steps or time. '''
+
+    def __init__(self, status):
+        Exception.__init__(self, status)
+        self.status = status
+
+
+class ErrorComms(object):
+    ''' Collects the error messages sent by the engine. '''
+
+    def __init__(self):
+        self.errors = []
+
+    def send(self, msg_type, data):
+        if msg_type == 503:
+            self.errors.append(data['message'])
+
+
+class BudgetEngine(Engine):
+    ''' An engine that counts the blocks it executes, and cancels the run when it is over budget. '''
+
+    def __init__(self, comms, backend, recorder, max_steps, max_time):
+        Engine.__init__(self, comms, use_robot=False, backend=backend, recorder=recorder,
+                        clock=simulation.VirtualClock())
+        self.steps = 0
+        self.exceeded = None
+        self._max_steps = max_steps
+        self._max_time = max_time
+        self._deadline = None
+
+    def start(self):
+        ''' Starts the budget for a run. '''
+        self.steps = 0
+        self.exceeded = None
+        self._deadline = time.time() + self._max_time
+
+    def _debug(self, debug_id, func_name, status):
+        if status == 'start':
+            self.steps += 1
+            if self.exceeded is None:
+                if self.steps > self._max_steps:
+                    self.exceeded = 'steps'
+                elif time.time() > self._deadline:
+                    self.exceeded = 'time'
+                if self.exceeded is not None:
+                    self.cancel()
+        Engine._debug(self, debug_id, func_name, status)
+
+
+def _hash_calls(output):
+    ''' Hashes the robot calls in a recording. '''
+    output.seek(0)
+    digest = hashlib.sha1()
+    for _, kind, name, value in recording.read(output):
+        if kind == recording.CALL:
+            digest.update(json.dumps([name, value], sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def run_program(task):
+    ''' Runs a single program (in a worker process.) '''
+    name, path, backend, max_steps, max_time = task
+    result = {'program': name}
+    try:
+        nodes = simulation.load(path)
+    except (IOError, ValueError, KeyError, TypeError) as e:
+        result['status'] = 'invalid'
+        result['errors'] = [str(e)]
+        return result
+
+    # Programs can use random numbers, so each program always gets the same ones
+    random.seed(name)
+    comms = ErrorComms()
+    output = io.BytesIO()
+    engine = BudgetEngine(comms, backend, recording.Recorder(output), max_steps, max_time)
+    try:
+        program = engine.compile(nodes)
+    except Exception as e:
+        result['status'] = 'invalid'
+        result['errors'] = [str(e)]
+        return result
+
+    engine.configure({'debug': False})
+    engine.start()
+    clock = engine._clock
+    started = clock.time()
+    start = time.time()
+    try:
+        engine.run(program)
+        result['status'] = engine.exceeded or 'ok'
+    except Exception as e:
+        result['status'] = 'error'
+        comms.errors.append('%s: %s' % (type(e).__name__, e))
+    result['elapsed'] = round(time.time() - start, 6)
+    result['estimate'] = round(clock.time() - started, 3)
+    result['errors'] = comms.errors
+    result['calls'] = _hash_calls(output)
+    result['steps'] = engine.steps
+    return result
+
+
+def _initialise_worker():
+    logger.configure(logger.NONE)
+
+
+def find_programs(corpus):
+    ''' Finds the program files in a corpus, with their names relative to the corpus. '''
+    programs = []
+    for folder, _, files in os.walk(corpus):
+        for filename in files:
+            if filename.endswith('.json'):
+                path = os.path.join(folder, filename)
+                programs.append((os.path.relpath(path, corpus).replace(os.sep, '/'), path))
+    programs.sort()
+    return programs
+
+
+def compare(results, baseline):
+    ''' Lists the programs that behave differently to the baseline, with the fields that differ. '''
+    expected = dict((result['program'], result) for result in baseline['programs'])
+    divergences = []
+    for result in results:
+        try:
+            previous = expected[result['program']]
+        except KeyError:
+            continue
+        fields = [field for field in COMPARED if result.get(field) != previous.get(field)]
+        if fields:
+            divergences.append({
+                'program': result['program'],
+                'fields': fields,
+                'baseline': dict((field, previous.get(field)) for field in fields),
+                'current': dict((field, result.get(field)) for field in fields),
+            })
+    return divergences
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a corpus of programs through the engine.')
+    parser.add_argument('corpus', help='The folder containing the programs')
+    parser.add_argument('--backend', help='The engine backend to use', choices=['tree', 'vm'], default='vm')
+    parser.add_argument('--jobs', help='The number of worker processes (defaults to the number of CPUs)', type=int)
+    parser.add_argument('--steps', help='The most blocks a program can execute', type=int, default=100000)
+    parser.add_argument('--time', help='The longest a program can run for (in seconds)', type=float, default=10)
+    parser.add_argument('--output', help='The file to write the results to (defaults to stdout)')
+    parser.add_argument('--baseline', help='The results from an earlier run to compare against')
+    args = parser.parse_args()
+
+    programs = find_programs(args.corpus)
+    tasks = [(name, path, args.backend, args.steps, args.time) for name, path in programs]
+    start = time.time()
+    pool = multiprocessing.Pool(args.jobs, _initialise_worker)
+    try:
+        results = list(pool.imap_unordered(run_program, tasks, chunksize=8))
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+    results.sort(key=lambda result: result['program'])
+
+    statuses = {}
+    for result in results:
+        statuses[result['status']] = statuses.get(result['status'], 0) + 1
+    steps = sum(result.get('steps', 0) for result in results)
+    output = {
+        'backend': args.backend,
+        'summary': {
+            'programs': len(results),
+            'statuses': statuses,
+            'steps': steps,
+            'elapsed': round(elapsed, 3),
+            'programsPerSecond': round(len(results) / elapsed, 1) if elapsed else None,
+            'stepsPerSecond': round(steps / elapsed, 1) if elapsed else None,
+        },
+        'programs': results,
+    }
+
+    divergences = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            divergences = compare(results, json.load(f))
+        output['divergences'] = divergences
+
+    text = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    for divergence in divergences:
+        sys.stderr.write('DIVERGED %s: %s\n' % (divergence['program'], ', '.join(divergence['fields'])))
+        for field in divergence['fields']:
+            sys.stderr.write('    %s: %s -> %s\n' % (
+                field, json.dumps(divergence['baseline'][field]), json.dumps(divergence['current'][field])))
+    sys.stderr.write('%d programs in %.2fs, %d diverged\n' % (len(results), elapsed, len(divergences)))
+    return 1 if divergences else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
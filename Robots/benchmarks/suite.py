@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+""" Engine benchmark suite
+
+Runs the Nao engine (both backends) and the mBot2 engine headless over the synthetic programs,
+with full debug telemetry turned on, and reports the results as JSON.
+
+For each engine and program this reports:
+* nodes: the number of blocks executed in a single run
+* ns/node: the best run time divided by the number of blocks
+* allocations/node: the growth in allocated memory blocks over a run (with the garbage collector off)
+* pool misses/node: the execution states and frames the engine had to allocate in a steady run
+  (i.e. after a warm up run has filled the pools)
+* peak bytes: the most memory the run needed at once (from tracemalloc, or gc.mem_free() on MicroPython)
+* messages/node: the number of messages sent to the server per block
+
+Usage: python suite.py [--repeat N] [--output FILE]
+"""
+
+import argparse
+import gc
+import importlib.util
+import json
+import os
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'nao'))
+
+import logger
+from engine import Engine
+from programs import PROGRAMS
+
+
+def _load_mbot2():
+    ''' Loads the mBot2 test client (this is a script, so it is not on the import path.) '''
+    spec = importlib.util.spec_from_file_location('mbot2_test', os.path.join(ROOT, 'mBot2-Blocks', 'test.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    # The test robot prints every action, which would swamp the timings
+    module.debugMessage = lambda source, msg: None
+    return module
+
+
+def peak_bytes(run):
+    ''' Measures the most memory a run needed at once, in bytes.
+
+    MicroPython does not free anything until a collection, so with the collector off the drop in free
+    memory is everything the run allocated. CPython frees most objects straight away, so this uses the
+    peak that tracemalloc traced instead. '''
+    gc.collect()
+    if hasattr(gc, 'mem_free'):
+        gc.disable()
+        try:
+            free = gc.mem_free()
+            run()
+            return free - gc.mem_free()
+        finally:
+            gc.enable()
+
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        run()
+        return tracemalloc.get_traced_memory()[1] - start
+    finally:
+        tracemalloc.stop()
+
+
+class NaoComms(object):
+    ''' Counts the messages sent by the Nao engine. '''
+
+    def __init__(self):
+        self.count = 0
+
+    def send(self, msg_type, data):
+        self.count += 1
+
+
+class MBot2Connection(object):
+    ''' Counts the messages sent by the mBot2 engine. '''
+
+    def __init__(self):
+        self.count = 0
+
+    def send_message(self, type, values=None):
+        self.count += 1
+
+    def set_state(self, state, name=None):
+        self.count += 1
+
+    def record_error(self, message):
+        self.count += 1
+
+    def record_debug(self, source, status, func):
+        self.count += 1
+
+
+class NaoRunner(object):
+    ''' Runs programs on the Nao engine. '''
+
+    def __init__(self, backend):
+        self.name = 'nao-' + backend
+        self.comms = NaoComms()
+        self._engine = Engine(self.comms, use_robot=False, backend=backend)
+
+    def load(self, ast):
+        self._program = self._engine.compile(ast)
+
+    def run(self, opts):
+        self._engine.configure(opts)
+        self._engine.run(self._program)
+        return self._engine.summary()
+
+    def created(self):
+        return self._engine._states.created
+
+
+class MBot2Runner(object):
+    ''' Runs programs on the mBot2 engine (using the robot test double.) '''
+
+    def __init__(self, module):
+        self.name = 'mbot2'
+        self.comms = MBot2Connection()
+        self._engine = module.Engine(self.comms, module.Robot())
+
+    def load(self, ast):
+        self._engine.ast = self._engine.prepare(ast)
+
+    def run(self, opts):
+        self._engine.configure(json.dumps(opts))
+        self._engine.run()
+        return dict((key, str(value)) for key, value in self._engine._summary.items())
+
+    def created(self):
+        return self._engine._states.created + self._engine._frames.created
+
+
+def measure(runner, ast, repeat):
+    ''' Measures a single program on an engine. '''
+    result = {'engine': runner.name, 'program': ast[0]}
+    try:
+        runner.load(ast[1])
+
+        # The block count comes from a summary run, so it is the same count the server would see
+        nodes = int(runner.run({'telemetry': 'summary'})['blocks'])
+        result['nodes'] = nodes
+
+        best = None
+        messages = 0
+        for _ in range(repeat):
+            runner.comms.count = 0
+            start = time.time()
+            runner.run({'debug': True})
+            elapsed = time.time() - start
+            messages = runner.comms.count
+            if best is None or elapsed < best:
+                best = elapsed
+
+        gc.collect()
+        gc.disable()
+        try:
+            blocks = sys.getallocatedblocks()
+            runner.run({'debug': True})
+            allocations = sys.getallocatedblocks() - blocks
+        finally:
+            gc.enable()
+
+        created = runner.created()
+        runner.run({'debug': True})
+        misses = runner.created() - created
+        peak = peak_bytes(lambda: runner.run({'debug': True}))
+
+        result['nsPerNode'] = round(best * 1e9 / max(nodes, 1), 1)
+        result['allocationsPerNode'] = round(float(allocations) / max(nodes, 1), 3)
+        result['poolMissesPerNode'] = round(float(misses) / max(nodes, 1), 3)
+        result['peakBytes'] = peak
+        result['messagesPerNode'] = round(float(messages) / max(nodes, 1), 3)
+    except RuntimeError as e:
+        # Python 3 raises RecursionError, which is a subclass of RuntimeError
+        result['error'] = type(e).__name__
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the robot engines.')
+    parser.add_argument('--repeat', help='The number of times to run each program', type=int, default=5)
+    parser.add_argument('--output', help='The file to write the results to (defaults to stdout)')
+    args = parser.parse_args()
+
+    logger.configure(logger.NONE)
+    mbot2 = _load_mbot2()
+    runners = [NaoRunner(Engine.TREE), NaoRunner(Engine.VM), MBot2Runner(mbot2)]
+    results = [measure(runner, program, args.repeat) for program in PROGRAMS for runner in runners]
+
+    output = json.dumps({'repeat': args.repeat, 'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
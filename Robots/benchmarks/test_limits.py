@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+""" Engine limit tests
+
+Checks that deeply nested and recursive programs run, or stop with a clean ROBOT_ERROR, on both
+backends of the Nao engine, rather than running out of Python stack. The recursion limit must be
+left alone, and stopping early must leave the profiler and the state pool balanced. Also checks
+that a hot loop allocates (almost) nothing for each block it runs, and that a long loop in an
+event handler does not hold up the other handlers.
+
+Usage: python -m unittest test_limits
+"""
+
+import gc
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'nao'))
+
+import logger
+from engine import Engine
+from programs import counting_loop, function, nested_loops, number, program, variable
+
+ROBOT_ERROR = 503
+
+# The most memory blocks a steady run can allocate for each block it runs
+MAX_ALLOCATIONS_PER_BLOCK = 0.05
+
+# The number of iterations in the long running event handler
+HANDLER_ITERATIONS = 20000
+
+
+class Comms(object):
+    ''' Keeps the messages sent by the engine. '''
+
+    def __init__(self):
+        self.messages = []
+
+    def send(self, msg_type, data):
+        self.messages.append((msg_type, data))
+
+    def errors(self):
+        return [data['message'] for msg_type, data in self.messages if msg_type == ROBOT_ERROR]
+
+
+class CountingComms(object):
+    ''' Counts the messages sent by the engine, so keeping them does not allocate. '''
+
+    def __init__(self):
+        self.count = 0
+
+    def send(self, msg_type, data):
+        self.count += 1
+
+
+def allocated_blocks():
+    ''' Counts the allocated memory blocks (Python 2 can only count the objects the collector tracks.) '''
+    if hasattr(sys, 'getallocatedblocks'):
+        return sys.getallocatedblocks()
+    return len(gc.get_objects())
+
+
+def recursive_function():
+    ''' A function that calls itself forever. '''
+    return program([
+        function('variable', [variable('count'), number(0)]),
+        function('recurse'),
+    ], [function('function', [function('recurse')], [
+        function('addTo', [variable('count'), number(1)]),
+        function('recurse'),
+    ])])
+
+
+def long_handler():
+    ''' A long loop in one event handler, and a short handler that copies the loop count. '''
+    return program([
+        function('variable', [variable('count'), number(0)]),
+        function('variable', [variable('seen'), number(-1)]),
+    ], [
+        function('frontButton', None, [
+            function('loop', [number(HANDLER_ITERATIONS)], [function('addTo', [variable('count'), number(1)])]),
+        ]),
+        function('rearButton', None, [function('variable', [variable('seen'), variable('count')])]),
+    ])
+
+
+def wait_until(check):
+    ''' Waits (for up to ten seconds) until a check passes. '''
+    timeout = time.time() + 10
+    while not check() and time.time() < timeout:
+        time.sleep(0.001)
+
+
+class LimitTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        logger.configure(logger.NONE)
+
+    def run_program(self, backend, ast, opts=None):
+        comms = Comms()
+        engine = Engine(comms, use_robot=False, backend=backend)
+        engine.configure(opts or {})
+        engine.run(engine.compile(ast))
+        return engine, comms
+
+    def setUp(self):
+        self.recursion_limit = sys.getrecursionlimit()
+
+    def tearDown(self):
+        self.assertEqual(self.recursion_limit, sys.getrecursionlimit())
+
+    def test_nested_loops_run_at_depth_300(self):
+        engine, comms = self.run_program(Engine.VM, nested_loops(300))
+        self.assertEqual([], comms.errors())
+        self.assertEqual(1, engine._variables[engine._slots['count']])
+
+    def test_nesting_limit(self):
+        for backend in (Engine.TREE, Engine.VM):
+            engine, comms = self.run_program(backend, nested_loops(300), {'maxNesting': 100})
+            self.assertEqual(['Program is nested too deeply (the limit is 100)'], comms.errors(), backend)
+            self.assertEqual(0, engine._variables[engine._slots['count']], backend)
+
+    def test_tree_nesting_fits_in_stack(self):
+        engine, comms = self.run_program(Engine.TREE, nested_loops(300))
+        limit = engine._nesting_limit()
+        self.assertTrue(limit < 300)
+        self.assertEqual(['Program is nested too deeply (the limit is %d)' % limit], comms.errors())
+
+    def test_recursion_stops_at_depth_limit(self):
+        engine, comms = self.run_program(Engine.VM, recursive_function(), {'maxDepth': 300})
+        self.assertEqual(['Program is nested too deeply (the limit is 300)'], comms.errors())
+        self.assertEqual(300, engine._variables[engine._slots['count']])
+
+    def test_tree_recursion_fits_in_stack(self):
+        engine, comms = self.run_program(Engine.TREE, recursive_function(), {'maxDepth': 300})
+        self.assertEqual(['Program is nested too deeply (the limit is %d)' % engine._nesting_limit()],
+                         comms.errors())
+
+    def test_profiler_balanced_after_limit(self):
+        for backend in (Engine.TREE, Engine.VM):
+            engine, comms = self.run_program(backend, recursive_function(), {'maxDepth': 50, 'profile': True})
+            self.assertEqual(['Program is nested too deeply (the limit is 50)'], comms.errors(), backend)
+            self.assertEqual([], engine._profiler._local.stack, backend)
+            self.assertEqual(engine._states.created, len(engine._states._free), backend)
+
+
+    def test_hot_loop_allocations(self):
+        for backend in (Engine.TREE, Engine.VM):
+            engine = Engine(CountingComms(), use_robot=False, backend=backend)
+            program = engine.compile(counting_loop(2000))
+            engine.configure({'telemetry': 'summary'})
+            engine.run(program)
+            blocks = int(engine.summary()['blocks'])
+
+            # The first run with debug telemetry on fills the pools and the telemetry batches
+            engine.configure({'debug': True})
+            engine.run(program)
+            created = engine._states.created
+            gc.collect()
+            gc.disable()
+            try:
+                start = allocated_blocks()
+                engine.configure({'debug': True})
+                engine.run(program)
+                allocations = allocated_blocks() - start
+            finally:
+                gc.enable()
+
+            self.assertEqual(created, engine._states.created, backend)
+            self.assertTrue(float(allocations) / blocks < MAX_ALLOCATIONS_PER_BLOCK,
+                            '%s allocated %d blocks for %d blocks run' % (backend, allocations, blocks))
+
+
+    def test_handlers_take_turns_inside_loops(self):
+        for backend in (Engine.TREE, Engine.VM):
+            engine, comms = self.run_program(backend, long_handler())
+            engine.trigger('front')
+            engine.trigger('rear')
+            wait_until(engine._scheduler.is_idle)
+            self.assertEqual(HANDLER_ITERATIONS, engine._variables[engine._slots['count']], backend)
+            seen = engine._variables[engine._slots['seen']]
+            self.assertTrue(0 <= seen < HANDLER_ITERATIONS, '%s: rear ran after %s iterations' % (backend, seen))
+
+    def test_restart_cancels_inside_loops(self):
+        for backend in (Engine.TREE, Engine.VM):
+            engine, comms = self.run_program(backend, long_handler(), {'handlers': 'restart'})
+            count = engine._slots['count']
+            engine.trigger('front')
+            wait_until(lambda: engine._variables[count] > 0)
+            engine.trigger('front')
+            wait_until(engine._scheduler.is_idle)
+            self.assertTrue(engine._variables[count] < 2 * HANDLER_ITERATIONS, backend)
+
+
+if __name__ == '__main__':
+    unittest.main()
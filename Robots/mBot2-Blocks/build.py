@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+""" mBot2 Blocks client - build
+
+mBlock deploys the client as a single file, so the shared engine core (../nao/core.py) cannot be
+imported. Instead this copies it into the engine core section of main.py and test.py.
+
+Run this after changing the core. With --check it only reports whether the files are up to date,
+so it can be used before deploying.
+
+Usage: python build.py [--check]
+"""
+
+import argparse
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+CORE = os.path.join(ROOT, '..', 'nao', 'core.py')
+TARGETS = ['main.py', 'test.py']
+
+START_MARKER = '### Engine core ###'
+END_MARKER = '### Common code ###'
+HEADER = '# Generated from nao/core.py by build.py - do not edit this section, edit the core and rebuild'
+
+
+def load_core():
+    ''' Loads the core, replacing the module docstring with the generated header. '''
+    with open(CORE) as f:
+        source = f.read()
+    if source.startswith("'''"):
+        source = source[source.index("'''", 3) + 3:].lstrip('\n')
+    return START_MARKER + '\n\n' + HEADER + '\n' + source.rstrip('\n') + '\n\n'
+
+
+def build(path, core):
+    ''' Builds a single client. Returns the current and new sources, the new source is None if the markers are missing. '''
+    with open(path) as f:
+        source = f.read()
+    try:
+        start = source.index(START_MARKER)
+        end = source.index(END_MARKER, start)
+    except ValueError:
+        return source, None
+    return source, source[:start] + core + source[end:]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inline the engine core into the mBot2 clients.')
+    parser.add_argument('--check', help='Only check whether the clients are up to date', action='store_true')
+    args = parser.parse_args()
+
+    core = load_core()
+    stale = False
+    for target in TARGETS:
+        path = os.path.join(ROOT, target)
+        current, built = build(path, core)
+        if built is None:
+            print('%s: missing the "%s" or "%s" marker' % (target, START_MARKER, END_MARKER))
+            stale = True
+        elif built == current:
+            print('%s: up to date' % (target, ))
+        elif args.check:
+            print('%s: out of date' % (target, ))
+            stale = True
+        else:
+            with open(path, 'w') as f:
+                f.write(built)
+            print('%s: updated' % (target, ))
+
+    if stale:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
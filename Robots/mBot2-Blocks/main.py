@@ -9,6 +9,7 @@ otherwise mBlock won't compile it correctly.
 
 import cyberpi
 import time
+from time import sleep
 
 import ujson as json
 import urequests as requests
@@ -27,6 +28,229 @@ VERSION = '1.1'
 def debugMessage(source, msg):
     pass
 
+### Engine core ###
+
+# Generated from nao/core.py by build.py - do not edit this section, edit the core and rebuild
+try:
+    from threading import Event
+except ImportError:
+    # MicroPython on the CyberPi does not have threading, so cancellable waits poll instead
+    Event = None
+from time import sleep
+
+# The telemetry levels
+TELEMETRY_OFF = 'off'
+TELEMETRY_SUMMARY = 'summary'
+TELEMETRY_FULL = 'full'
+TELEMETRY_LEVELS = (TELEMETRY_OFF, TELEMETRY_SUMMARY, TELEMETRY_FULL)
+
+
+def parse_telemetry(opts):
+    ''' Retrieves the telemetry level from the run options.
+
+    An explicit telemetry option is used if it is valid, otherwise a debug option of false turns
+    telemetry off. The default is full telemetry, which is what the clients expect. '''
+    try:
+        level = opts['telemetry']
+        if level in TELEMETRY_LEVELS:
+            return level
+    except KeyError:
+        pass
+
+    try:
+        return TELEMETRY_FULL if opts['debug'] else TELEMETRY_OFF
+    except KeyError:
+        return TELEMETRY_FULL
+
+
+class DepthLimitError(Exception):
+    ''' Raised when a program nests blocks deeper than the engine allows. '''
+
+    def __init__(self, limit):
+        Exception.__init__(self, 'Program is nested too deeply (the limit is ' + str(limit) + ')')
+
+
+class Cancellation(object):
+    ''' Signals that the current run has been cancelled, waking any waits as soon as possible. '''
+
+    # How often to check for cancellation when threading is not available (in seconds)
+    POLL_INTERVAL = 0.05
+
+    __slots__ = ('is_cancelled', '_event')
+
+    def __init__(self):
+        self.is_cancelled = False
+        self._event = None if Event is None else Event()
+
+    def cancel(self):
+        ''' Cancels the run. '''
+        self.is_cancelled = True
+        if not self._event is None:
+            self._event.set()
+
+    def reset(self):
+        ''' Clears the cancellation for a new run. '''
+        self.is_cancelled = False
+        if not self._event is None:
+            self._event.clear()
+
+    def wait(self, seconds):
+        ''' Waits for a number of seconds (including fractions.) Returns True if the run has been cancelled. '''
+        if not self._event is None:
+            if seconds > 0:
+                self._event.wait(seconds)
+            return self.is_cancelled
+
+        while seconds > 0 and not self.is_cancelled:
+            step = min(seconds, Cancellation.POLL_INTERVAL)
+            sleep(step)
+            seconds -= step
+        return self.is_cancelled
+
+
+class EngineFunction(object):
+    ''' Defines a function that can be executed on the engine.
+
+    A pure function only depends on its arguments and has no side effects, so calls with constant
+    arguments can be evaluated before the program runs. Arguments is the minimum number of arguments
+    the function needs. A control function is a generator that yields the blocks to run (e.g. each
+    pass of a loop), so the engine can run them without recursing. '''
+
+    __slots__ = ('_func', 'top_level', 'pure', 'arguments', 'control')
+
+    def __init__(self, func, top_level=False, pure=False, arguments=0, control=False):
+        self._func = func
+        self.top_level = top_level
+        self.pure = pure
+        self.arguments = arguments
+        self.control = control
+
+    def execute(self, state):
+        ''' Executes the function. '''
+        return self._func(state)
+
+
+class OperatorFunction(EngineFunction):
+    ''' A pure function that applies one of the operators to its arguments. '''
+
+    __slots__ = ()
+
+    def __init__(self, operator, arguments):
+        EngineFunction.__init__(self, operator, pure=True, arguments=arguments)
+
+    def execute(self, state):
+        ''' Evaluates the arguments from the state and applies the operator. '''
+        if self.arguments == 1:
+            return self._func(state.argument(0))
+        return self._func(state.argument(0), state.argument(1))
+
+    def apply(self, first, second=None):
+        ''' Applies the operator to arguments that have already been evaluated. '''
+        if self.arguments == 1:
+            return self._func(first)
+        return self._func(first, second)
+
+
+class ExecutionState(object):
+    ''' Defines the current execution state.
+
+    Args holds the evaluators for the arguments, when the engine has compiled them. '''
+
+    __slots__ = ('function', 'ast', 'parent', 'args', 'body', 'completed')
+
+    def __init__(self, ast, parent, function, args=None, body=None):
+        self.reset(ast, parent, function, args, body)
+
+    def reset(self, ast, parent, function, args=None, body=None):
+        ''' Resets the state, so it can be reused for another call. '''
+        self.function = function
+        self.ast = ast
+        self.parent = parent
+        self.args = args
+        self.body = body
+        self.completed = False
+
+    def argument(self, index):
+        ''' Evaluates an argument using its compiled evaluator. '''
+        return self.args[index](self)
+
+    def complete(self):
+        ''' Marks the state as completed. '''
+        self.completed = True
+
+
+class StatePool(object):
+    ''' Reuses execution states, so running a block does not allocate a new state each time.
+
+    A state must only be released once nothing refers to it any more (e.g. when its function has
+    returned.) Created counts the states that had to be allocated because the pool was empty. '''
+
+    __slots__ = ('_free', 'created')
+
+    def __init__(self):
+        self._free = []
+        self.created = 0
+
+    def acquire(self, ast, parent, function, args=None, body=None):
+        ''' Retrieves a state from the pool, or allocates one if the pool is empty. '''
+        try:
+            state = self._free.pop()
+        except IndexError:
+            self.created += 1
+            return ExecutionState(ast, parent, function, args, body)
+        state.reset(ast, parent, function, args, body)
+        return state
+
+    def release(self, state):
+        ''' Returns a state to the pool, clearing its references so they can be collected. '''
+        state.reset(None, None, None)
+        self._free.append(state)
+
+
+def _not(value):
+    return not value
+
+
+def _round(value):
+    return round(value, 0)
+
+
+def _equal(value1, value2):
+    return value1 == value2
+
+
+def _not_equal(value1, value2):
+    return value1 != value2
+
+
+def _less_than(value1, value2):
+    return value1 < value2
+
+
+def _less_than_equal(value1, value2):
+    return value1 <= value2
+
+
+def _greater_than(value1, value2):
+    return value1 > value2
+
+
+def _greater_than_equal(value1, value2):
+    return value1 >= value2
+
+
+# The operators: these are shared by every engine, so they are only created once
+OPERATORS = {
+    'not': OperatorFunction(_not, 1),
+    'round': OperatorFunction(_round, 1),
+    'equal': OperatorFunction(_equal, 2),
+    'notEqual': OperatorFunction(_not_equal, 2),
+    'lessThan': OperatorFunction(_less_than, 2),
+    'lessThanEqual': OperatorFunction(_less_than_equal, 2),
+    'greaterThan': OperatorFunction(_greater_than, 2),
+    'greaterThanEqual': OperatorFunction(_greater_than_equal, 2),
+}
+
 ### Common code ###
 
 class ClientMessageType(object):
@@ -196,14 +420,12 @@ class Connection(object):
 class EngineSettings(object):
     ''' The configuration options for the engine. '''
 
+    # The default number of frames the engine can nest (e.g. loops inside loops or recursive functions)
+    DEFAULT_MAX_DEPTH = 200
+
     def __init__(self, msg):
         ''' Initialises the options. '''
-        if msg is None:
-            self.debug = False
-            self.delay = 0
-            return
-
-        opts = json.loads(msg)
+        opts = {} if msg is None else json.loads(msg)
         try:
             self.debug = opts['debug']
         except KeyError:
@@ -214,30 +436,57 @@ class EngineSettings(object):
         except KeyError:
             self.delay = 0
 
-class EngineFunction(object):
-    ''' Defines a function that can be executed on the engine. '''
+        try:
+            self.max_depth = int(opts['maxDepth'])
+        except (KeyError, ValueError):
+            self.max_depth = EngineSettings.DEFAULT_MAX_DEPTH
 
-    def __init__(self, func, top_level=False):
-        self._func = func
-        self.top_level = top_level
+        self.telemetry = parse_telemetry(opts)
 
-    def execute(self, state):
-        ''' Executes the function. '''
-        return self._func(state)
+class Frame(object):
+    ''' A frame on the engine's execution stack.
 
+    A block frame runs a list of blocks in order, while a control frame holds a control function that
+    yields the blocks to run. '''
 
-class ExecutionState(object):
-    ''' Defines the current execution state. '''
+    __slots__ = ('nodes', 'index', 'state', 'top_level', 'compound', 'block', 'control')
 
-    def __init__(self, ast, parent, function):
-        self.function = function
-        self.ast = ast
-        self.parent = parent
-        self.completed = False
+    def __init__(self, nodes, state, top_level=False, compound=False, block=None, control=None):
+        self.reset(nodes, state, top_level, compound, block, control)
 
-    def complete(self):
-        ''' Marks the state as completed. '''
-        self.completed = True
+    def reset(self, nodes, state, top_level=False, compound=False, block=None, control=None):
+        ''' Resets the frame, so it can be reused. '''
+        self.nodes = nodes
+        self.index = 0
+        self.state = state
+        self.top_level = top_level
+        self.compound = compound
+        self.block = block
+        self.control = control
+
+class FramePool(object):
+    ''' Reuses frames, so running a block does not allocate a new frame each time. '''
+
+    __slots__ = ('_free', 'created')
+
+    def __init__(self):
+        self._free = []
+        self.created = 0
+
+    def acquire(self, nodes, state, top_level=False, compound=False, block=None, control=None):
+        ''' Retrieves a frame from the pool, or allocates one if the pool is empty. '''
+        try:
+            frame = self._free.pop()
+        except IndexError:
+            self.created += 1
+            return Frame(nodes, state, top_level, compound, block, control)
+        frame.reset(nodes, state, top_level, compound, block, control)
+        return frame
+
+    def release(self, frame):
+        ''' Returns a frame to the pool, clearing its references so they can be collected. '''
+        frame.reset(None, None)
+        self._free.append(frame)
 
 class Engine(object):
     ''' The main execution engine for the robot. '''
@@ -248,6 +497,11 @@ class Engine(object):
         self._robot = robot
         self._robot.engine = self
         self._opts = EngineSettings(None)
+        self._summary = {}
+        self._cancellation = Cancellation()
+        self._states = StatePool()
+        self._frames = FramePool()
+        self._builtins = self._build_functions()
         self._reset(None)
         self.is_cancelled = False
         self._variables = {}
@@ -258,11 +512,14 @@ class Engine(object):
     def configure(self, msg):
         ''' Configures the engine. '''
         self._opts = EngineSettings(msg)
+        self._summary = {'blocks': 0, 'states': 0, 'errors': 0}
         self.is_cancelled = False
+        self._cancellation.reset()
 
     def cancel(self):
         ''' Cancels the current run. '''
         self.is_cancelled = True
+        self._cancellation.cancel()
 
     def run(self):
         ''' Executes the current AST. '''
@@ -272,73 +529,182 @@ class Engine(object):
             self._execute(self.ast, None, True)
         except Exception as ex:
             self._conn.send_message(ClientMessageType.ROBOT_ERROR, {'error': str(ex)})
-        self._conn.send_message(ClientMessageType.PROGRAM_FINISHED)
+        summary = None
+        if self._opts.telemetry == TELEMETRY_SUMMARY:
+            summary = {}
+            for key, value in self._summary.items():
+                summary[key] = str(value)
+        self._conn.send_message(ClientMessageType.PROGRAM_FINISHED, summary)
         self._conn.set_state('Waiting')
 
     def trigger(self, block_name, value=None):
         ''' Triggers a block in the engine. '''
-        self._generate_execute_block(block_name)(None)
+        try:
+            block = self._blocks[block_name]
+        except KeyError:
+            return
+        self._execute(block['children'], None)
+
+    def prepare(self, ast):
+        ''' Pre-parses the literals in an AST and folds pure functions with constant arguments.
+
+        The value is stored in the node under 'folded', and the nodes are visited children first so
+        nested expressions can be folded. '''
+        tasks = [(node, False) for node in ast]
+        while tasks:
+            node, visited = tasks.pop()
+            if not visited:
+                tasks.append((node, True))
+                for arg in node.get('arguments') or []:
+                    tasks.append((arg, False))
+                for child in node.get('children') or []:
+                    tasks.append((child, False))
+                continue
+
+            node_type = node['token']['type']
+            node_value = node['token']['value']
+            if node_type == 'Text' or node_type == 'Constant':
+                node['folded'] = str(node_value)
+            elif node_type == 'Number':
+                node['folded'] = float(node_value)
+            elif node_type == 'Boolean':
+                node['folded'] = node_value == 'TRUE'
+            elif node_type == 'Colour':
+                node['folded'] = '#' + str(node_value)
+            elif node_type == 'Identifier' and not node.get('children'):
+                func = self._functions.get(node_value)
+                args = node.get('arguments') or []
+                if func is None or not func.pure or not args:
+                    continue
+                if not all('folded' in arg for arg in args):
+                    continue
+                try:
+                    node['folded'] = func.apply(*[arg['folded'] for arg in args])
+                except Exception:
+                    # Leave any errors until the block is run
+                    pass
+        return ast
 
     def _execute(self, ast, state, top_level=False):
-        ''' Executes a block of AST. '''
+        ''' Executes a block of AST.
+
+        Control functions hand their blocks back to this loop, which keeps them on an explicit frame
+        stack, so nested blocks and recursive functions do not use up the Python stack. The frames and
+        states come from pools and are released when they finish, so steady loops do not allocate. '''
+        frames = [self._frames.acquire(ast, state, top_level)]
+        try:
+            return self._run_frames(frames)
+        finally:
+            # Frames are left on the stack when the run is cancelled or fails
+            while frames:
+                frame = frames.pop()
+                if frame.compound or not frame.control is None:
+                    self._states.release(frame.state)
+                self._frames.release(frame)
+
+    def _run_frames(self, frames):
+        ''' Runs the frames on the stack until it is empty (or the run is cancelled.) '''
         last_result = None
-        for block in ast:
+        while frames:
             if self.is_cancelled:
                 break
+            frame = frames[-1]
+            if not frame.control is None:
+                try:
+                    nodes = next(frame.control)
+                except StopIteration:
+                    frames.pop()
+                    self._finish_function(frame.block, frame.state, frame.top_level)
+                    self._states.release(frame.state)
+                    self._frames.release(frame)
+                    last_result = None
+                    continue
+                self._push(frames, self._frames.acquire(nodes, frame.state))
+                continue
+
+            if frame.index >= len(frame.nodes) or (frame.compound and frame.state.completed):
+                frames.pop()
+                if frame.compound:
+                    self._states.release(frame.state)
+                self._frames.release(frame)
+                continue
+
+            block = frame.nodes[frame.index]
+            frame.index += 1
             if block['type'] == 'Function':
-                last_result = self._execute_function(block, state, top_level)
+                func_name = block['token']['value']
+                try:
+                    func = self._functions[func_name]
+                except KeyError:
+                    self._error('Unknown function: ' + func_name)
+                    continue
+
+                if func.top_level and not frame.top_level:
+                    self._error('Function ' + func_name +
+                                ' cannot be executed here')
+                    continue
+
+                if func.pure:
+                    last_result = self._apply(block, func, frame.state, frame.top_level)
+                    continue
+
+                self._debug(block, 'start')
+                func_state = self._states.acquire(block, frame.state, func_name)
+                result = func.execute(func_state)
+                if func.control:
+                    self._push(frames, self._frames.acquire(None, func_state, frame.top_level, block=block, control=result))
+                    continue
+                last_result = result
+                self._finish_function(block, func_state, frame.top_level)
+                self._states.release(func_state)
             elif block['type'] == 'Compound':
-                compound_state = ExecutionState(
-                    block, state, block['token']['value'])
-                for child in block['children']:
-                    last_result = self._execute_function(
-                        child, compound_state, False)
-                    if compound_state.completed:
-                        break
+                compound_state = self._states.acquire(block, frame.state, block['token']['value'])
+                self._push(frames, self._frames.acquire(block['children'], compound_state, compound=True))
             else:
                 self._error('Unknown node type: %s' % (block['type'], ))
         return last_result
 
-    def _execute_function(self, block, state, top_level):
-        ''' Executes a function. '''
-        func_name = block['token']['value']
-        last_result = None
-        try:
-            func = self._functions[func_name]
-        except KeyError:
-            self._error('Unknown function: ' + func_name)
-            return last_result
+    def _push(self, frames, frame):
+        ''' Adds a frame to the execution stack, checking the depth limit. '''
+        if len(frames) >= self._opts.max_depth:
+            raise DepthLimitError(self._opts.max_depth)
+        frames.append(frame)
 
-        if func.top_level and not top_level:
-            self._error('Function ' + func_name +
-                        ' cannot be executed here')
-        else:
-            self._debug(block, 'start')
-            func_state = ExecutionState(block, state, func_name)
-            last_result = func.execute(func_state)
-            if not state is None and func_state.completed:
-                state.complete()
-            if not top_level:
-                self._do_delay()
-            self._debug(block, 'end')
-
-        return last_result
+    def _finish_function(self, block, state, top_level):
+        ''' Completes a function: passes on the completion to the parent state, then does the delay and debug. '''
+        if not state.parent is None and state.completed:
+            state.parent.complete()
+        if not top_level:
+            self._do_delay()
+        self._debug(block, 'end')
 
     def _do_delay(self):
-        seconds = int(self._opts.delay)
+        seconds = float(self._opts.delay)
         if seconds > 0:
-            for _ in range(0, seconds):
-                if self.is_cancelled:
-                    break
-                sleep(1)
+            self._cancellation.wait(seconds)
 
     def _error(self, message):
+        if 'errors' in self._summary:
+            self._summary['errors'] += 1
         self._conn.record_error(message)
 
     def _change_state(self, name, value):
+        level = self._opts.telemetry
+        if level == TELEMETRY_OFF:
+            return
+        if level == TELEMETRY_SUMMARY:
+            self._summary['states'] += 1
+            return
         self._conn.set_state(value, name)
 
     def _debug(self, block, status):
+        level = self._opts.telemetry
+        if level == TELEMETRY_OFF:
+            return
+        if level == TELEMETRY_SUMMARY:
+            if status == 'start':
+                self._summary['blocks'] += 1
+            return
         try:
             debug_id = block['sourceId']
             self._conn.record_debug(debug_id, status, block['token']['value'])
@@ -347,6 +713,11 @@ class Engine(object):
 
     def _evaluate(self, node, state):
         ''' Evaluates a node. '''
+        if 'folded' in node:
+            if node['type'] == 'Function':
+                self._execute_folded(node, state)
+            return node['folded']
+
         node_type = node['token']['type']
         node_value = node['token']['value']
         if node_type == 'Text':
@@ -358,6 +729,9 @@ class Engine(object):
         elif node_type == 'Boolean':
             return node_value == 'TRUE'
         elif node_type == 'Identifier':
+            func = self._functions.get(node_value)
+            if not func is None and func.pure:
+                return self._apply(node, func, state)
             return self._execute([node], state)
         elif node_type == 'Variable':
             return self._get_variable(node_value)
@@ -366,6 +740,27 @@ class Engine(object):
 
         self._error('Unknown expression type: ' + node_type)
 
+    def _apply(self, block, func, state, top_level=False):
+        ''' Applies an operator directly, without adding a frame or execution state. '''
+        self._debug(block, 'start')
+        args = block['arguments']
+        if func.arguments == 1:
+            result = func.apply(self._evaluate(args[0], state))
+        else:
+            result = func.apply(self._evaluate(args[0], state), self._evaluate(args[1], state))
+        if not top_level:
+            self._do_delay()
+        self._debug(block, 'end')
+        return result
+
+    def _execute_folded(self, node, state):
+        ''' Sends the debug messages and does the delay for a folded function. '''
+        self._debug(node, 'start')
+        for arg in node['arguments']:
+            self._evaluate(arg, state)
+        self._do_delay()
+        self._debug(node, 'end')
+
     def _get_variable(self, name):
         try:
             return self._variables[name]
@@ -378,11 +773,15 @@ class Engine(object):
         self._variables = {}
         self._blocks = {}
         self._last_function = None
-        self._functions = {
+        self._functions = dict(self._builtins)
+
+    def _build_functions(self):
+        ''' Builds the dispatch table for the built-in functions: this is only done once, each run starts with a copy. '''
+        functions = {
             # Top level functions
             'reset': EngineFunction(self._reset, True),
             'start': EngineFunction(self._generate_register_block('start'), True),
-            'go': EngineFunction(self._generate_execute_block('start'), True),
+            'go': EngineFunction(self._generate_execute_block('start'), True, control=True),
 
             # Robot functions
             'wait': EngineFunction(self._wait),
@@ -393,23 +792,17 @@ class Engine(object):
             'turn_right': EngineFunction(self._turn_right),
             
             # Programming functions
-            'loop': EngineFunction(self._loop),
-            'while': EngineFunction(self._while),
+            'loop': EngineFunction(self._loop, control=True),
+            'while': EngineFunction(self._while, control=True),
             'variable': EngineFunction(self._define_variable),
             'function': EngineFunction(self._define_function),
             'addTo':  EngineFunction(self._add_to_variable),
-            'if': EngineFunction(self._check_if_condition),
-            'elseif': EngineFunction(self._check_if_condition),
-            'else': EngineFunction(self._check_else),
-            'not': EngineFunction(self._invert),
-            'equal': EngineFunction(self._check_if_equal),
-            'lessThan': EngineFunction(self._check_less_than),
-            'greaterThan': EngineFunction(self._check_greater_than),
-            'notEqual': EngineFunction(self._check_not_equal),
-            'lessThanEqual': EngineFunction(self._check_less_than_equal),
-            'greaterThanEqual': EngineFunction(self._check_greater_than_equal),
-            'round': EngineFunction(self._round),
+            'if': EngineFunction(self._check_if_condition, control=True),
+            'elseif': EngineFunction(self._check_if_condition, control=True),
+            'else': EngineFunction(self._check_else, control=True),
         }
+        functions.update(OPERATORS)
+        return functions
 
     def _generate_register_block(self, block_name):
         ''' Generates a closure to register block. '''
@@ -428,7 +821,7 @@ class Engine(object):
             except KeyError:
                 return
 
-            self._execute(block['children'], None)
+            yield block['children']
 
         return _execute_block
 
@@ -436,10 +829,7 @@ class Engine(object):
         ''' Make the robot wait. '''
         seconds = self._evaluate(state.ast['arguments'][0], state)
         self._robot.log('Wait ' + str(seconds) + 's')
-        for _ in range(0, int(seconds)):
-            if self.is_cancelled:
-                break
-            sleep(1)
+        self._cancellation.wait(float(seconds))
 
 
     def _stop(self, state):
@@ -453,9 +843,7 @@ class Engine(object):
         for loop in range(iterations):
             self._robot.log('Loop ' + str(loop))
             self._change_state('loop', loop)
-            self._execute(state.ast['children'], state)
-            if self.is_cancelled:
-                break
+            yield state.ast['children']
 
     def _define_variable(self, state):
         ''' Define or update a variable. '''
@@ -483,13 +871,13 @@ class Engine(object):
             except KeyError:
                 # This doesn't make sense, but allow for functions with no children (an empty function)
                 children = []
-            self._functions[name] = EngineFunction(self._execute_custom_function(name, children))
+            self._functions[name] = EngineFunction(self._execute_custom_function(name, children), control=True)
 
     def _execute_custom_function(self, name, ast):
         ''' Generates a closure to execute a custom function. '''
         def _execute_function(state):
             ''' Executes each AST block in the function definition. '''
-            self._execute(ast, state)
+            yield ast
 
         return _execute_function
 
@@ -506,67 +894,13 @@ class Engine(object):
         except KeyError:
             self._error('Unknown variable ' + name)
 
-    def _invert(self, state):
-        ''' Inverts a value. '''
-        value = self._evaluate(state.ast['arguments'][0], state)
-        self._robot.log('Invert')
-        return not value
-
-    def _round(self, state):
-        ''' Rounds a value. '''
-        value = self._evaluate(state.ast['arguments'][0], state)
-        self._robot.log('Round')
-        return round(value, 0)
-
-    def _check_if_equal(self, state):
-        ''' Checks if the two sides are equal. '''
-        value1 = self._evaluate(state.ast['arguments'][0], state)
-        value2 = self._evaluate(state.ast['arguments'][1], state)
-        self._robot.log('Equal')
-        return value1 == value2
-
-    def _check_less_than(self, state):
-        ''' Checks if the two sides are equal. '''
-        value1 = self._evaluate(state.ast['arguments'][0], state)
-        value2 = self._evaluate(state.ast['arguments'][1], state)
-        self._robot.log('Less')
-        return value1 < value2
-
-    def _check_greater_than(self, state):
-        ''' Checks if the two sides are equal. '''
-        value1 = self._evaluate(state.ast['arguments'][0], state)
-        value2 = self._evaluate(state.ast['arguments'][1], state)
-        self._robot.log('Greater')
-        return value1 > value2
-
-    def _check_not_equal(self, state):
-        ''' Checks if the two sides are equal. '''
-        value1 = self._evaluate(state.ast['arguments'][0], state)
-        value2 = self._evaluate(state.ast['arguments'][1], state)
-        self._robot.log('Not equal')
-        return value1 != value2
-
-    def _check_less_than_equal(self, state):
-        ''' Checks if the two sides are equal. '''
-        value1 = self._evaluate(state.ast['arguments'][0], state)
-        value2 = self._evaluate(state.ast['arguments'][1], state)
-        self._robot.log('Less equal')
-        return value1 <= value2
-
-    def _check_greater_than_equal(self, state):
-        ''' Checks if the two sides are equal. '''
-        value1 = self._evaluate(state.ast['arguments'][0], state)
-        value2 = self._evaluate(state.ast['arguments'][1], state)
-        self._robot.log('Greater equal')
-        return value1 >= value2
-
     def _check_if_condition(self, state):
         ''' Check a condition block. '''
         result = self._evaluate(state.ast['arguments'][0], state)
         self._robot.log('Condition')
         if result is True:
             state.complete()
-            self._execute(state.ast['children'], state)
+            yield state.ast['children']
 
     def _while(self, state):
         ''' Repeat while the condition is true. '''
@@ -574,12 +908,12 @@ class Engine(object):
         while result is True:
             self._robot.log('While loop')
             state.complete()
-            self._execute(state.ast['children'], state)
+            yield state.ast['children']
             result = self._evaluate(state.ast['arguments'][0], state)
 
     def _check_else(self, state):
         ''' Check a else block. '''
-        self._execute(state.ast['children'], state)
+        yield state.ast['children']
 
     def _random_colour(self, state):
         ''' Returns a random colour. '''
@@ -636,7 +970,7 @@ class App(object):
             elif msg.type == ClientMessageType.DOWNLOAD_PROGRAM:
                 self._conn.set_state('Downloading')
                 self._robot.log('Downloading')
-                self._engine.ast = self._conn.download_code(msg)
+                self._engine.ast = self._engine.prepare(self._conn.download_code(msg))
                 debugMessage('App', 'Received code')
                 debugMessage('App', self._engine.ast)
                 self._robot.log('...done')
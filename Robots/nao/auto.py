@@ -13,6 +13,7 @@ import hashlib
 import logger
 import os
 import requests
+from rest import RestClient
 import subprocess
 import sys
 
@@ -28,24 +29,26 @@ def generateFileHash(filepath):
             sha.update(data)
     return base64.b64encode(sha.digest())
 
-def download_file(filename, base_address, verifySSL, hash):
-    full_address = base_address + 'package/' + filename
-    logger.log('[AutoLoad] -> Downloading %s from %s', filename, full_address)
+def download_file(filename, client, base_path, hash):
+    path = base_path + 'package/' + filename
+    logger.log('[AutoLoad] -> Downloading %s from %s', filename, client.url(path))
     headers = {
         "ETag": hash
     }
-    response = requests.get(full_address, verify=verifySSL, headers=headers)
+    response = client.get(path, headers=headers)
     response.raise_for_status()
     with open(filename, "wb") as f:
         f.write(response.content)
     logger.log('[AutoLoad] -> %s downloaded', filename)
 
 def check_for_updates(server, verifySSL, secure):
-    base_address = ('https' if secure else 'http') + '://' + server + '/api/v1/robots/types/nao/'
-    list_address = base_address + 'package.txt'
-    logger.log('[AutoLoad] Checking for package at (%s)', list_address)
+    # All the files are downloaded through one client, so they share a single connection
+    client = RestClient(('https' if secure else 'http') + '://' + server, verifySSL)
+    base_path = '/api/v1/robots/types/nao/'
+    list_path = base_path + 'package.txt'
+    logger.log('[AutoLoad] Checking for package at (%s)', client.url(list_path))
     try:
-        response = requests.get(list_address, timeout=10, verify=verifySSL)
+        response = client.get(list_path)
         response.raise_for_status()
 
         logger.log('[AutoLoad] -> Received response')
@@ -65,7 +68,7 @@ def check_for_updates(server, verifySSL, secure):
             is_match = local_hash == hash
             logger.log('[AutoLoad] -> %s:local=%s,remote=%s', ('Match' if is_match else 'Different'), local_hash, hash)
             if not is_match:
-                download_file(filename, base_address, verifySSL, local_hash)
+                download_file(filename, client, base_path, local_hash)
                 
         return True
     except requests.exceptions.ConnectionError as e:
@@ -74,6 +77,8 @@ def check_for_updates(server, verifySSL, secure):
         logger.log('[AutoLoad] Connection attempt timed out!')
     except Exception as e:
         logger.log('[AutoLoad] unknown error: ' + str(e) + '!')
+    finally:
+        client.close()
     return False
 
 def run():
@@ -108,6 +113,16 @@ def parse_args():
         '--updateOnly', help='Attempts to update the files without running the client', action='store_true')
     parser.add_argument(
         '--reconnect', help='The number of reconnect attempts to make if a connection is lost', default=25)
+    parser.add_argument(
+        '--backend', help='The engine backend to use for executing programs', choices=['tree', 'vm'], default='vm')
+    parser.add_argument(
+        '--trace', help='Records the engine runs to a trace file, which can be replayed with recording.py', default=None)
+    parser.add_argument(
+        '--jsonOnly', help='Always sends JSON messages, even if the server supports the binary encoding', action='store_true')
+    parser.add_argument(
+        '--logLevel', help='The default logging level', choices=sorted(logger.LEVELS.keys()), default='info')
+    parser.add_argument(
+        '--logSubsystems', help='Logging levels for individual subsystems (e.g. Engine=debug,Comms=warning)', default='')
     return parser.parse_args()
 
 def main():
@@ -0,0 +1,51 @@
+''' Provides a cache for downloaded programs. '''
+from collections import OrderedDict
+
+import logger
+
+_log = logger.get_logger('Cache')
+
+
+class CachedProgram(object):
+    ''' Defines a downloaded program, along with its compiled form. '''
+
+    def __init__(self, etag, nodes, program, engine):
+        self.etag = etag
+        self.nodes = nodes
+        self.program = program
+        self.engine = engine
+
+
+class ProgramCache(object):
+    ''' A bounded cache of downloaded programs, keyed by user and program.
+
+    The least recently used program is removed when the cache is full. '''
+
+    def __init__(self, max_entries=10):
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get(self, user, program):
+        ''' Retrieves a cached program, or None if it is not in the cache. '''
+        key = (user, program)
+        try:
+            entry = self._entries.pop(key)
+        except KeyError:
+            return None
+
+        # Re-add the entry so it is the most recently used
+        self._entries[key] = entry
+        return entry
+
+    def put(self, user, program, entry):
+        ''' Adds a program to the cache. '''
+        key = (user, program)
+        self._entries.pop(key, None)
+        self._entries[key] = entry
+        while len(self._entries) > self._max_entries:
+            old_key, _ = self._entries.popitem(last=False)
+            _log.debug('Removed program %s/%s', old_key[0], old_key[1])
+
+    def remove(self, user, program):
+        ''' Removes a program from the cache. '''
+        self._entries.pop((user, program), None)
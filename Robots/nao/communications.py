@@ -2,7 +2,7 @@ from enum import Enum, IntEnum
 import logging
 import json
 import socket
-from threading import Lock, Thread
+from threading import Lock
 import time
 import traceback
 
@@ -10,8 +10,16 @@ import requests
 import ssl
 import websocket
 
+from cache import CachedProgram, ProgramCache
 from engine import Engine
 import logger
+from outbox import Outbox
+from recording import Recorder
+from rest import RestClient
+import wire
+from worker import Worker
+
+_log = logger.get_logger('Comms')
 
 try:
     from robot import Robot
@@ -56,18 +64,29 @@ class ClientMessageType(IntEnum):
     STEP_ERRORED = 1502
 
 class Communications(object):
-    '''The communications interface. '''
+    '''The communications interface.
+
+    The websocket thread only reads the messages: anything slow (creating the engine, downloading and
+    preparing programs and running them) is passed to a single worker thread, which runs the jobs in the
+    order they arrived. This keeps the websocket free, so a stop request is handled straight away: if the
+    program is still waiting to start (e.g. behind a download), the queued start is cancelled instead. '''
 
-    def __init__(self,  use_robot=True, reconnectAttempts = None):
-        ''' Initialises the communications. '''
+    def __init__(self,  use_robot=True, reconnectAttempts = None, backend=Engine.VM, trace=None, binary=True):
+        ''' Initialises the communications. If trace is set, the engine runs are recorded to that file. If binary
+is set, the binary encoding is offered to the server for the state updates and debug messages. '''
         self._use_robot = use_robot
+        self._binary = binary
+        self._encoder = None
+        self._backend = backend
+        self._recorder = None if trace is None else Recorder(open(trace, 'wb'))
         self._reconnect = reconnectAttempts
         self._serverDisconnected = False
         self._connectionCount = 0
         self._token = None
         self._verify = True
         self._base_address = None
-        self._ast = None
+        self._rest = None
+        self._program = None
         self._secure = True
         self._conversationId = 0
         self._closing = False
@@ -75,58 +94,65 @@ class Communications(object):
         self._ws = None
         self._lock = Lock()
         self._is_running = False
-
+        self._queued_starts = 0
+        self._cancel_queued = False
+        self._cache = ProgramCache()
+        self._worker = Worker('Comms')
+        self._outbox = Outbox(self._write)
 
     def start(self, address, pwd=None, verify=True, secure=True, name=None):
         self._verify = verify
         self._secure = secure
         self._base_address = address
-        start_address = ('https' if self._secure else 'http') + '://' + self._base_address + '/api/v1/version'
-        logger.log('[Comms] Checking server version (%s)', start_address)
+        if self._rest is not None:
+            self._rest.close()
+        self._rest = RestClient(('https' if self._secure else 'http') + '://' + self._base_address, self._verify)
+        start_address = self._rest.url('/api/v1/version')
+        _log.info('Checking server version (%s)', start_address)
         try:
-            response = requests.get(start_address, timeout=10, verify=self._verify)
-            logger.log('[Comms] -> Received response %s', response.text)
+            response = self._rest.get('/api/v1/version')
+            _log.debug('-> Received response %s', response.text)
         except requests.exceptions.ConnectionError as e:
-            logger.log('[Comms] Server not responding: ' + str(e) + '!')
+            _log.warning('Server not responding: %s!', e)
             return False
         except requests.exceptions.Timeout:
-            logger.log('[Comms] Connection attempt timed out!')
+            _log.warning('Connection attempt timed out!')
             return False
         except Exception as e:
-            logger.log('[Comms] unknown error: ' + str(e) + '!')
+            _log.error('unknown error: %s!', e)
             return False
 
-        start_address = ('https' if self._secure else 'http') + '://' + self._base_address + '/api/v1/session'
-        logger.log('[Comms] Authenticating (%s)', start_address)
+        start_address = self._rest.url('/api/v1/session')
+        _log.info('Authenticating (%s)', start_address)
         hostname = socket.gethostname() if name is None else name
-        logger.log('[Comms] -> user name %s', hostname)
+        _log.debug('-> user name %s', hostname)
         start_json = json.dumps({'name': hostname, 'password': pwd, 'role': 'robot'})
         headers = {'Content-type': 'application/json'}
         try:
-            req = requests.post(start_address, data=start_json, verify=self._verify, headers=headers)
+            req = self._rest.post('/api/v1/session', data=start_json, headers=headers)
         except requests.exceptions.ConnectionError:
-            logger.log('[Comms] Server not responding!')
+            _log.warning('Server not responding!')
             return False
         except requests.exceptions.Timeout:
-            logger.log('[Comms] Connection attempt timed out!')
+            _log.warning('Connection attempt timed out!')
             return False
         except Exception as e:
-            logger.log('[Comms] unknown error: ' + str(e) + '!')
+            _log.error('unknown error: %s!', e)
             return False
 
         if req.status_code != 200:
-            logger.log('[Comms] Login failed [' + str(req.status_code) + ']!')
-            logger.log('[Comms] -> ' + req.text)
+            _log.warning('Login failed [%d]!', req.status_code)
+            _log.debug('-> %s', req.text)
 
-            start_address = ('https' if self._secure else 'http') + '://' + self._base_address + '/api/v1/robots/register'
-            logger.log('[Comms] Registering robot %s (%s)', hostname, start_address)
+            start_address = self._rest.url('/api/v1/robots/register')
+            _log.info('Registering robot %s (%s)', hostname, start_address)
             start_json = json.dumps({'machineName': hostname})
             try:
-                req = requests.post(start_address, data=start_json, timeout=1, verify=self._verify, headers=headers)
+                req = self._rest.post('/api/v1/robots/register', data=start_json, headers=headers)
                 req.raise_for_status()
-                logger.log('[Comms] -> robot registered')
+                _log.info('-> robot registered')
             except Exception as e:
-                logger.log('[Comms] registration failed: ' + str(e))
+                _log.error('registration failed: %s', e)
                 return False
 
 
@@ -135,7 +161,7 @@ class Communications(object):
         authResp = json.loads(req.text)
         self._token = authResp['output']['token']
         ws_address = ('wss' if self._secure else 'ws') + '://' + self._base_address + '/api/v1/connections/robot'
-        logger.log('[Comms] Connecting to %s', ws_address)
+        _log.info('Connecting to %s', ws_address)
         self._ws = websocket.WebSocketApp(ws_address,
                                           on_message=self._message,
                                           on_error=self._error,
@@ -152,10 +178,10 @@ class Communications(object):
                 delayTime = 2 ** self._connectionCount
                 if delayTime > 60:
                     delayTime = 60
-                logger.log('[Comms] Pausing for %ds', delayTime)
+                _log.info('Pausing for %ds', delayTime)
                 for _ in range(delayTime):
                     time.sleep(1)
-            logger.log('[Comms] Connection attempt #%d', self._connectionCount)
+            _log.info('Connection attempt #%d', self._connectionCount)
             if not self._verify:
                 self._ws.run_forever(sslopt={"cert_reqs": ssl.CERT_NONE})
             else:
@@ -173,92 +199,181 @@ class Communications(object):
 
     def broadcastEvent(self, id):
         if self._use_robot:
-            logger.log('[Comms] Broadcasting notification %d', id)
+            _log.info('Broadcasting notification %d', id)
             r = Robot('127.0.0.1')
             n = r.getNotification(id)
             self.send(ClientMessageType.ALERT_BROADCAST, {'id': id, 'message': n.message, 'severity': n.severity})
         else:
-            logger.log('[Comms] Not connected to robot, skipping notification %d', id)
+            _log.info('Not connected to robot, skipping notification %d', id)
 
     def _execute_code(self, data):
-        logger.log('[Comms] Running code')
+        _log.info('Running code')
+        # Only the worker sets the current conversation, so the messages sent during the run (including
+        # the engine's) are labelled with the start request, not with any message that arrives meanwhile
+        self._conversationId = data['conversationId']
+        encoder = self._encoder
+        if encoder is not None:
+            # Start a new string table for each program, so the table does not keep growing
+            encoder.reset()
         self.send(ClientMessageType.ROBOT_STATE_UPDATE, {'state': 'Initialising'})
         try:
             opts = json.loads(data['values']['opts'])
         except KeyError:
             opts = {}
         self._engine.configure(opts)
-        self.send(ClientMessageType.PROGRAM_STARTED, {})
-        self.send(ClientMessageType.ROBOT_STATE_UPDATE, {'state': 'Running'})
+
+        # The start is queued until now, so a stop that arrived before this point cancels it
         self._lock.acquire()
-        self._is_running = True
+        self._queued_starts -= 1
+        is_cancelled = self._cancel_queued
+        if self._queued_starts == 0:
+            self._cancel_queued = False
+        if not is_cancelled:
+            self._is_running = True
         self._lock.release()
-        self._engine.run(self._ast)
+        if is_cancelled:
+            _log.info('Program was stopped before it started')
+            self.send(ClientMessageType.PROGRAM_STOPPED, {})
+            self.send(ClientMessageType.ROBOT_STATE_UPDATE, {'state': 'Waiting'})
+            self._conversationId = 0
+            return
+
+        self.send(ClientMessageType.PROGRAM_STARTED, {})
+        self.send(ClientMessageType.ROBOT_STATE_UPDATE, {'state': 'Running'})
+        self._engine.run(self._program)
         self._lock.acquire()
         self._is_running = False
         self._lock.release()
-        self.send(ClientMessageType.PROGRAM_STOPPED if self._engine.is_cancelled else 103, {})
+        self.send(ClientMessageType.PROGRAM_STOPPED if self._engine.is_cancelled else 103, self._engine.summary())
         self.send(ClientMessageType.ROBOT_STATE_UPDATE, {'state': 'Waiting'})
         self._conversationId = 0
+        stats = self._outbox.stats()
+        _log.info('Outbound queue: peak depth %d, %d sent, %d coalesced, %d dropped, %d failed',
+                  stats['peakDepth'], stats['sent'], stats['coalesced'], stats['dropped'], stats['failed'])
+
+    def _download_program(self, user, program):
+        ''' Downloads and compiles a program, using the cached version if it has not changed. '''
+        program_path = '/api/v1/code/' + user + '/' + program
+        _log.info('Downloading program from %s', self._rest.url(program_path))
+        headers = {'Authorization': 'Bearer ' + self._token}
+        cached = self._cache.get(user, program)
+        if cached is not None:
+            headers['If-None-Match'] = cached.etag
+
+        req = self._rest.get(program_path, headers=headers)
+        if req.status_code == 304 and cached is not None:
+            _log.info('Program has not changed, using cached version')
+            if cached.engine is not self._engine:
+                # The engine has been replaced (e.g. after reconnecting), so the compiled program is stale
+                cached.program = self._engine.compile(cached.nodes)
+                cached.engine = self._engine
+                return cached.program
+            return self._engine.load(cached.program)
+
+        req.raise_for_status()
+        _log.info('Program downloaded')
+        if _log.is_enabled(logger.DEBUG):
+            _log.debug('-> %s', req.text)
+
+        nodes = json.loads(req.text)['output']['nodes']
+        compiled = self._engine.compile(nodes)
+        etag = req.headers.get('ETag')
+        if etag:
+            self._cache.put(user, program, CachedProgram(etag, nodes, compiled, self._engine))
+        else:
+            self._cache.remove(user, program)
+        return compiled
+
+    def _receive_program(self, values, conversation_id):
+        ''' Downloads a program and then prepares the robot for it. '''
+        try:
+            self._program = self._download_program(values['user'], values['program'])
+            values = {}
+            if self._program.diagnostics:
+                values['diagnostics'] = json.dumps(self._program.diagnostics)
+            self.send(ClientMessageType.PROGRAM_DOWNLOADED, values, conversation_id)
+        except Exception as e:
+            _log.error('unknown error: %s!', e)
+            self.send(ClientMessageType.UNABLE_TO_DOWNLOAD_PROGRAM, { 'error': str(e) }, conversation_id)
+            self.send(ClientMessageType.ROBOT_STATE_UPDATE, {'state': 'Waiting'}, conversation_id)
+            return
+
+        self._prepare_program(self._program, conversation_id)
+
+    def _prepare_program(self, program, conversation_id):
+        ''' Prepares the robot for the downloaded program and tells the server when it is ready. '''
+        values = {'state': 'Prepared'}
+        try:
+            values['prepareTime'] = str(self._engine.prepare(program))
+        except Exception as e:
+            _log.warning('Unable to prepare program: %s', e)
+        self.send(ClientMessageType.ROBOT_STATE_UPDATE, values, conversation_id)
 
     def _message(self, *args):
         message = args[-1]
-        logger.log('[Comms] <- %s', message)
+        _log.debug('<- %s', message)
         data = json.loads(message)
         try:
             msg_type = ClientMessageType(data['type'])
-            logger.log('[Comms] Received %s', repr(msg_type))
+            _log.debug('Received %r', msg_type)
         except:
             # Do nothing, this is just debug information so we can ignore it if it failed
             pass
 
-        self._conversationId = data['conversationId']
+        # The jobs on the worker may still be sending for earlier messages, so each message passes on its
+        # own conversation
+        conversation_id = data['conversationId']
         if data['type'] == ClientMessageType.DOWNLOAD_PROGRAM:
-            self.send(ClientMessageType.ROBOT_STATE_UPDATE, {'state': 'Downloading'})
-            program_address = ('https' if self._secure else 'http') + '://' + self._base_address + '/api/v1/code/' + data['values']['user'] + '/' + data['values']['program']
-            logger.log('[Comms] Downloading program from %s', program_address)
-            headers = {'Authorization': 'Bearer ' + self._token}
-            try:
-                req = requests.get(program_address, verify=self._verify, headers=headers)
-                req.raise_for_status()
-                logger.log('[Comms] Program downloaded')
-                logger.log('[Comms] -> %s', req.text)
-
-                result = json.loads(req.text)
-                self._ast = result['output']['nodes']
-
-                self.send(ClientMessageType.PROGRAM_DOWNLOADED, {})
-                self.send(ClientMessageType.ROBOT_STATE_UPDATE, {'state': 'Prepared'})
-            except Exception as e:
-                logger.log('[Comms] unknown error: %s!', e)
-                self.send(ClientMessageType.UNABLE_TO_DOWNLOAD_PROGRAM, { 'error': str(e) } )
-                self.send(ClientMessageType.ROBOT_STATE_UPDATE, {'state': 'Waiting'})
-                self._conversationId = 0
+            self.send(ClientMessageType.ROBOT_STATE_UPDATE, {'state': 'Downloading'}, conversation_id)
+            self._worker.submit(self._receive_program, data['values'], conversation_id)
 
         elif data['type'] == ClientMessageType.START_PROGRAM:
-            thrd = Thread(target=self._execute_code, args=(data,))
-            thrd.start()
+            # The worker runs the jobs in order, so the program has been downloaded and prepared by now
+            self._lock.acquire()
+            self._queued_starts += 1
+            self._lock.release()
+            self._worker.submit(self._execute_code, data)
 
         elif data['type'] == ClientMessageType.STOP_PROGRAM:
             self._lock.acquire()
             is_running = self._is_running
+            is_queued = self._queued_starts > 0
+            if is_queued and not is_running:
+                self._cancel_queued = True
             self._lock.release()
 
             if is_running:
-                logger.log('[Comms] Cancelling current run')
-                self.send(ClientMessageType.ROBOT_STATE_UPDATE, {'state': 'Cancelling'})
+                _log.info('Cancelling current run')
+                self.send(ClientMessageType.ROBOT_STATE_UPDATE, {'state': 'Cancelling'}, conversation_id)
                 self._engine.cancel()
+            elif is_queued:
+                _log.info('Cancelling queued run')
+                self.send(ClientMessageType.ROBOT_STATE_UPDATE, {'state': 'Cancelling'}, conversation_id)
             else:
-                logger.log('[Comms] Ignoring cancellation - already completed')
+                _log.info('Ignoring cancellation - already completed')
 
         elif data['type'] == ClientMessageType.AUTHENTICATED:
-            logger.log('[Comms] Robot has been authenticated')
-            time.sleep(1)       # Need to add a delay as the server needs time to update the database after the first authentication
-            self.send(ClientMessageType.ROBOT_STATE_UPDATE, {'state': 'Waiting'})
-            self._conversationId = 0
+            _log.info('Robot has been authenticated')
+            if self._binary and (data.get('values') or {}).get('encoding') == wire.FORMAT:
+                _log.info('Using the binary encoding')
+                self._encoder = wire.Encoder()
+            self._worker.submit(self._authenticated, conversation_id)
 
         else:
-            logger.log('[Comms] Unknown or missing message type "%s"', data['type'])
+            _log.warning('Unknown or missing message type "%s"', data['type'])
+
+    def _authenticated(self, conversation_id):
+        time.sleep(1)       # Need to add a delay as the server needs time to update the database after the first authentication
+        self.send(ClientMessageType.ROBOT_STATE_UPDATE, {'state': 'Waiting'}, conversation_id)
+
+    def _create_engine(self):
+        if self._engine is not None:
+            # Each connection has a new engine, so stop the old one's threads before replacing it
+            self._engine.close()
+        try:
+            self._engine = Engine(self, self._use_robot, backend=self._backend, recorder=self._recorder)
+        except:
+            traceback.print_exc()
 
     def _error(self, *args):
         error = args[-1]
@@ -266,36 +381,65 @@ class Communications(object):
             self._serverDisconnected = False
             return
         self._serverDisconnected = True
-        logger.log('[Comms] Lost connection: %s', error)
+        _log.warning('Lost connection: %s', error)
 
     def _close(self, *args):
-        logger.log('[Comms] Closed')
+        _log.info('Closed')
 
     def _open(self, *args):
-        logger.log('[Comms] Opened')
+        _log.info('Opened')
         self._serverDisconnected = False
         self._connectionCount = 0
-        self.send(ClientMessageType.AUTHENTICATE, { 'token': self._token })
-        try:
-            self._engine = Engine(self, self._use_robot)
-        except:
-            traceback.print_exc()
-        
-    def send(self, msg_type, data):
+        # The server decides on the encoding for each connection, so the messages are JSON until it agrees
+        self._encoder = None
+        values = { 'token': self._token }
+        if self._binary:
+            values['encodings'] = wire.FORMAT
+        self.send(ClientMessageType.AUTHENTICATE, values)
+        self._worker.submit(self._create_engine)
+
+    def send(self, msg_type, data, conversation_id=None):
+        ''' Queues a message to send to the server. This can be called from any thread.
+
+The message is part of the current conversation (i.e. the running program), unless a conversation is
+passed in. '''
         try:
             msg_type_value = msg_type.value
-            logger.log('[Comms] Sending %s', repr(msg_type))
+            _log.debug('Sending %r', msg_type)
         except AttributeError:
             msg_type_value = msg_type
-            logger.log('[Comms] Sending message of type %s', str(msg_type))
-        msg = json.dumps({
-            'type': msg_type_value,
-            'conversationId': self._conversationId,
-            'values': data
-        })
-        logger.log('[Comms] -> %s', msg)
+            _log.debug('Sending message of type %s', msg_type)
+        if conversation_id is None:
+            conversation_id = self._conversationId
+        self._outbox.put(msg_type_value, conversation_id, data)
+
+    def queue_stats(self):
+        ''' Retrieves the counters for the outbound queue (depth, peak depth, sent, coalesced, dropped and failed.) '''
+        return self._outbox.stats()
+
+    def _write(self, msg_type, conversation_id, data):
+        ''' Sends a message from the outbound queue, using the binary encoding if the server supports it. '''
+        encoder = self._encoder
+        if encoder is not None:
+            frame = encoder.encode(msg_type, conversation_id, data)
+            if frame is not None:
+                _log.debug('-> [%d bytes]', len(frame))
+                try:
+                    self._ws.send(frame, opcode=websocket.ABNF.OPCODE_BINARY)
+                except:
+                    # The server may not have received the new strings, so start a new table
+                    encoder.reset()
+                    raise
+                return
+
+        msg = wire.encode_json(msg_type, conversation_id, data)
+        _log.debug('-> %s', msg)
         self._ws.send(msg)
 
     def close(self):
-        logger.log('[Comms] Closing down communications')
+        _log.info('Closing down communications')
         self._closing = True
+        self._worker.close()
+        self._outbox.flush()
+        if self._rest is not None:
+            self._rest.close()
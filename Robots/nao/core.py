@@ -0,0 +1,224 @@
+''' Provides the engine core that is shared by the Nao and mBot2 clients.
+
+This module must run on CPython 2 and 3, and on MicroPython (the mBot2 CyberPi), so it only uses
+language features and modules that all three have. The mBot2 client is deployed as a single file,
+so build.py in mBot2-Blocks inlines this module into it: run it after changing this file. '''
+try:
+    from threading import Event
+except ImportError:
+    # MicroPython on the CyberPi does not have threading, so cancellable waits poll instead
+    Event = None
+from time import sleep
+
+# The telemetry levels
+TELEMETRY_OFF = 'off'
+TELEMETRY_SUMMARY = 'summary'
+TELEMETRY_FULL = 'full'
+TELEMETRY_LEVELS = (TELEMETRY_OFF, TELEMETRY_SUMMARY, TELEMETRY_FULL)
+
+
+def parse_telemetry(opts):
+    ''' Retrieves the telemetry level from the run options.
+
+    An explicit telemetry option is used if it is valid, otherwise a debug option of false turns
+    telemetry off. The default is full telemetry, which is what the clients expect. '''
+    try:
+        level = opts['telemetry']
+        if level in TELEMETRY_LEVELS:
+            return level
+    except KeyError:
+        pass
+
+    try:
+        return TELEMETRY_FULL if opts['debug'] else TELEMETRY_OFF
+    except KeyError:
+        return TELEMETRY_FULL
+
+
+class DepthLimitError(Exception):
+    ''' Raised when a program nests blocks deeper than the engine allows. '''
+
+    def __init__(self, limit):
+        Exception.__init__(self, 'Program is nested too deeply (the limit is ' + str(limit) + ')')
+
+
+class Cancellation(object):
+    ''' Signals that the current run has been cancelled, waking any waits as soon as possible. '''
+
+    # How often to check for cancellation when threading is not available (in seconds)
+    POLL_INTERVAL = 0.05
+
+    __slots__ = ('is_cancelled', '_event')
+
+    def __init__(self):
+        self.is_cancelled = False
+        self._event = None if Event is None else Event()
+
+    def cancel(self):
+        ''' Cancels the run. '''
+        self.is_cancelled = True
+        if not self._event is None:
+            self._event.set()
+
+    def reset(self):
+        ''' Clears the cancellation for a new run. '''
+        self.is_cancelled = False
+        if not self._event is None:
+            self._event.clear()
+
+    def wait(self, seconds):
+        ''' Waits for a number of seconds (including fractions.) Returns True if the run has been cancelled. '''
+        if not self._event is None:
+            if seconds > 0:
+                self._event.wait(seconds)
+            return self.is_cancelled
+
+        while seconds > 0 and not self.is_cancelled:
+            step = min(seconds, Cancellation.POLL_INTERVAL)
+            sleep(step)
+            seconds -= step
+        return self.is_cancelled
+
+
+class EngineFunction(object):
+    ''' Defines a function that can be executed on the engine.
+
+    A pure function only depends on its arguments and has no side effects, so calls with constant
+    arguments can be evaluated before the program runs. Arguments is the minimum number of arguments
+    the function needs. A control function is a generator that yields the blocks to run (e.g. each
+    pass of a loop), so the engine can run them without recursing. '''
+
+    __slots__ = ('_func', 'top_level', 'pure', 'arguments', 'control')
+
+    def __init__(self, func, top_level=False, pure=False, arguments=0, control=False):
+        self._func = func
+        self.top_level = top_level
+        self.pure = pure
+        self.arguments = arguments
+        self.control = control
+
+    def execute(self, state):
+        ''' Executes the function. '''
+        return self._func(state)
+
+
+class OperatorFunction(EngineFunction):
+    ''' A pure function that applies one of the operators to its arguments. '''
+
+    __slots__ = ()
+
+    def __init__(self, operator, arguments):
+        EngineFunction.__init__(self, operator, pure=True, arguments=arguments)
+
+    def execute(self, state):
+        ''' Evaluates the arguments from the state and applies the operator. '''
+        if self.arguments == 1:
+            return self._func(state.argument(0))
+        return self._func(state.argument(0), state.argument(1))
+
+    def apply(self, first, second=None):
+        ''' Applies the operator to arguments that have already been evaluated. '''
+        if self.arguments == 1:
+            return self._func(first)
+        return self._func(first, second)
+
+
+class ExecutionState(object):
+    ''' Defines the current execution state.
+
+    Args holds the evaluators for the arguments, when the engine has compiled them. '''
+
+    __slots__ = ('function', 'ast', 'parent', 'args', 'body', 'completed')
+
+    def __init__(self, ast, parent, function, args=None, body=None):
+        self.reset(ast, parent, function, args, body)
+
+    def reset(self, ast, parent, function, args=None, body=None):
+        ''' Resets the state, so it can be reused for another call. '''
+        self.function = function
+        self.ast = ast
+        self.parent = parent
+        self.args = args
+        self.body = body
+        self.completed = False
+
+    def argument(self, index):
+        ''' Evaluates an argument using its compiled evaluator. '''
+        return self.args[index](self)
+
+    def complete(self):
+        ''' Marks the state as completed. '''
+        self.completed = True
+
+
+class StatePool(object):
+    ''' Reuses execution states, so running a block does not allocate a new state each time.
+
+    A state must only be released once nothing refers to it any more (e.g. when its function has
+    returned.) Created counts the states that had to be allocated because the pool was empty. '''
+
+    __slots__ = ('_free', 'created')
+
+    def __init__(self):
+        self._free = []
+        self.created = 0
+
+    def acquire(self, ast, parent, function, args=None, body=None):
+        ''' Retrieves a state from the pool, or allocates one if the pool is empty. '''
+        try:
+            state = self._free.pop()
+        except IndexError:
+            self.created += 1
+            return ExecutionState(ast, parent, function, args, body)
+        state.reset(ast, parent, function, args, body)
+        return state
+
+    def release(self, state):
+        ''' Returns a state to the pool, clearing its references so they can be collected. '''
+        state.reset(None, None, None)
+        self._free.append(state)
+
+
+def _not(value):
+    return not value
+
+
+def _round(value):
+    return round(value, 0)
+
+
+def _equal(value1, value2):
+    return value1 == value2
+
+
+def _not_equal(value1, value2):
+    return value1 != value2
+
+
+def _less_than(value1, value2):
+    return value1 < value2
+
+
+def _less_than_equal(value1, value2):
+    return value1 <= value2
+
+
+def _greater_than(value1, value2):
+    return value1 > value2
+
+
+def _greater_than_equal(value1, value2):
+    return value1 >= value2
+
+
+# The operators: these are shared by every engine, so they are only created once
+OPERATORS = {
+    'not': OperatorFunction(_not, 1),
+    'round': OperatorFunction(_round, 1),
+    'equal': OperatorFunction(_equal, 2),
+    'notEqual': OperatorFunction(_not_equal, 2),
+    'lessThan': OperatorFunction(_less_than, 2),
+    'lessThanEqual': OperatorFunction(_less_than_equal, 2),
+    'greaterThan': OperatorFunction(_greater_than, 2),
+    'greaterThanEqual': OperatorFunction(_greater_than_equal, 2),
+}
@@ -2,23 +2,154 @@
 import json
 import math
 import random
+import sys
+import threading
 import time
 import pdb
 
+from core import Cancellation, DepthLimitError, EngineFunction, ExecutionState, OPERATORS, StatePool
 import sensors
 from movements import ArmMovement, BodyMovement, Dances, HeadMovement, Movements
 from noRobot import RobotMock
 import logger
+from profiler import Profiler
+import recording
+import scheduler
+from simulation import SimulatedRobot
+import telemetry
+import vm
+
+_log = logger.get_logger('Engine')
 
 try:
     from robot import Robot
 except ImportError:
     Robot = RobotMock
 
+# Marks a variable slot that has not been assigned a value
+_UNDEFINED = object()
+
+# The behaviour functions: the function name, the name to log and the behaviour to start
+_BEHAVIOURS = [
+    ('arabasque', 'Arabasque', Movements.ARABESQUE),
+    ('plie', 'Plie', Movements.PLIE),
+    ('single', 'Single', Movements.SINGLE),
+    ('arabasqueRight', 'ArabasqueRight', Movements.ARABESQUERIGHT),
+    ('fly', 'Fly', Movements.FLY),
+    ('ballet3', 'Ballet3', Movements.BALLET3),
+    ('ballet2', 'Ballet2', Movements.BALLET2),
+    ('ballet1', 'Ballet1', Movements.BALLET1),
+    ('enavont', 'enavont', Movements.ENAVONT),
+    ('up', 'up', Movements.UP),
+    ('rest', 'rest', Movements.REST),
+    ('leftArmOut', 'leftArmOut', Movements.LEFT_ARM_OUT),
+    ('rightArmOut', 'rightArmOut', Movements.RIGHT_ARM_OUT),
+]
+_BEHAVIOUR_IDS = dict((name, behaviour) for name, _, behaviour in _BEHAVIOURS)
+
+_DANCES = {
+    'macaranna': Dances.MACARENA,
+    'gangnam': Dances.GANGNAM,
+    'taichi': Dances.TAICHI
+}
+
+
+
+def _look_movement(direction):
+    movement = HeadMovement()
+    if direction == 'left':
+        return movement.lookLeft()
+    elif direction == 'right':
+        return movement.lookRight()
+    elif direction == 'ahead':
+        return movement.lookAhead()
+    return movement
+
+
+def _point_movement(arm, direction):
+    movement = ArmMovement(ArmMovement.LEFT if arm == 'left' else ArmMovement.RIGHT)
+    if direction == 'out':
+        return movement.pointOut()
+    elif direction == 'down':
+        return movement.pointDown()
+    elif direction == 'up':
+        return movement.pointUp()
+    elif direction == 'ahead':
+        return movement.pointAhead()
+    return movement
+
+
+# The movement builders for each function: the builder and the number of arguments it takes
+_MOVEMENTS = {
+    'wave': (lambda: BodyMovement().wave(), 0),
+    'wipe_forehead': (lambda: BodyMovement().wipeForehead(), 0),
+    'look': (_look_movement, 1),
+    'point': (_point_movement, 2),
+}
+
+# The robot resources that actions use: actions that use different resources can run at the same time
+VOICE = 'voice'
+HEAD = 'head'
+LEFT_ARM = 'leftArm'
+RIGHT_ARM = 'rightArm'
+LEGS = 'legs'
+LEDS = 'leds'
+ALL_RESOURCES = frozenset([VOICE, HEAD, LEFT_ARM, RIGHT_ARM, LEGS, LEDS])
+
+
+def _joint_resources(names):
+    ''' Works out the resources a movement uses from the names of its joints. '''
+    resources = set()
+    for name in names:
+        if name.startswith('Head'):
+            resources.add(HEAD)
+        elif name[1:4] in ('Hip', 'Kne', 'Ank'):
+            resources.add(LEGS)
+        elif name.startswith('L'):
+            resources.add(LEFT_ARM)
+        else:
+            resources.add(RIGHT_ARM)
+    return frozenset(resources)
+
+
+# The functions that move the robot, so the motors need to be awake
+_MOTION_FUNCTIONS = set(['wave', 'dance', 'look', 'point', 'walk', 'turn', 'position', 'wipe_forehead', 'changeHand'] +
+                        [name for name, _, _ in _BEHAVIOURS])
+
+# The token types for the expressions that can be evaluated
+_EXPRESSION_TYPES = ('Text', 'Constant', 'Number', 'Boolean', 'Colour', 'Identifier', 'Variable')
+
+# The Python stack frames the tree backend uses for each level of nested blocks (compiling an if in a
+# compound is the deepest: _compile_block, _compile_node, _compile_compound, _compile_function and a list
+# comprehension in two of them), and the frames to leave for everything else (e.g. robot calls and logging).
+# The recursion limit is shared by every thread, so the tree backend fits its nesting into it rather
+# than raising it.
+_FRAMES_PER_LEVEL = 6
+_STACK_HEADROOM = 300
+
+# The blocks whose children run later (e.g. when a button is pressed), rather than in program order
+_DEFERRED_BLOCKS = ('function', 'frontButton', 'middleButton', 'rearButton', 'chestButton', 'wordRecognised')
+
+
+def _literal_text(node):
+    ''' Retrieves the value of a text argument, or None if the argument is not text. '''
+    token = node.get('token') or {}
+    if node.get('type') == 'Constant' and token.get('type') in ('Text', 'Constant'):
+        return str(token.get('value'))
+    return None
+
 
 class EngineSettings(object):
     ''' The configuration options for the engine. '''
 
+    # The default number of custom function calls that can be nested (e.g. by a recursive function)
+    DEFAULT_MAX_DEPTH = 100
+
+    # The default number of levels of blocks that can be nested. This is checked when the program is
+    # compiled, and by the tree backend when custom function bodies nest at run time. The tree backend
+    # uses the Python stack for each level, so its limit can be lower (see Engine._nesting_limit.)
+    DEFAULT_MAX_NESTING = 500
+
     def __init__(self, opts):
         ''' Initialises the options. '''
         try:
@@ -31,201 +162,732 @@ class EngineSettings(object):
         except KeyError:
             self.delay = 0
 
+        try:
+            self.max_depth = int(opts['maxDepth'])
+        except (KeyError, ValueError):
+            self.max_depth = EngineSettings.DEFAULT_MAX_DEPTH
+
+        try:
+            self.max_nesting = int(opts['maxNesting'])
+        except (KeyError, ValueError):
+            self.max_nesting = EngineSettings.DEFAULT_MAX_NESTING
+
+        self.telemetry = telemetry.parse_level(opts)
 
-class EngineFunction(object):
-    ''' Defines a function that can be executed on the engine. '''
+        # Whether actions are left running while the following blocks start
+        try:
+            self.pipeline = opts['pipeline']
+        except KeyError:
+            self.pipeline = False
+
+        # Whether to profile the blocks: the profile is either sent when the program finishes, or saved to a file
+        try:
+            self.profile = opts['profile']
+        except KeyError:
+            self.profile = False
+
+        try:
+            self.profile_file = opts['profileFile']
+        except KeyError:
+            self.profile_file = None
 
-    def __init__(self, func, top_level=False):
-        self._func = func
-        self.top_level = top_level
+        # What to do when an event handler is triggered while it is still running
+        try:
+            self.handlers = opts['handlers']
+        except KeyError:
+            self.handlers = scheduler.DROP
+        if self.handlers not in scheduler.POLICIES:
+            self.handlers = scheduler.DROP
 
-    def execute(self, state):
-        ''' Executes the function. '''
-        return self._func(state)
 
+class _ThreadState(threading.local):
+    ''' The engine state for each thread: event handlers run on their own task threads, alongside the main program. '''
 
-class ExecutionState(object):
-    ''' Defines the current execution state. '''
+    robot = None
+    depth = 0
+    nesting = 0
+    in_task = False
 
-    def __init__(self, ast, parent, function):
-        self.function = function
-        self.ast = ast
-        self.parent = parent
-        self.completed = False
 
-    def complete(self):
-        ''' Marks the state as completed. '''
-        self.completed = True
+class Program(object):
+    ''' Defines a program that has been compiled for the engine. '''
+
+    def __init__(self, ast, execute, slots=None, variable_names=None, problems=None, diagnostics=None):
+        self.ast = ast
+        self.execute = execute
+        self.slots = slots or {}
+        self.variable_names = variable_names or []
+        self.problems = problems or []
+        self.diagnostics = diagnostics or []
 
 
 class Engine(object):
-    ''' The main execution engine for the robot. '''
+    ''' The main execution engine for the robot.
 
-    _is_walking = False
+    The main program and the event handlers run on different threads, so the shared counters and
+    variables are updated under the state lock, and the robot and call depth are kept for each thread. '''
 
     BACK = 0
     LEFT = 1
     RIGHT = 2
     FRONT = LEFT + RIGHT
 
-    def __init__(self, comms, use_robot=True, ip='127.0.0.1'):
-        ''' Initialises the engine. '''
+    TREE = 'tree'
+    VM = 'vm'
+
+    # How often (in seconds) to check for obstacles while walking
+    WALK_CHECK_INTERVAL = 0.1
+
+    def __init__(self, comms, use_robot=True, ip='127.0.0.1', backend=VM, recorder=None, clock=None):
+        ''' Initialises the engine. The recorder (if any) records everything sent to the robot and the server.
+
+A virtual clock (see simulation.py) runs the engine on a simulated robot, where the waits and robot actions
+advance the clock instead of taking real time. '''
+        self._recorder = recorder
+        self._clock = clock
+        if recorder is not None:
+            comms = recording.RecordingComms(comms, recorder)
         self._comms = comms
+        self._telemetry = telemetry.DebugChannel(comms)
+        self._backend = backend
         self._opts = EngineSettings({})
+        self._max_nesting = self._nesting_limit()
+        self._summary = {}
+        self._cancellation = Cancellation() if clock is None else clock.cancellation()
+        self._states = StatePool()
+        self._profiler = None
+        self._scheduler = scheduler.Scheduler()
+        self._local = _ThreadState()
+        self._state_lock = threading.Lock()
+        self._slots = {}
+        self._variable_names = []
+        self._download_problems = set()
+        self._movements = {}
+        self._preloaded = set()
+        self._prepared_robot = None
+        self._builtins = self._build_functions()
         self._reset(None)
         self.is_cancelled = False
         self._robot = None
         self._use_robot = use_robot
-        self._variables = {}
         self._last_word = ''
         self._ip = ip
 
-        self._leftFoot = None
-        self._rightFoot = None
-        self._leftSonar = None
-        self._rightSonar = None
-
         with self._initialise_robot(ip) as robot:
-            logger.log('[Engine] Robot is ready')
+            _log.info('Robot is ready')
             robot.say('I am ready now')
 
     def configure(self, opts):
         ''' Configures the engine. '''
+        if self._recorder is not None:
+            self._recorder.options(opts)
         self._opts = EngineSettings(opts)
+        self._max_nesting = self._nesting_limit()
+        self._summary = {'blocks': 0, 'states': 0, 'errors': 0}
         self.is_cancelled = False
+        self._cancellation.reset()
+        self._scheduler.policy = self._opts.handlers
+        if self._opts.profile or self._opts.profile_file:
+            self._profiler = Profiler()
+        else:
+            self._profiler = None
 
     def cancel(self):
         ''' Cancels the current run. '''
         self.is_cancelled = True
+        self._cancellation.cancel()
+        self._scheduler.cancel()
+
+    def close(self):
+        ''' Closes the engine when it is being replaced (e.g. after reconnecting.)
+
+This cancels any run and event handlers, sends any buffered debug events and stops the telemetry thread. '''
+        _log.info('Closing engine')
+        self.cancel()
+        self._telemetry.close()
+
+    def compile(self, ast):
+        ''' Compiles an AST into a program.
+
+This resolves function lookups, argument evaluators and top level checks once, so running the
+program does not need to look into the AST. '''
+        _log.info('Compiling program [%s]', self._backend)
+        ast, diagnostics = self._validate(ast)
+        problems = self._resolve_variables(ast)
+        for name in problems:
+            diagnostics.append({'sourceId': None, 'message': 'Variable ' + name + ' is used before it is defined'})
+        if self._backend == Engine.VM:
+            execute = vm.Machine(self, vm.Compiler(self).compile(ast)).execute
+        else:
+            execute = self._compile_block(ast, True)
+        return self.load(Program(ast, execute, self._slots, self._variable_names, problems, diagnostics))
+
+    def load(self, program):
+        ''' Loads a compiled program so it is ready to run.
+
+The problems found while compiling are in the program's diagnostics, which are sent when the program
+runs rather than each time the blocks run. '''
+        self._slots = program.slots
+        self._variable_names = program.variable_names
+        self._download_problems = set(self._slots[name] for name in program.problems)
+        self._variables = [_UNDEFINED] * len(self._variable_names)
+        return program
+
+    def prepare(self, program):
+        ''' Prepares the robot for a program, so the first blocks do not pay any set-up costs.
+
+This builds the movements the program uses, preloads its behaviours and wakes the robot if it
+needs to move. Returns the time taken in milliseconds. '''
+        start = time.time()
+        used = set()
+        behaviours = set()
+        nodes = list(program.ast or [])
+        while nodes:
+            node = nodes.pop()
+            if not isinstance(node, dict):
+                continue
+            name = (node.get('token') or {}).get('value')
+            args = node.get('arguments') or []
+            nodes.extend(args)
+            nodes.extend(node.get('children') or [])
+            if node.get('type') != 'Function':
+                continue
+
+            used.add(name)
+            values = [_literal_text(arg) for arg in args]
+            if name in _BEHAVIOUR_IDS:
+                behaviours.add(_BEHAVIOUR_IDS[name])
+            elif name == 'dance' and values and values[0] in _DANCES:
+                behaviours.add(_DANCES[values[0]])
+            elif name in _MOVEMENTS:
+                count = _MOVEMENTS[name][1]
+                if None not in values[:count] and len(values) >= count:
+                    self._movement(name, *values[:count])
+
+        if self._prepared_robot is None:
+            self._prepared_robot = self._initialise_robot(self._ip)
+        robot = self._prepared_robot
+        for behaviour in behaviours - self._preloaded:
+            if robot.preloadBehaviour(behaviour):
+                self._preloaded.add(behaviour)
+        if used & _MOTION_FUNCTIONS:
+            robot.wakeUp()
+
+        duration = int((time.time() - start) * 1000)
+        _log.info('Prepared program in %dms', duration)
+        return duration
+
+    def _validate(self, ast):
+        ''' Checks a program for blocks that can never run and removes them.
+
+Returns the pruned AST and a list of diagnostics, so each problem is reported once when the program
+is downloaded rather than every time the block runs. '''
+        defined = set()
+        nodes = list(ast or [])
+        while nodes:
+            node = nodes.pop()
+            nodes.extend(node.get('children') or [])
+            args = node.get('arguments') or []
+            if node.get('type') == 'Function' and node['token']['value'] == 'function' and args:
+                defined.add(args[0]['token']['value'])
+
+        diagnostics = []
+        return self._validate_block(ast or [], True, defined, diagnostics, 0), diagnostics
+
+    def _validate_block(self, ast, top_level, defined, diagnostics, nesting):
+        ''' Validates a list of blocks, returning the blocks that can run.
+
+Blocks whose children would be nested deeper than the limit are removed, so compiling and running the
+program stays within the stack. '''
+        valid = []
+        for block in ast:
+            node_type = block.get('type')
+            if node_type == 'Function':
+                problem = self._check_function(block, top_level, defined)
+            elif node_type == 'Compound':
+                problem = None
+            else:
+                problem = 'Unknown node type: %s' % (node_type, )
+
+            if problem is not None:
+                _log.warning('Removing block %s: %s', block.get('sourceId'), problem)
+                diagnostics.append({'sourceId': block.get('sourceId'), 'message': problem})
+                continue
+
+            children = block.get('children')
+            if children and nesting >= self._max_nesting:
+                problem = str(DepthLimitError(self._max_nesting))
+                _log.warning('Removing block %s: %s', block.get('sourceId'), problem)
+                diagnostics.append({'sourceId': block.get('sourceId'), 'message': problem})
+                continue
+
+            if children:
+                block = dict(block)
+                block['children'] = self._validate_block(children, False, defined, diagnostics, nesting + 1)
+                if node_type == 'Compound' and not block['children']:
+                    continue
+            valid.append(block)
+        return valid
+
+    def _check_function(self, block, top_level, defined):
+        ''' Checks a function call and its arguments. Returns the problem, or None if the call can run. '''
+        func_name = block['token']['value']
+        args = block.get('arguments') or []
+        func = self._builtins.get(func_name)
+        if func is None:
+            if func_name not in defined:
+                return 'Unknown function: ' + func_name
+        elif func.top_level and not top_level:
+            return 'Function ' + func_name + ' cannot be executed here'
+        elif len(args) < func.arguments:
+            return 'Function %s needs %d argument(s)' % (func_name, func.arguments)
+
+        if func_name == 'function':
+            # The first argument is the name of the new function, rather than a call
+            name = args[0]['token']['value']
+            if name in self._builtins:
+                return 'Function ' + name + ' already exists - cannot add'
+            return None
+
+        for arg in args:
+            arg_type = arg['token']['type']
+            if arg_type == 'Identifier':
+                problem = self._check_function(arg, False, defined)
+                if problem is not None:
+                    return problem
+            elif arg_type not in _EXPRESSION_TYPES:
+                return 'Unknown expression type: ' + arg_type
+        return None
+
+    def _resolve_variables(self, ast):
+        ''' Assigns a slot to each variable and returns the variables that are used before they are defined.
+
+Uses in program order must follow a definition, while uses in functions and event handlers only
+need a definition somewhere in the program. '''
+        self._slots = {}
+        self._variable_names = []
+        defined = set()
+        checked = []
+        deferred_uses = []
+        tasks = [(block, False) for block in reversed(ast or [])]
+        while tasks:
+            node, deferred = tasks.pop()
+            if not isinstance(node, dict):
+                # A marker for a variable definition
+                defined.add(node)
+                continue
+
+            token = node.get('token') or {}
+            if node.get('type') == 'Variable' or token.get('type') == 'Variable':
+                name = token.get('value')
+                self._variable_slot(name)
+                if deferred:
+                    deferred_uses.append(name)
+                elif name not in defined:
+                    checked.append(name)
+                continue
+
+            name = token.get('value')
+            args = node.get('arguments') or []
+            children = [(child, deferred or name in _DEFERRED_BLOCKS) for child in node.get('children') or []]
+            if name == 'variable' and args:
+                target = args[0]['token']['value']
+                self._variable_slot(target)
+                items = [(arg, deferred) for arg in args[1:]] + [(target, deferred)] + children
+            else:
+                items = [(arg, deferred) for arg in args] + children
+            tasks.extend(reversed(items))
+
+        problems = []
+        for name in checked + [name for name in deferred_uses if name not in defined]:
+            if name not in problems:
+                problems.append(name)
+        return problems
 
-    def run(self, ast):
-        ''' Executes an AST. '''
-        self._execute(ast, None, True)
+    def _variable_slot(self, name):
+        ''' Retrieves the slot for a variable, adding a new slot if needed. '''
+        try:
+            return self._slots[name]
+        except KeyError:
+            slot = len(self._variable_names)
+            self._slots[name] = slot
+            self._variable_names.append(name)
+            if len(self._variables) == slot:
+                self._variables.append(_UNDEFINED)
+            return slot
+
+    def run(self, program):
+        ''' Executes a compiled program.
+
+The problems found when the program was compiled are sent as errors first (once each), as the blocks
+with them have been removed. '''
+        if not isinstance(program, Program):
+            program = self.compile(program)
+        if self._recorder is not None:
+            self._recorder.program(program.ast)
+        for diagnostic in program.diagnostics:
+            self._error(diagnostic['message'])
+        self._local.depth = 0
+        self._local.nesting = 0
+        try:
+            program.execute(None)
+        except DepthLimitError as e:
+            self._error(str(e))
+        except RuntimeError as e:
+            # The nesting limit should stop the tree backend first, but deep expressions are not counted
+            if 'recursion' not in str(e):
+                raise
+            self._error('Program is nested too deeply')
+        finally:
+            self._telemetry.flush()
+            if self._profiler is not None and self._opts.profile_file:
+                self._profiler.save(self._opts.profile_file)
+
+    def _nesting_limit(self):
+        ''' Retrieves the number of levels of blocks that can be nested.
+
+The tree backend compiles and runs each level on the Python stack, so its limit is what fits in the current
+recursion limit. The bytecode backend only uses the stack for validating and compiling (a frame or two for
+each level), so it can use the configured limit. '''
+        limit = self._opts.max_nesting
+        if self._backend != Engine.VM:
+            limit = min(limit, (sys.getrecursionlimit() - _STACK_HEADROOM) // _FRAMES_PER_LEVEL)
+        return limit
+
+    def summary(self):
+        ''' Retrieves the summary for the current run: the counters (only when summary telemetry is on) and
+the profile (only when profiling is on.) '''
+        values = {}
+        if self._opts.telemetry == telemetry.SUMMARY:
+            values = dict((key, str(value)) for key, value in self._summary.items())
+        if self._profiler is not None and self._opts.profile:
+            values['profile'] = json.dumps(self._profiler.report())
+        return values
 
     def trigger(self, block_name, value=None):
-        ''' Triggers a block in the engine. '''
+        ''' Triggers a block in the engine.
+
+The block runs as a task on the scheduler, so the caller (e.g. a NAOqi event callback) is not blocked
+while it runs. Returns the task, or None if the block was not started. '''
+        if self._recorder is not None:
+            self._recorder.trigger(block_name, value)
         if block_name == 'word':
             self._last_word = value
-        self._generate_execute_block(block_name)(None)
-
-    def _execute(self, ast, state, top_level=False):
-        ''' Executes a block of AST. '''
-        last_result = None
-        for block in ast:
-            if self.is_cancelled:
-                break
-            if block['type'] == 'Function':
-                last_result = self._execute_function(block, state, top_level)
-            elif block['type'] == 'Compound':
-                compound_state = ExecutionState(
-                    block, state, block['token']['value'])
-                for child in block['children']:
-                    last_result = self._execute_function(
-                        child, compound_state, False)
+        try:
+            block = self._blocks[block_name]
+        except KeyError:
+            _log.info('%s block not registered, skipping', block_name)
+            return None
+        return self._scheduler.spawn(block_name, self._run_handler(block_name, block))
+
+    def _run_handler(self, block_name, block):
+        ''' Runs an event handler, yielding after each top level step so other handlers can take turns.
+
+The handler runs on its task's thread, and the nested blocks (and the bytecode backend's loops) also
+give up the turn at checkpoints, so a long loop does not hold up the other handlers. '''
+        _log.info('Executing %s block', block_name)
+        self._local.in_task = True
+        with self._initialise_robot(self._ip) as robot:
+            self._robot = robot
+            try:
+                for step in getattr(block, 'steps', [block]):
+                    if self.is_cancelled:
+                        break
+                    step(None)
+                    yield
+            finally:
+                self._wait_for_robot(robot)
+                self._robot = None
+                self._telemetry.flush()
+        _log.info('%s block completed', block_name)
+
+    @property
+    def _robot(self):
+        ''' The robot for the current thread, as event handlers run alongside the main program. '''
+        return self._local.robot
+
+    @_robot.setter
+    def _robot(self, robot):
+        self._local.robot = robot
+
+    def _compile_block(self, ast, top_level=False):
+        ''' Compiles a block of AST into a single callable. '''
+        steps = [self._compile_node(block, top_level) for block in ast or []]
+        if top_level:
+            def _execute_block(state):
+                ''' Executes each step in the block. '''
+                last_result = None
+                for step in steps:
+                    if self.is_cancelled:
+                        break
+                    last_result = step(state)
+                return last_result
+
+            _execute_block.steps = steps
+            return _execute_block
+
+        def _execute_nested_block(state):
+            ''' Executes each step in a nested block, counting the nesting so it stays within the stack. '''
+            local = self._local
+            if local.nesting >= self._max_nesting:
+                raise DepthLimitError(self._max_nesting)
+            local.nesting += 1
+            in_task = local.in_task
+            try:
+                last_result = None
+                for step in steps:
+                    if self.is_cancelled:
+                        break
+                    if in_task:
+                        self._scheduler.checkpoint()
+                    last_result = step(state)
+                return last_result
+            finally:
+                local.nesting -= 1
+
+        _execute_nested_block.steps = steps
+        return _execute_nested_block
+
+    def _compile_node(self, block, top_level):
+        ''' Compiles a single AST node. '''
+        node_type = block['type']
+        if node_type == 'Function':
+            return self._compile_function(block, top_level)
+        if node_type == 'Compound':
+            return self._compile_compound(block)
+
+        message = 'Unknown node type: %s' % (node_type, )
+        def _unknown_node(state):
+            self._error(message)
+        return _unknown_node
+
+    def _compile_compound(self, block):
+        ''' Compiles a compound node (e.g. an if/elseif/else chain.) '''
+        name = block['token']['value']
+        clauses = [self._compile_function(child, False) for child in block.get('children') or []]
+
+        def _execute_compound(state):
+            ''' Executes clauses until one of them completes the compound. '''
+            compound_state = self._states.acquire(block, state, name)
+            try:
+                last_result = None
+                for clause in clauses:
+                    last_result = clause(compound_state)
                     if compound_state.completed:
                         break
-            else:
-                self._error('Unknown node type: %s' % (block['type'], ))
-        return last_result
+                return last_result
+            finally:
+                self._states.release(compound_state)
 
-    def _execute_function(self, block, state, top_level):
-        ''' Executes a function. '''
+        return _execute_compound
+
+    def _compile_function(self, block, top_level):
+        ''' Compiles a function call, binding the function and its arguments. '''
         func_name = block['token']['value']
-        last_result = None
-        try:
-            func = self._functions[func_name]
-        except KeyError:
-            self._error('Unknown function: ' + func_name)
-            return last_result
+        args = [self._compile_expression(arg) for arg in block.get('arguments') or []]
+        body = self._compile_block(block.get('children'))
+        debug_id = block.get('sourceId')
+        delay = not top_level
+
+        func = self._builtins.get(func_name)
+        if func is not None and func.top_level and not top_level:
+            message = 'Function ' + func_name + ' cannot be executed here'
+            def _invalid_function(state):
+                self._error(message)
+            return _invalid_function
+
+        if func is not None and func.pure and not block.get('children'):
+            folded = self._fold_function(block, func, func_name, args, debug_id, delay)
+            if folded is not None:
+                return folded
 
-        if func.top_level and not top_level:
-            self._error('Function ' + func_name +
-                        ' cannot be executed here')
-        else:
-            logger.log('[Engine] Executing function "%s"', func_name)
-            self._debug(block, 'start')
-            func_state = ExecutionState(block, state, func_name)
-            last_result = func.execute(func_state)
-            if not state is None and func_state.completed:
-                state.complete()
-            if not top_level:
-                self._do_delay()
-            self._debug(block, 'end')
+        def _execute_function(state):
+            ''' Executes the bound function. '''
+            target = func
+            if target is None:
+                # Custom functions are only added when their definition runs
+                try:
+                    target = self._functions[func_name]
+                except KeyError:
+                    self._error('Unknown function: ' + func_name)
+                    return None
+
+            _log.debug('Executing function "%s"', func_name)
+            profiler = self._profiler
+            if profiler is not None:
+                profiler.enter()
+            try:
+                self._debug(debug_id, func_name, 'start')
+                func_state = self._states.acquire(block, state, func_name, args, body)
+                try:
+                    last_result = target.execute(func_state)
+                    if not state is None and func_state.completed:
+                        state.complete()
+                finally:
+                    self._states.release(func_state)
+                if delay:
+                    self._do_delay()
+                self._debug(debug_id, func_name, 'end')
+                return last_result
+            finally:
+                if profiler is not None:
+                    profiler.leave(func_name, debug_id)
+
+        return _execute_function
 
-        return last_result
+    def _compile_expression(self, node):
+        ''' Compiles an expression into an evaluator. '''
+        node_type = node['token']['type']
+        node_value = node['token']['value']
+        if node_type == 'Text' or node_type == 'Constant':
+            return self._compile_literal(str(node_value))
+        elif node_type == 'Number':
+            return self._compile_literal(float(node_value))
+        elif node_type == 'Boolean':
+            return self._compile_literal(node_value == 'TRUE')
+        elif node_type == 'Colour':
+            return self._compile_literal('#' + str(node_value))
+        elif node_type == 'Identifier':
+            return self._compile_node(node, False)
+        elif node_type == 'Variable':
+            slot = self._variable_slot(node_value)
+            def _evaluate_variable(state):
+                return self._read_variable(slot)
+            _evaluate_variable.slot = slot
+            return _evaluate_variable
+
+        def _unknown_expression(state):
+            _log.warning('Unknown expression type: %s', node_type)
+        return _unknown_expression
+
+    def _compile_literal(self, value):
+        ''' Generates an evaluator for a pre-parsed literal value. '''
+        def _evaluate_literal(state):
+            return value
+        _evaluate_literal.constant = True
+        _evaluate_literal.value = value
+        return _evaluate_literal
+
+    def _fold_function(self, block, func, func_name, args, debug_id, delay):
+        ''' Generates an evaluator for a pure function with constant arguments, or None if it cannot be folded.
+
+The result is calculated once, but the debug messages and delay for the block are kept (including
+any folded arguments), so folding is not visible when debugging. '''
+        if not all(getattr(arg, 'constant', False) for arg in args):
+            return None
+
+        values = [self._compile_literal(arg.value) for arg in args]
+        try:
+            value = func.execute(ExecutionState(block, None, func_name, values, None))
+        except Exception:
+            # Leave any errors until the block is run
+            return None
+
+        _log.debug('Folded %s to %s', func_name, value)
+        def _evaluate_folded(state):
+            self._debug(debug_id, func_name, 'start')
+            for arg in args:
+                arg(state)
+            if delay:
+                self._do_delay()
+            self._debug(debug_id, func_name, 'end')
+            return value
+        _evaluate_folded.constant = True
+        _evaluate_folded.value = value
+        return _evaluate_folded
 
     def _do_delay(self):
-        seconds = int(self._opts.delay)
+        seconds = float(self._opts.delay)
         if seconds > 0:
-            logger.log('[Engine] Delaying for ' + str(seconds) + 's')
-            for _ in range(0, seconds):
-                if self.is_cancelled:
-                    break
-                time.sleep(1)
+            _log.debug('Delaying for %ss', seconds)
+            self._cancellation.wait(seconds)
 
     def _error(self, message):
-        logger.log('[Engine] Sending error message: "' + message + '"')
+        _log.warning('Sending error message: "%s"', message)
+        self._count('errors')
+        self._telemetry.flush()
         data = {
             'message': message
         }
         self._comms.send(503, data)
 
     def _change_state(self, name, value):
-        logger.log('[Engine] Sending state change for ' + name + ' of ' + str(value))
+        level = self._opts.telemetry
+        if level == telemetry.OFF:
+            return
+        if level == telemetry.SUMMARY:
+            self._count('states')
+            return
+
+        _log.debug('Sending state change for %s of %s', name, value)
         data = {
             'name': name,
             'value': value
         }
         self._comms.send(501, data)
 
-    def _debug(self, block, status):
-        try:
-            debug_id = block['sourceId']
-            logger.log('[Engine] Sending debug info for block %s [%s]', debug_id, status)
-            data = {
-                'sourceID': debug_id,
-                'status': status,
-                'function': block['token']['value']
-            }
-            self._comms.send(502, data)
-        except KeyError:
-            logger.log('[Engine] Unable to find sourceId, skipping send debug')
+    def _debug(self, debug_id, func_name, status):
+        level = self._opts.telemetry
+        if level == telemetry.OFF:
+            return
+        if level == telemetry.SUMMARY:
+            if status == 'start':
+                self._count('blocks')
+            return
 
-    def _evaluate(self, node, state):
-        ''' Evaluates a node. '''
-        node_type = node['token']['type']
-        node_value = node['token']['value']
-        if node_type == 'Text':
-            return str(node_value)
-        elif node_type == 'Constant':
-            return str(node_value)
-        elif node_type == 'Number':
-            return float(node_value)
-        elif node_type == 'Boolean':
-            return node_value == 'TRUE'
-        elif node_type == 'Identifier':
-            return self._execute([node], state)
-        elif node_type == 'Variable':
-            return self._get_variable(node_value)
-        elif node_type == 'Colour':
-            return '#' + str(node_value)
+        if debug_id is None:
+            _log.debug('Unable to find sourceId, skipping send debug')
+            return
 
-        logger.log('[Engine] Unknown expression type: ' + node_type)
+        _log.debug('Recording debug info for block %s [%s]', debug_id, status)
+        self._telemetry.record(debug_id, status, func_name)
 
-    def _get_variable(self, name):
-        logger.log('[Engine] Retrieving variable ' + name)
+    def _count(self, name):
+        ''' Increases one of the summary counters. '''
+        self._state_lock.acquire()
         try:
-            return self._variables[name]
-        except KeyError:
-            self._error('Unknown variable ' + name)
+            if name in self._summary:
+                self._summary[name] += 1
+        finally:
+            self._state_lock.release()
+
+    def _read_variable(self, slot):
+        value = self._variables[slot]
+        if value is _UNDEFINED:
+            self._unknown_variable(slot)
+            return None
+        return value
+
+    def _unknown_variable(self, slot):
+        ''' Reports an unknown variable, unless it has already been reported in this run. '''
+        self._state_lock.acquire()
+        try:
+            is_new = slot not in self._reported
+            self._reported.add(slot)
+        finally:
+            self._state_lock.release()
+        if is_new:
+            self._error('Unknown variable ' + self._variable_names[slot])
+
+    def _argument_slot(self, state):
+        ''' Retrieves the slot for the variable in the first argument. '''
+        try:
+            return state.args[0].slot
+        except AttributeError:
+            return self._variable_slot(state.ast['arguments'][0]['token']['value'])
 
     def _reset(self, state):
         ''' Resets the execution engine. '''
-        logger.log('[Engine] Resetting engine')
-        self._variables = {}
+        _log.debug('Resetting engine')
+        self._variables = [_UNDEFINED] * len(self._variable_names)
+        self._reported = set(self._download_problems)
         self._blocks = {}
         self._last_function = None
-        self._functions = {
+        self._functions = dict(self._builtins)
+
+    def _build_functions(self):
+        ''' Builds the dispatch table for the built-in functions: this is only done once, each run starts with a copy. '''
+        functions = {
             # Top level functions
             'reset': EngineFunction(self._reset, True),
             'start': EngineFunction(self._generate_register_block('start'), True),
@@ -238,72 +900,54 @@ class Engine(object):
 
             # Robot functions
             'wave': EngineFunction(self._wave),
-            'dance': EngineFunction(self._dance),
-            'look': EngineFunction(self._look),
-            'point': EngineFunction(self._point),
-            'say': EngineFunction(self._say),
+            'dance': EngineFunction(self._dance, arguments=2),
+            'look': EngineFunction(self._look, arguments=1),
+            'point': EngineFunction(self._point, arguments=2),
+            'say': EngineFunction(self._say, arguments=1),
             'rest': EngineFunction(self._rest),
-            'wait': EngineFunction(self._wait),
-            'walk': EngineFunction(self._walk),
+            'wait': EngineFunction(self._wait, arguments=1),
+            'walk': EngineFunction(self._walk, arguments=2),
             'stop': EngineFunction(self._stop),
-            'turn': EngineFunction(self._turn),
+            'turn': EngineFunction(self._turn, arguments=1),
             'randomColour': EngineFunction(self._random_colour),
-            'position': EngineFunction(self._position),
+            'position': EngineFunction(self._position, arguments=1),
             'wipe_forehead': EngineFunction(self._wipe_forehead),
-            'changeLEDColour': EngineFunction(self._change_LED),
-            'changeHand': EngineFunction(self._change_hand),
-            'readSensor': EngineFunction(self._read_sensor),
+            'changeLEDColour': EngineFunction(self._change_LED, arguments=2),
+            'changeHand': EngineFunction(self._change_hand, arguments=2),
+            'readSensor': EngineFunction(self._read_sensor, arguments=1),
             'lastRecognisedWord': EngineFunction(self._last_recognised_word),
 
             # Programming functions
-            'loop': EngineFunction(self._loop),
-            'while': EngineFunction(self._while),
-            'variable': EngineFunction(self._define_variable),
-            'function': EngineFunction(self._define_function),
-            'addTo':  EngineFunction(self._add_to_variable),
-            'if': EngineFunction(self._check_if_condition),
-            'elseif': EngineFunction(self._check_if_condition),
+            'loop': EngineFunction(self._loop, arguments=1),
+            'while': EngineFunction(self._while, arguments=1),
+            'variable': EngineFunction(self._define_variable, arguments=2),
+            'function': EngineFunction(self._define_function, arguments=1),
+            'addTo':  EngineFunction(self._add_to_variable, arguments=2),
+            'if': EngineFunction(self._check_if_condition, arguments=1),
+            'elseif': EngineFunction(self._check_if_condition, arguments=1),
             'else': EngineFunction(self._check_else),
-            'not': EngineFunction(self._invert),
-            'equal': EngineFunction(self._check_if_equal),
-            'lessThan': EngineFunction(self._check_less_than),
-            'greaterThan': EngineFunction(self._check_greater_than),
-            'notEqual': EngineFunction(self._check_not_equal),
-            'lessThanEqual': EngineFunction(self._check_less_than_equal),
-            'greaterThanEqual': EngineFunction(self._check_greater_than_equal),
-            'round': EngineFunction(self._round),
-
-            # Behaviour functions
-             'arabasque':EngineFunction(self._generate_behaviour('Arabasque', Movements.ARABESQUE)),
-            'plie': EngineFunction(self._generate_behaviour('Plie', Movements.PLIE)),
-            'single': EngineFunction(self._generate_behaviour('Single', Movements.SINGLE)),
-            'arabasqueRight': EngineFunction(self._generate_behaviour('ArabasqueRight', Movements.ARABESQUERIGHT)),
-            'fly': EngineFunction(self._generate_behaviour('Fly', Movements.FLY)),
-            'ballet3': EngineFunction(self._generate_behaviour('Ballet3', Movements.BALLET3)),
-            'ballet2': EngineFunction(self._generate_behaviour('Ballet2', Movements.BALLET2)),
-            'ballet1': EngineFunction(self._generate_behaviour('Ballet1', Movements.BALLET1)),
-            'enavont': EngineFunction(self._generate_behaviour('enavont', Movements.ENAVONT)),
-            'up': EngineFunction(self._generate_behaviour('up', Movements.UP)),
-            'rest': EngineFunction(self._generate_behaviour('rest', Movements.REST)),
-            'leftArmOut': EngineFunction(self._generate_behaviour('leftArmOut', Movements.LEFT_ARM_OUT)),
-            'rightArmOut': EngineFunction(self._generate_behaviour('rightArmOut', Movements.RIGHT_ARM_OUT)),
         }
+        functions.update(OPERATORS)
+        for name, label, behaviour in _BEHAVIOURS:
+            functions[name] = EngineFunction(self._generate_behaviour(label, behaviour))
+        return functions
 
     def _generate_register_block(self, block_name):
         ''' Generates a closure to register block. '''
         def _register_block(state):
             ''' Registers the on start block. '''
-            logger.log('[Engine] Registering ' + block_name + ' block')
-            self._blocks[block_name] = state.ast
+            _log.debug('Registering %s block', block_name)
+            self._blocks[block_name] = state.body
         return _register_block
 
     def _generate_behaviour(self, behaviour_name, behaviour_id):
         ''' Generates a closure for behaviour only functions. '''
         def _execute_behaviour(state):
             ''' Executes a behaviour and waits for it to complete. '''
-            logger.log('[Engine] Performing behaviour "' + behaviour_name + '"')
-            self._robot.startBehaviour(behaviour_id)
-            self._robot.wait()
+            _log.debug('Performing behaviour "%s"', behaviour_name)
+            self._claim(ALL_RESOURCES)
+            self._start_behaviour(behaviour_id)
+            self._settle()
         return _execute_behaviour
 
     def _generate_execute_block(self, block_name):
@@ -313,145 +957,190 @@ class Engine(object):
             try:
                 block = self._blocks[block_name]
             except KeyError:
-                logger.log('[Engine] ' + block_name + \
-                    ' block not registered, skipping')
+                _log.info('%s block not registered, skipping', block_name)
                 return
 
-            logger.log('[Engine] Executing ' + block_name + ' block')
-            with self._initialise_robot(self._ip) as robot:
+            _log.info('Executing %s block', block_name)
+            robot = self._prepared_robot or self._initialise_robot(self._ip)
+            self._prepared_robot = None
+            with robot:
                 self._robot = robot
-                self._execute(block['children'], None)
+                block(None)
+                self._wait_for_robot(robot)
                 robot.rest()
                 self._robot = None
-            logger.log('[Engine] ' + block_name + ' block completed')
+            _log.info('%s block completed', block_name)
 
         return _execute_block
 
     def _initialise_robot(self, ip):
-        logger.log('[Engine] Initialising robot')
+        _log.debug('Initialising robot')
+        robot = self._create_robot(ip)
+        if self._recorder is not None:
+            robot = recording.RecordingRobot(robot, self._recorder)
+        return robot
+
+    def _create_robot(self, ip):
+        if self._clock is not None:
+            return SimulatedRobot(self._clock)
         if self._use_robot:
-            r = Robot(ip)
-            return r
+            return Robot(ip)
         return RobotMock()
 
+    def _now(self):
+        ''' Retrieves the current time, from the virtual clock when simulating. '''
+        return time.time() if self._clock is None else self._clock.time()
+
     def _wave(self, state):
         ''' Make the robot wave. '''
-        logger.log('[Engine] Waving')
-        movement = BodyMovement().wave()
+        _log.debug('Waving')
+        movement = self._movement('wave')
         self._perform_movement(state, movement, 'wave', require_standing = False)
 
     def _look(self, state):
         ''' Make the robot look in a direction. '''
-        direction = self._evaluate(state.ast['arguments'][0], state)
-        logger.log('[Engine] Looking ' + direction)
-        movement = HeadMovement()
-        if direction == 'left':
-            movement = movement.lookLeft()
-        elif direction == 'right':
-            movement = movement.lookRight()
-        elif direction == 'ahead':
-            movement = movement.lookAhead()
+        direction = state.argument(0)
+        _log.debug('Looking %s', direction)
+        movement = self._movement('look', direction)
         self._perform_movement(state, movement, 'look', 1, require_standing = False)
 
     def _point(self, state):
         ''' Make the robot point in a direction. '''
-        arm = self._evaluate(state.ast['arguments'][0], state)
-        direction = self._evaluate(state.ast['arguments'][1], state)
-        logger.log('[Engine] Pointing ' + arm + ' arm ' + direction)
-        movement = ArmMovement(ArmMovement.LEFT if arm ==
-                               'left' else ArmMovement.RIGHT)
-        if direction == 'out':
-            movement = movement.pointOut()
-        elif direction == 'down':
-            movement = movement.pointDown()
-        elif direction == 'up':
-            movement = movement.pointUp()
-        elif direction == 'ahead':
-            movement = movement.pointAhead()
+        arm = state.argument(0)
+        direction = state.argument(1)
+        _log.debug('Pointing %s arm %s', arm, direction)
+        movement = self._movement('point', arm, direction)
         self._perform_movement(state, movement, 'look', 2, require_standing = False)
 
+    def _movement(self, name, *args):
+        ''' Retrieves a movement, building it the first time it is used. '''
+        key = (name,) + args
+        try:
+            return self._movements[key]
+        except KeyError:
+            builder, _ = _MOVEMENTS[name]
+            movement = builder(*args)
+            self._movements[key] = movement
+            return movement
+
+    def _start_behaviour(self, behaviour_id):
+        ''' Starts a behaviour, skipping the installed check if it was preloaded. '''
+        if behaviour_id in self._preloaded:
+            self._robot.startBehaviour(behaviour_id, skipCheck=True)
+        else:
+            self._robot.startBehaviour(behaviour_id)
+
+    def _claim(self, resources):
+        ''' Waits for any running actions that use the resources, when actions are pipelined.
+
+Without pipelining every action has finished before the next one starts, so there is nothing to wait for.
+The time blocked is recorded when profiling, the same as waiting for the robot. '''
+        if not self._opts.pipeline:
+            return
+        profiler = self._profiler
+        if profiler is None:
+            self._robot.claim(resources)
+            return
+        start = time.time()
+        self._robot.claim(resources)
+        profiler.waited(time.time() - start)
+
+    def _settle(self):
+        ''' Waits for the current action to finish, unless actions are pipelined. '''
+        if not self._opts.pipeline:
+            self._wait_for_robot(self._robot)
+
+    def _wait_for_robot(self, robot):
+        ''' Waits for the robot to finish its actions, recording the time blocked when profiling. '''
+        profiler = self._profiler
+        if profiler is None:
+            robot.wait()
+            return
+        start = time.time()
+        robot.wait()
+        profiler.waited(time.time() - start)
+
     def _perform_movement(self, state, movement, name, speech=0, require_standing=True):
+        resources = _joint_resources(movement.names())
+        self._claim(resources)
         if require_standing:
             posture = self._robot.getPosture()
             if posture != 'Standing' and posture != 'Sitting':
-                logger.log('[Engine] Unable to ' + name + ' in the current position')
+                _log.info('Unable to %s in the current position', name)
                 self._robot.say('I cannot ' + name + ' in this position')
                 return
 
         try:
-            speech = self._evaluate(state.ast['arguments'][speech], state)
+            speech = state.argument(speech)
+            self._claim(resources | set([VOICE]))
             self._robot.say(speech)
         except KeyError:
-            logger.log('[Engine] No text to speak, skipping')
+            _log.debug('No text to speak, skipping')
             pass
         except IndexError:
-            logger.log('[Engine] No text to speak, skipping')
+            _log.debug('No text to speak, skipping')
             pass
         except TypeError:
-            logger.log('[Engine] No text to speak, skipping')
+            _log.debug('No text to speak, skipping')
             pass
 
-        self._robot.performMovements(movement).wait()
+        self._robot.performMovements(movement)
+        self._settle()
 
     def _dance(self, state):
         ''' Make the robot dance. '''
+        self._claim(ALL_RESOURCES)
         posture = self._robot.getPosture()
         if posture != 'Standing':
             self._robot.say('I cannot dance in this posture')
             return
 
-        dance = self._evaluate(state.ast['arguments'][0], state)
-        music = self._evaluate(state.ast['arguments'][1], state)
-        dances = {
-            'macaranna': Dances.MACARENA,
-            'gangnam': Dances.GANGNAM,
-            'taichi': Dances.TAICHI
-        }
+        dance = state.argument(0)
+        music = state.argument(1)
         if not music:
             self._robot.muteAudioVolume()
         try:
-            logger.log('[Engine] Performing dance ' + dance)
-            self._robot.startBehaviour(dances[dance])
-            self._robot.wait()
+            _log.debug('Performing dance %s', dance)
+            self._start_behaviour(_DANCES[dance])
+            self._wait_for_robot(self._robot)
         except KeyError:
-            logger.log('[Engine] Unknown dance ' + dance)
+            _log.warning('Unknown dance %s', dance)
 
         if not music:
             self._robot.restoreAudioVolume()
 
     def _rest(self, state):
         ''' Make the robot rest. '''
-        logger.log('[Engine] Resting')
+        _log.debug('Resting')
+        self._claim(ALL_RESOURCES)
         self._robot.rest()
 
     def _wait(self, state):
         ''' Make the robot wait. '''
-        seconds = self._evaluate(state.ast['arguments'][0], state)
-        logger.log('[Engine] Waiting for ' + str(seconds) + 's')
-        for _ in range(0, int(seconds)):
-            if self.is_cancelled:
-                break
-            time.sleep(1)
+        seconds = state.argument(0)
+        _log.debug('Waiting for %ss', seconds)
+        self._cancellation.wait(float(seconds))
 
     def _walk(self, state):
         ''' Make the robot walk. '''
+        self._claim(ALL_RESOURCES)
         posture = self._robot.getPosture()
         if posture != 'Standing':
             self._robot.say('I cannot walk in this posture')
             return
 
         self._robot.setSonars(True)
-        xDist = self._evaluate(state.ast['arguments'][0], state)
-        yDist = self._evaluate(state.ast['arguments'][1], state)
-        self._leftFoot = self._robot.getSensor(sensors.Sensor.FOOT_LEFT)
-        self._rightFoot = self._robot.getSensor(sensors.Sensor.FOOT_RIGHT)
-        self._leftSonar = self._robot.getSensor(sensors.Sensor.SONAR_LEFT)
-        self._rightSonar = self._robot.getSensor(sensors.Sensor.SONAR_RIGHT)
-
-        logger.log('[Engine] Walking forwards ' + \
-            str(xDist) + 's, sideways ' + str(yDist) + 's')
-        x_time = abs(int(xDist))
-        y_time = abs(int(yDist))
+        xDist = state.argument(0)
+        yDist = state.argument(1)
+        # The sensors are only used by this walk, as a handler can be walking at the same time
+        walk_sensors = (self._robot.getSensor(sensors.Sensor.FOOT_LEFT),
+                        self._robot.getSensor(sensors.Sensor.FOOT_RIGHT),
+                        self._robot.getSensor(sensors.Sensor.SONAR_LEFT),
+                        self._robot.getSensor(sensors.Sensor.SONAR_RIGHT))
+
+        _log.debug('Walking forwards %ss, sideways %ss', xDist, yDist)
+        x_time = abs(float(xDist))
+        y_time = abs(float(yDist))
         direction = Engine.BACK
         if xDist == 0:
             x_dir = 0
@@ -470,50 +1159,51 @@ class Engine(object):
             direction = Engine.LEFT
         time_1 = min(x_time, y_time)
         time_2 = max(x_time, y_time) - time_1
-        self._is_walking = True
         self._robot.walkStart(x_dir, y_dir, 0)
-        for _ in range(0, time_1):
-            if self.is_cancelled or self._is_blocked(direction):
-                break
-            time.sleep(1)
+        self._walk_for(time_1, direction, walk_sensors)
         if x_time > y_time:
             y_dir = 0
         if x_time < y_time:
             x_dir = 0
         self._robot.walkStart(x_dir, y_dir, 0)
-        walk_cancelled = False
-        for _ in range(0, time_2):
-            if self.is_cancelled or self._is_blocked(direction):
-                walk_cancelled = True
-                break
-            time.sleep(1)
+        walk_cancelled = self._walk_for(time_2, direction, walk_sensors)
         if not walk_cancelled:
-            logger.log('[Engine] Stopping walk due to time expired')
+            _log.debug('Stopping walk due to time expired')
         self._robot.walkStop()
-        self._is_walking = False
         self._robot.setSonars(False)
 
-    def _is_blocked(self, direction):
-        ''' Checks if there are any obstacles. '''
-        left_foot = self._leftFoot.read()
-        right_foot = self._rightFoot.read()
-        logger.log('[Engine] Foot buttons (%s,%s)', left_foot, right_foot)
+    def _walk_for(self, seconds, direction, walk_sensors):
+        ''' Keeps walking for a number of seconds. Returns True if the walk was cancelled or blocked. '''
+        end_time = self._now() + seconds
+        while True:
+            remaining = end_time - self._now()
+            if remaining <= 0:
+                return False
+            if self._is_blocked(direction, walk_sensors) or self._cancellation.wait(min(remaining, Engine.WALK_CHECK_INTERVAL)):
+                return True
+
+    def _is_blocked(self, direction, walk_sensors):
+        ''' Checks if there are any obstacles, using the foot and sonar sensors for the walk. '''
+        left_foot_sensor, right_foot_sensor, left_sonar, right_sonar = walk_sensors
+        left_foot = left_foot_sensor.read()
+        right_foot = right_foot_sensor.read()
+        _log.debug('Foot buttons (%s,%s)', left_foot, right_foot)
         if (left_foot or right_foot):
-            logger.log('[Engine] Stopping walk due to foot buttons')
+            _log.info('Stopping walk due to foot buttons')
             return True
 
         if direction & Engine.LEFT:
-            dist = self._leftSonar.read()
-            logger.log('[Engine] Left distance is %f', dist)
+            dist = left_sonar.read()
+            _log.debug('Left distance is %f', dist)
             if dist < 0.25:
-                logger.log('[Engine] Stopping walk due to left sonar')
+                _log.info('Stopping walk due to left sonar')
                 return True
 
         if direction & Engine.RIGHT:
-            dist = self._rightSonar.read()
-            logger.log('[Engine] Right distance is %f', dist)
+            dist = right_sonar.read()
+            _log.debug('Right distance is %f', dist)
             if dist < 0.25:
-                logger.log('[Engine] Stopping walk due to right sonar')
+                _log.info('Stopping walk due to right sonar')
                 return True
 
         return False
@@ -521,34 +1211,34 @@ class Engine(object):
     def _stop(self, state):
         ''' Make the robot stop. '''
         self._robot.walkStop()
-        self._is_walking = False
         self._robot.setSonars(False)
 
     def _turn(self, state):
         ''' Make the robot turn. '''
+        self._claim(ALL_RESOURCES)
         posture = self._robot.getPosture()
         if posture != 'Standing':
             self._robot.say('I cannot turn in this posture')
             return
 
-        degs = float(self._evaluate(state.ast['arguments'][0], state))
+        degs = float(state.argument(0))
         if degs > 360:
             degs = 360
         elif degs < -360:
             degs = -360
-        logger.log('[Engine] Turning ' + \
-            str(degs) + ' degrees [' + str(degs) + ' degrees]')
-        self._robot.walkTo(0, 0, degs).wait()
+        _log.debug('Turning %s degrees', degs)
+        self._robot.walkTo(0, 0, degs)
+        self._settle()
 
     def _wipe_forehead(self, state):
         ''' Make the robot wipe forehead. '''
-        logger.log('[Engine] Wiping forehead')
-        movement = BodyMovement().wipeForehead()
+        _log.debug('Wiping forehead')
+        movement = self._movement('wipe_forehead')
         self._perform_movement(state, movement, 'wipe forehead', require_standing = False)
 
     def _say(self, state):
         ''' Make the robot speak. '''
-        value = self._evaluate(state.ast['arguments'][0], state)
+        value = state.argument(0)
         text_to_say = str(value)
         try:
             number_value = float(value)
@@ -556,23 +1246,27 @@ class Engine(object):
                 text_to_say = '{:.0f}'.format(number_value)
         except:
             pass
-        logger.log('[Engine] Saying "' + text_to_say + '"')
-        self._robot.say(text_to_say).wait()
+        _log.debug('Saying "%s"', text_to_say)
+        self._claim(set([VOICE]))
+        self._robot.say(text_to_say)
+        self._settle()
 
     def _position(self, state):
         ''' Make the robot move to a position. '''
-        value = self._evaluate(state.ast['arguments'][0], state)
-        logger.log('[Engine] Moving to position ' + value)
+        value = state.argument(0)
+        _log.debug('Moving to position %s', value)
+        self._claim(ALL_RESOURCES)
         try:
-            speech = self._evaluate(state.ast['arguments'][1], state)
+            speech = state.argument(1)
             self._robot.say(speech)
         except (KeyError, IndexError):
             pass
-        self._robot.goToPosture(value).wait()
+        self._robot.goToPosture(value)
+        self._settle()
 
     def _change_LED(self, state):
         ''' Change an LED. '''
-        item = self._evaluate(state.ast['arguments'][0], state)
+        item = state.argument(0)
         items = {
             'CHEST': Robot.CHEST,
             'BOTH_EYES': [Robot.RIGHT_EYE, Robot.LEFT_EYE],
@@ -585,30 +1279,36 @@ class Engine(object):
             self._error('Unknown LED ' + item)
             return
 
-        value = self._evaluate(state.ast['arguments'][1], state)
-        logger.log('[Engine] Changing LED ' + str(item) + ' to ' + value)
+        value = state.argument(1)
+        _log.debug('Changing LED %s to %s', item, value)
+        self._claim(set([LEDS]))
         self._robot.setLEDColour(led, value)
 
     def _change_hand(self, state):
         ''' Make the robot open or close one or two hands. '''
         hand = [Robot.LEFT_HAND]
+        resources = set([LEFT_ARM])
         text = ' left hand'
-        handArg = self._evaluate(state.ast['arguments'][1], state)
-        actionArg = self._evaluate(state.ast['arguments'][0], state)
+        handArg = state.argument(1)
+        actionArg = state.argument(0)
         if handArg == 'right':
             hand = [Robot.RIGHT_HAND]
+            resources = set([RIGHT_ARM])
             text = ' right hand'
         elif handArg == 'both':
             hand = [Robot.RIGHT_HAND, Robot.LEFT_HAND]
+            resources = set([LEFT_ARM, RIGHT_ARM])
             text = ' both hands'
 
-        logger.log('[Engine] Changing ' + text)
-        self._robot.moveHands(hand, actionArg == 'open').wait()
+        _log.debug('Changing%s', text)
+        self._claim(resources)
+        self._robot.moveHands(hand, actionArg == 'open')
+        self._settle()
 
     def _read_sensor(self, state):
         ''' Reads a robot sensor. '''
-        sensor = self._evaluate(state.ast['arguments'][0], state)
-        logger.log('[Engine] Reading ' + sensor + ' sensor')
+        sensor = state.argument(0)
+        _log.debug('Reading %s sensor', sensor)
         try:
             sensor = self._robot.getSensor(sensor)
             value = sensor.read()
@@ -620,34 +1320,37 @@ class Engine(object):
 
     def _last_recognised_word(self, state):
         ''' Retrieves the last recognised word. '''
-        logger.log('[Engine] Retrieving last recognised word (' + \
-            self._last_word + ')')
+        _log.debug('Retrieving last recognised word (%s)', self._last_word)
         return self._last_word
 
     def _loop(self, state):
         ''' Define or update a variable. '''
-        iterations = int(self._evaluate(state.ast['arguments'][0], state))
-        logger.log('[Engine] Starting loop with ' + str(iterations) + ' iterations')
+        iterations = int(state.argument(0))
+        _log.debug('Starting loop with %d iterations', iterations)
         for loop in range(iterations):
             self._change_state('loop', loop)
-            logger.log('[Engine] Executing iteration ' + str(loop))
-            self._execute(state.ast['children'], state)
+            _log.debug('Executing iteration %d', loop)
+            state.body(state)
             if self.is_cancelled:
                 break
-        logger.log('[Engine] Loop completed')
+        _log.debug('Loop completed')
 
     def _define_variable(self, state):
         ''' Define or update a variable. '''
-        name = state.ast['arguments'][0]['token']['value']
-        value = self._evaluate(state.ast['arguments'][1], state)
-        logger.log('[Engine] Setting variable ' + name + ' to ' + str(value))
-        self._variables[name] = value
+        slot = self._argument_slot(state)
+        value = state.argument(1)
+        name = self._variable_names[slot]
+        _log.debug('Setting variable %s to %s', name, value)
+        self._variables[slot] = value
         self._change_state(name, value)
 
     def _define_function(self, state):
         ''' Define a new function. This function will not allow replacing existing functions (as this could be dangerous!) '''
         name = state.ast['arguments'][0]['token']['value']
+        self._add_function(name, state.body)
 
+    def _add_function(self, name, body):
+        ''' Adds a custom function to the functions table. Returns the new function, or None if the name is already in use. '''
         try:
             func = self._functions[name]
             if func is None:
@@ -655,124 +1358,81 @@ class Engine(object):
                 raise KeyError()
 
             self._error('Function ' + name + ' already exists - cannot add')
+            return None
         except KeyError:
-            # Add a wrapper around the AST and add it to the functions table
-            logger.log('[Engine] Defining new function ' + name)
-            try:
-                children = state.ast['children']
-            except KeyError:
-                # This doesn't make sense, but allow for functions with no children (an empty function)
-                children = []
-            self._functions[name] = EngineFunction(self._execute_custom_function(name, children))
+            # Add a wrapper around the body and add it to the functions table
+            _log.debug('Defining new function %s', name)
+            func = EngineFunction(self._execute_custom_function(name, body))
+            self._functions[name] = func
+            return func
 
-    def _execute_custom_function(self, name, ast):
+    def _execute_custom_function(self, name, body):
         ''' Generates a closure to execute a custom function. '''
         def _execute_function(state):
             ''' Executes each AST block in the function definition. '''
-            logger.log('[Engine] Executing custom function "' + name + '"')
-            self._execute(ast, state)
-            logger.log('[Engine] Custom function "' + name + '" completed')
+            _log.debug('Executing custom function "%s"', name)
+            local = self._local
+            self._check_depth(local.depth)
+            local.depth += 1
+            try:
+                body(state)
+            finally:
+                local.depth -= 1
+            _log.debug('Custom function "%s" completed', name)
 
         return _execute_function
 
+    def _check_depth(self, depth):
+        ''' Stops the program if it has reached the depth limit. '''
+        if depth >= self._opts.max_depth:
+            raise DepthLimitError(self._opts.max_depth)
+
     def _add_to_variable(self, state):
         ''' Increases a variable. '''
-        name = state.ast['arguments'][0]['token']['value']
-        value = self._evaluate(state.ast['arguments'][1], state)
+        self._increase_variable(self._argument_slot(state), state.argument(1))
+
+    def _increase_variable(self, slot, value):
+        ''' Increases the variable in a slot. '''
+        self._state_lock.acquire()
         try:
-            current = self._variables[name]
-            new_value = (current + value)
-            logger.log('[Engine] Increasing variable ' + name + ' by ' + \
-                str(value) + ' from ' + str(current) + ' to ' + str(new_value))
-            self._variables[name] = new_value
-            self._change_state(name, new_value)
-        except KeyError:
-            self._error('Unknown variable ' + name)
-
-    def _invert(self, state):
-        ''' Inverts a value. '''
-        value = self._evaluate(state.ast['arguments'][0], state)
-        logger.log('[Engine] Inverting: ' + str(value))
-        return not value
-
-    def _round(self, state):
-        ''' Rounds a value. '''
-        value = self._evaluate(state.ast['arguments'][0], state)
-        logger.log('[Engine] Rounding: ' + str(value))
-        return round(value, 0)
-
-    def _check_if_equal(self, state):
-        ''' Checks if the two sides are equal. '''
-        value1 = self._evaluate(state.ast['arguments'][0], state)
-        value2 = self._evaluate(state.ast['arguments'][1], state)
-        logger.log('[Engine] Checking for equality: ' + \
-            str(value1) + ' and ' + str(value2))
-        return value1 == value2
-
-    def _check_less_than(self, state):
-        ''' Checks if the two sides are equal. '''
-        value1 = self._evaluate(state.ast['arguments'][0], state)
-        value2 = self._evaluate(state.ast['arguments'][1], state)
-        logger.log('[Engine] Checking for equality: ' + \
-            str(value1) + ' and ' + str(value2))
-        return value1 < value2
-
-    def _check_greater_than(self, state):
-        ''' Checks if the two sides are equal. '''
-        value1 = self._evaluate(state.ast['arguments'][0], state)
-        value2 = self._evaluate(state.ast['arguments'][1], state)
-        logger.log('[Engine] Checking for equality: ' + \
-            str(value1) + ' and ' + str(value2))
-        return value1 > value2
-
-    def _check_not_equal(self, state):
-        ''' Checks if the two sides are equal. '''
-        value1 = self._evaluate(state.ast['arguments'][0], state)
-        value2 = self._evaluate(state.ast['arguments'][1], state)
-        logger.log('[Engine] Checking for equality: ' + \
-            str(value1) + ' and ' + str(value2))
-        return value1 != value2
-
-    def _check_less_than_equal(self, state):
-        ''' Checks if the two sides are equal. '''
-        value1 = self._evaluate(state.ast['arguments'][0], state)
-        value2 = self._evaluate(state.ast['arguments'][1], state)
-        logger.log('[Engine] Checking for equality: ' + \
-            str(value1) + ' and ' + str(value2))
-        return value1 <= value2
-
-    def _check_greater_than_equal(self, state):
-        ''' Checks if the two sides are equal. '''
-        value1 = self._evaluate(state.ast['arguments'][0], state)
-        value2 = self._evaluate(state.ast['arguments'][1], state)
-        logger.log('[Engine] Checking for equality: ' + \
-            str(value1) + ' and ' + str(value2))
-        return value1 >= value2
+            current = self._variables[slot]
+            if current is not _UNDEFINED:
+                new_value = (current + value)
+                self._variables[slot] = new_value
+        finally:
+            self._state_lock.release()
+        if current is _UNDEFINED:
+            self._unknown_variable(slot)
+            return
+
+        name = self._variable_names[slot]
+        _log.debug('Increasing variable %s by %s from %s to %s', name, value, current, new_value)
+        self._change_state(name, new_value)
 
     def _check_if_condition(self, state):
         ''' Check a condition block. '''
-        result = self._evaluate(state.ast['arguments'][0], state)
+        result = state.argument(0)
         if result is True:
             state.complete()
-            logger.log('[Engine] Executing if block')
-            self._execute(state.ast['children'], state)
+            _log.debug('Executing if block')
+            state.body(state)
 
     def _while(self, state):
         ''' Check a condition block. '''
-        logger.log('[Engine] Executing while block')
-        result = self._evaluate(state.ast['arguments'][0], state)
+        _log.debug('Executing while block')
+        result = state.argument(0)
         while result is True:
-            logger.log('[Engine] Starting loop')
+            _log.debug('Starting loop')
             state.complete()
-            logger.log('[Engine] Executing if block')
-            self._execute(state.ast['children'], state)
-            result = self._evaluate(state.ast['arguments'][0], state)
-            logger.log('[Engine] Finished loop')
+            _log.debug('Executing if block')
+            state.body(state)
+            result = state.argument(0)
+            _log.debug('Finished loop')
 
     def _check_else(self, state):
         ''' Check a else block. '''
-        logger.log('[Engine] Executing else block')
-        self._execute(state.ast['children'], state)
+        _log.debug('Executing else block')
+        state.body(state)
 
     def _random_colour(self, state):
         ''' Returns a random colour. '''
@@ -1,2 +1,100 @@
+''' Provides logging for the robot client.
+
+Each subsystem (e.g. Engine, Comms) has its own logger, and the level can be set globally or per
+subsystem. Messages use %-formatting, which is only done if the level is enabled, so a disabled
+message costs a single level check. '''
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+NONE = 100
+
+LEVELS = {
+    'debug': DEBUG,
+    'info': INFO,
+    'warning': WARNING,
+    'error': ERROR,
+    'none': NONE,
+}
+
+_default_level = INFO
+_subsystem_levels = {}
+_loggers = {}
+
+
+class Logger(object):
+    ''' Writes the log messages for a subsystem. '''
+
+    def __init__(self, name, label=None):
+        self.name = name
+        self.prefix = '[' + (name if label is None else label) + '] '
+        self.level = _subsystem_levels.get(name, _default_level)
+
+    def is_enabled(self, level):
+        ''' Checks whether messages at a level will be written. '''
+        return self.level <= level
+
+    def debug(self, message, *args):
+        if self.level <= DEBUG:
+            _write(self.prefix, message, args)
+
+    def info(self, message, *args):
+        if self.level <= INFO:
+            _write(self.prefix, message, args)
+
+    def warning(self, message, *args):
+        if self.level <= WARNING:
+            _write(self.prefix, message, args)
+
+    def error(self, message, *args):
+        if self.level <= ERROR:
+            _write(self.prefix, message, args)
+
+
+def _write(prefix, message, args):
+    print(prefix + (message % args if args else message))
+
+
+def get_logger(name, label=None):
+    ''' Retrieves the logger for a subsystem. The label is used instead of the name in the output. '''
+    key = (name, label)
+    try:
+        return _loggers[key]
+    except KeyError:
+        instance = Logger(name, label)
+        _loggers[key] = instance
+        return instance
+
+
+def configure(level=None, subsystems=None):
+    ''' Sets the default level and the per subsystem levels. '''
+    global _default_level, _subsystem_levels
+    if level is not None:
+        _default_level = level
+    if subsystems is not None:
+        _subsystem_levels = dict(subsystems)
+    for instance in _loggers.values():
+        instance.level = _subsystem_levels.get(instance.name, _default_level)
+
+
+def parse_level(text):
+    ''' Converts a level name (e.g. debug) into a level. '''
+    return LEVELS[text.strip().lower()]
+
+
+def parse_subsystems(text):
+    ''' Converts a list of subsystem levels (e.g. Engine=debug,Comms=warning) into a dictionary. '''
+    subsystems = {}
+    for item in (text or '').split(','):
+        if item.strip() == '':
+            continue
+        name, level = item.split('=', 1)
+        subsystems[name.strip()] = parse_level(level)
+    return subsystems
+
+
 def log(message, *args):
-    print(message % args)
+    ''' Writes a message without a subsystem. '''
+    if _default_level <= INFO:
+        _write('', message, args)
@@ -16,6 +16,9 @@ from noRobot import RobotMock
 from communications import Communications
 import logger
 
+_log = logger.get_logger('Main')
+_module_log = logger.get_logger('Module')
+
 try:
     from naoqi import ALBroker, ALModule, ALProxy
     from robot import Robot
@@ -55,44 +58,44 @@ class NaoRemoteModule(ALModule):
                                 "NaoRemote", "onChestButtonDetected")
         memory.subscribeToEvent("notificationAdded", 
                                 "NaoRemote", "onNotificationAdded")
-        logger.log('[Module] Subscribed to all events')
+        _module_log.info('Subscribed to all events')
 
     def _unregisterEvents(self):
         memory.unsubscribeToEvent("MiddleTactilTouched", "NaoRemote")
         memory.unsubscribeToEvent("FrontTactilTouched", "NaoRemote")
         memory.unsubscribeToEvent("RearTactilTouched", "NaoRemote")
         memory.unsubscribeToEvent("ChestButtonPressed", "NaoRemote")
-        logger.log('[Module] Unsubscribed from all events')
+        _module_log.debug('Unsubscribed from all events')
 
     def onNotificationAdded(self, type, id):
         """ This will be called when a notification is added. """
-        logger.log('[Module] Notification added')
+        _module_log.info('Notification added')
         self._comms.broadcastEvent(id)
 
     def onMiddleTouchDetected(self, *args):
         """ This will be called each time the middle head button is pushed. """
-        logger.log('[Module] Middle head tactile touched')
+        _module_log.debug('Middle head tactile touched')
         self._unregisterEvents()
         self._comms.trigger('middle')
         self._registerEvents()
 
     def onChestButtonDetected(self, *args):
         """ This will be called each time the middle head button is pushed. """
-        logger.log('[Module] Chest button pressed')
+        _module_log.debug('Chest button pressed')
         self._unregisterEvents()
         self._comms.trigger('chest')
         self._registerEvents()
 
     def onFrontTouchDetected(self, *args):
         """ This will be called each time the front head button is pushed. """
-        logger.log('[Module] Front head tactile touched')
+        _module_log.debug('Front head tactile touched')
         self._unregisterEvents()
         self._comms.trigger('front')
         self._registerEvents()
 
     def onRearTouchDetected(self, *args):
         """ This will be called each time the rear head button is pushed. """
-        logger.log('[Module] Rear head tactile touched')
+        _module_log.debug('Rear head tactile touched')
         self._unregisterEvents()
         self._comms.trigger('rear')
         self._registerEvents()
@@ -116,7 +119,18 @@ def main():
         '--ignoreSSL', help='Ignores any SSL errors - only recommended for test environments', action='store_true')
     parser.add_argument(
         '--reconnect', help='The number of reconnect attempts to make if a connection is lost', default=25)
+    parser.add_argument(
+        '--backend', help='The engine backend to use for executing programs', choices=['tree', 'vm'], default='vm')
+    parser.add_argument(
+        '--trace', help='Records the engine runs to a trace file, which can be replayed with recording.py', default=None)
+    parser.add_argument(
+        '--jsonOnly', help='Always sends JSON messages, even if the server supports the binary encoding', action='store_true')
+    parser.add_argument(
+        '--logLevel', help='The default logging level', choices=sorted(logger.LEVELS.keys()), default='info')
+    parser.add_argument(
+        '--logSubsystems', help='Logging levels for individual subsystems (e.g. Engine=debug,Comms=warning)', default='')
     args = parser.parse_args()
+    logger.configure(logger.parse_level(args.logLevel), logger.parse_subsystems(args.logSubsystems))
 
     server = args.server
     pwd = args.password
@@ -124,32 +138,35 @@ def main():
         server = server + ':' + args.port
 
     args.reconnect = int(args.reconnect)
-    logger.log('[Main] Starting communications')
-    logger.log('[Main] Environment')
-    logger.log('[Main] -- Test robot              : %r', args.test)
-    logger.log('[Main] -- Number of reconnections : %r', args.reconnect)
-    comms = Communications(not args.test, args.reconnect)
+    _log.info('Starting communications')
+    _log.info('Environment')
+    _log.info('-- Test robot              : %r', args.test)
+    _log.info('-- Number of reconnections : %r', args.reconnect)
+    _log.info('-- Engine backend          : %s', args.backend)
+    _log.info('-- Trace file              : %s', args.trace)
+    _log.info('-- Binary encoding         : %r', not args.jsonOnly)
+    comms = Communications(not args.test, args.reconnect, args.backend, args.trace, not args.jsonOnly)
     if not args.test:
         if has_nao:
             myBroker = ALBroker("myBroker", "0.0.0.0", 0, args.pip, args.pport)
             global NaoRemote
             NaoRemote = NaoRemoteModule("NaoRemote", comms)
         else:
-            logger.log('[Main] !!NaoQI not installed!!')
+            _log.error('!!NaoQI not installed!!')
             return
 
     verifySSL = not args.ignoreSSL
     if not verifySSL:
-        logger.log('[Main] WARNING: ignoring SSL errors')
+        _log.warning('Ignoring SSL errors')
 
     connected = False
     if not args.server is None:
-        logger.log('[Main] Connecting to %s', server)
+        _log.info('Connecting to %s', server)
         comms.start(server, pwd, verifySSL, name=args.name)
         connected = True
 
     if not connected:
-        logger.log('[Main] Attempting to connect using connect.txt')
+        _log.info('Attempting to connect using connect.txt')
         try:
             with open('connect.txt', 'r') as conn_file:
                 rdr = csv.reader(conn_file)
@@ -158,14 +175,14 @@ def main():
                         server = row[0]
                         pwd = row[1]
                         secure = True if len(row) < 3 else row[2] != 'no'
-                        logger.log('[Main] Connecting to %s %s', server, ('' if secure else ' [not secure]'))
+                        _log.info('Connecting to %s %s', server, ('' if secure else ' [not secure]'))
                         if comms.start(server, pwd, verifySSL, secure, args.name):
                             connected = True
         except IOError:
-            logger.log('[Main] Cannot find connect.txt')
+            _log.info('Cannot find connect.txt')
 
     if not connected:
-        logger.log('[Main] Unable to connect')
+        _log.error('Unable to connect')
         robot = RobotMock()
         if not args.test and has_nao:
             robot = Robot('127.0.0.1')
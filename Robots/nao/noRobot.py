@@ -1,5 +1,7 @@
 import logger
 
+_log = logger.get_logger('Fake')
+
 class RobotMock(object):
     ''' Fakes a robot instance. This is used primarily for testing the rest of the components on a PC. '''
 
@@ -23,7 +25,7 @@ class RobotMock(object):
 
     def __getattr__(self, name):
         def _missing(*args, **kwargs):
-            logger.log('[Fake] Called method "%s"', name)
+            _log.debug('Called method "%s"', name)
             return self
         return _missing
 
@@ -34,5 +36,5 @@ class RobotMock(object):
         pass
 
     def wait(self):
-        logger.log('[Fake] Waiting')
+        _log.debug('Waiting')
         pass
@@ -0,0 +1,151 @@
+''' Provides a bounded queue for the messages sent to the server, with a dedicated sender thread. '''
+from collections import deque
+import threading
+import time
+
+import logger
+
+_log = logger.get_logger('Outbox')
+
+# The state update message: updates with the same name can be coalesced
+ROBOT_STATE_UPDATE = 501
+ROBOT_DEBUG_MESSAGE = 502
+
+# The telemetry messages: only these count against the capacity and can be dropped
+TELEMETRY_MESSAGES = (ROBOT_STATE_UPDATE, ROBOT_DEBUG_MESSAGE)
+
+
+class Outbox(object):
+    ''' Queues the outbound messages and sends them from a single thread, in order.
+
+    The callers only pay for adding a message to the queue, so a slow socket write does not hold up the
+    engine. While a state update for a name is still waiting to be sent, a newer update for the same name
+    replaces its value instead of being queued (the last value wins.) When the queue is full, telemetry
+    callers wait for space (up to the put timeout) and the message is dropped if there is still no space.
+    The other messages (e.g. program finished) are never dropped: they are always added to the queue. '''
+
+    def __init__(self, write, capacity=256, put_timeout=1.0):
+        ''' Initialises the outbox. Write is called on the sender thread with the type, conversation and
+values of each message, and must send it to the server. '''
+        self._write = write
+        self.capacity = capacity
+        self.put_timeout = put_timeout
+        self._condition = threading.Condition()
+        self._queue = deque()
+        self._updates = {}
+        self._thread = None
+        self._sending = False
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.failed = 0
+        self.peak_depth = 0
+
+    def put(self, msg_type, conversation_id, data):
+        ''' Adds a message to the queue. Returns False if a telemetry message was dropped because the queue is full. '''
+        key = None
+        if msg_type == ROBOT_STATE_UPDATE and 'name' in data:
+            key = (conversation_id, data['name'])
+
+        self._condition.acquire()
+        try:
+            if key is not None:
+                entry = self._updates.get(key)
+                if entry is not None:
+                    entry[2] = data
+                    self.coalesced += 1
+                    return True
+
+            if msg_type in TELEMETRY_MESSAGES and len(self._queue) >= self.capacity:
+                deadline = time.time() + self.put_timeout
+                while len(self._queue) >= self.capacity:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.dropped += 1
+                        _log.warning('Outbound queue is full, dropping message of type %s', msg_type)
+                        return False
+                    self._condition.wait(remaining)
+
+            entry = [msg_type, conversation_id, data, key]
+            self._queue.append(entry)
+            if key is not None:
+                self._updates[key] = entry
+            if len(self._queue) > self.peak_depth:
+                self.peak_depth = len(self._queue)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='Outbox')
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify_all()
+            return True
+        finally:
+            self._condition.release()
+
+    def depth(self):
+        ''' Retrieves the number of messages waiting to be sent. '''
+        self._condition.acquire()
+        try:
+            return len(self._queue)
+        finally:
+            self._condition.release()
+
+    def flush(self, timeout=5.0):
+        ''' Waits until the queued messages have been sent. Returns False if they are still being sent. '''
+        self._condition.acquire()
+        try:
+            deadline = time.time() + timeout
+            while self._queue or self._sending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+        finally:
+            self._condition.release()
+
+    def stats(self):
+        ''' Retrieves the counters for the queue. '''
+        self._condition.acquire()
+        try:
+            return {
+                'depth': len(self._queue),
+                'peakDepth': self.peak_depth,
+                'sent': self.sent,
+                'coalesced': self.coalesced,
+                'dropped': self.dropped,
+                'failed': self.failed,
+            }
+        finally:
+            self._condition.release()
+
+    def _run(self):
+        while True:
+            self._condition.acquire()
+            try:
+                while not self._queue:
+                    self._condition.wait()
+                msg_type, conversation_id, data, key = self._queue.popleft()
+                if key is not None:
+                    del self._updates[key]
+                self._sending = True
+                self._condition.notify_all()
+            finally:
+                self._condition.release()
+
+            sent = True
+            try:
+                self._write(msg_type, conversation_id, data)
+            except Exception as e:
+                sent = False
+                _log.warning('Unable to send message of type %s: %s', msg_type, e)
+
+            self._condition.acquire()
+            try:
+                self._sending = False
+                if sent:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+                self._condition.notify_all()
+            finally:
+                self._condition.release()
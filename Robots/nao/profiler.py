@@ -0,0 +1,94 @@
+''' Provides a per-block profiler, which separates the interpreter time from the time spent waiting for the robot. '''
+import json
+import threading
+import time
+
+import logger
+
+_log = logger.get_logger('Profiler')
+
+
+class Profiler(object):
+    ''' Accumulates the wall time, call count and time blocked in Robot.wait() for each function name and block.
+
+    The times for a block include any blocks nested inside it, so the interpreter time for a block is its
+    wall time less its wait time. Event handlers run on other threads, so each thread has its own stack. '''
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._functions = {}
+        self._blocks = {}
+
+    def enter(self):
+        ''' Starts timing a block. '''
+        local = self._local
+        try:
+            local.stack.append((time.time(), local.waited))
+        except AttributeError:
+            local.stack = [(time.time(), 0.0)]
+            local.waited = 0.0
+
+    def leave(self, func_name, source_id):
+        ''' Stops timing the current block and adds it to the totals. '''
+        local = self._local
+        start, waited = local.stack.pop()
+        elapsed = time.time() - start
+        wait = local.waited - waited
+        self._lock.acquire()
+        try:
+            self._add(self._functions, func_name, None, elapsed, wait)
+            if source_id:
+                self._add(self._blocks, source_id, func_name, elapsed, wait)
+        finally:
+            self._lock.release()
+
+    def waited(self, seconds):
+        ''' Records the time the current thread was blocked waiting for the robot. '''
+        try:
+            self._local.waited += seconds
+        except AttributeError:
+            self._local.stack = []
+            self._local.waited = seconds
+
+    def report(self):
+        ''' Generates the report: the totals for each function name and block, with the times in milliseconds. '''
+        self._lock.acquire()
+        try:
+            return {
+                'functions': dict((name, self._format(entry)) for name, entry in self._functions.items()),
+                'blocks': dict((source_id, self._format(entry)) for source_id, entry in self._blocks.items()),
+            }
+        finally:
+            self._lock.release()
+
+    def save(self, path):
+        ''' Writes the report to a file as JSON. '''
+        _log.info('Saving profile to %s', path)
+        try:
+            with open(path, 'w') as f:
+                json.dump(self.report(), f, indent=2, sort_keys=True)
+        except IOError as e:
+            _log.warning('Unable to save profile: %s', e)
+
+    def _add(self, totals, key, func_name, elapsed, wait):
+        try:
+            entry = totals[key]
+        except KeyError:
+            entry = [func_name, 0, 0.0, 0.0]
+            totals[key] = entry
+        entry[1] += 1
+        entry[2] += elapsed
+        entry[3] += wait
+
+    def _format(self, entry):
+        func_name, calls, elapsed, wait = entry
+        result = {
+            'calls': calls,
+            'time': round(elapsed * 1000, 3),
+            'wait': round(wait * 1000, 3),
+            'interpreter': round((elapsed - wait) * 1000, 3),
+        }
+        if func_name is not None:
+            result['function'] = func_name
+        return result
@@ -0,0 +1,357 @@
+''' Provides recording and replaying of engine runs.
+
+A trace is a compact binary file that records everything the engine sends to the robot and the server,
+together with the sensor values it read. Each record is a header (the record kind, the microseconds since
+the previous record and the payload length) followed by the payload. Names (e.g. robot method names) are
+only written once, later records refer to them by their index.
+
+Usage: python recording.py dump FILE
+       python recording.py replay FILE [--backend tree|vm]
+'''
+import argparse
+from collections import deque
+import io
+import json
+import struct
+import threading
+import time
+
+import logger
+from simulation import SimulatedRobot, VirtualClock
+
+_log = logger.get_logger('Trace')
+
+MAGIC = b'NBT1'
+
+# The record kinds
+NAME = 0
+CALL = 1
+SENSOR = 2
+SEND = 3
+PROGRAM = 4
+OPTIONS = 5
+TRIGGER = 6
+
+_HEADER = struct.Struct('<BII')
+_ID = struct.Struct('<H')
+
+# The debug messages are batched by time, so they are not compared in a replay
+ROBOT_DEBUG_MESSAGE = 502
+
+# The sensor name used to record the robot's posture
+POSTURE = 'POSTURE'
+
+
+def _describe(value):
+    ''' Describes a value that cannot be converted to JSON (e.g. a movement.) '''
+    return getattr(value, 'name', None) or type(value).__name__
+
+
+def _encode(value):
+    return json.dumps(value, separators=(',', ':'), default=_describe).encode('utf-8')
+
+
+class Recorder(object):
+    ''' Writes trace records to a binary stream. This can be shared by several threads. '''
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._names = {}
+        self._last = None
+        self._lock = threading.Lock()
+        stream.write(MAGIC)
+
+    def call(self, name, args, kwargs=None):
+        ''' Records a call to the robot. '''
+        values = [list(args), kwargs] if kwargs else list(args)
+        self._write_named(CALL, name, _encode(values))
+
+    def sensor(self, name, value):
+        ''' Records a value read from a sensor. '''
+        self._write_named(SENSOR, name, _encode(value))
+
+    def send(self, msg_type, data):
+        ''' Records a message sent to the server. '''
+        self._write(SEND, _ID.pack(int(getattr(msg_type, 'value', msg_type))) + _encode(data))
+
+    def program(self, ast):
+        ''' Records the program that is about to run. '''
+        self._write(PROGRAM, _encode(ast))
+
+    def options(self, opts):
+        ''' Records the options the engine has been configured with. '''
+        self._write(OPTIONS, _encode(opts))
+
+    def trigger(self, block_name, value):
+        ''' Records an event that triggered a block. '''
+        self._write_named(TRIGGER, block_name, _encode(value))
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._stream.close()
+        finally:
+            self._lock.release()
+
+    def _write_named(self, kind, name, payload):
+        self._lock.acquire()
+        try:
+            try:
+                index = self._names[name]
+            except KeyError:
+                index = len(self._names)
+                self._names[name] = index
+                self._write_record(NAME, name.encode('utf-8'))
+            self._write_record(kind, _ID.pack(index) + payload)
+        finally:
+            self._lock.release()
+
+    def _write(self, kind, payload):
+        self._lock.acquire()
+        try:
+            self._write_record(kind, payload)
+        finally:
+            self._lock.release()
+
+    def _write_record(self, kind, payload):
+        ''' Writes a record: the lock must be held. The clock is not monotonic on Python 2, so the time never goes backwards. '''
+        now = time.time()
+        delta = 0 if self._last is None else max(0, min(int((now - self._last) * 1e6), 0xFFFFFFFF))
+        self._last = now if self._last is None else max(now, self._last)
+        self._stream.write(_HEADER.pack(kind, delta, len(payload)) + payload)
+        self._stream.flush()
+
+
+def read(stream):
+    ''' Reads the records from a trace. Each record is a tuple of the time (in seconds from the start), kind, name and value. '''
+    if stream.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a trace file')
+
+    names = []
+    records = []
+    elapsed = 0.0
+    while True:
+        header = stream.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            break
+        kind, delta, length = _HEADER.unpack(header)
+        payload = stream.read(length)
+        elapsed += delta / 1e6
+        if kind == NAME:
+            names.append(payload.decode('utf-8'))
+            continue
+
+        name = None
+        if kind in (CALL, SENSOR, TRIGGER):
+            name = names[_ID.unpack(payload[:_ID.size])[0]]
+            payload = payload[_ID.size:]
+        elif kind == SEND:
+            name = _ID.unpack(payload[:_ID.size])[0]
+            payload = payload[_ID.size:]
+        records.append((elapsed, kind, name, json.loads(payload.decode('utf-8'))))
+    return records
+
+
+class RecordingComms(object):
+    ''' Wraps the communications, recording every message sent. '''
+
+    def __init__(self, comms, recorder):
+        self._comms = comms
+        self._recorder = recorder
+
+    def send(self, msg_type, data):
+        self._recorder.send(msg_type, data)
+        self._comms.send(msg_type, data)
+
+
+class RecordingSensor(object):
+    ''' Wraps a sensor, recording every value read. '''
+
+    def __init__(self, sensor, name, recorder):
+        self._sensor = sensor
+        self._name = name
+        self._recorder = recorder
+
+    def read(self):
+        value = self._sensor.read()
+        self._recorder.sensor(self._name, value)
+        return value
+
+
+class RecordingRobot(object):
+    ''' Wraps a robot, recording every call made to it. '''
+
+    def __init__(self, robot, recorder):
+        self._robot = robot
+        self._recorder = recorder
+
+    def __enter__(self):
+        self._robot.__enter__()
+        return self
+
+    def __exit__(self, exit_type, exit_value, exit_traceback):
+        return self._robot.__exit__(exit_type, exit_value, exit_traceback)
+
+    def __getattr__(self, name):
+        attr = getattr(self._robot, name)
+        if not callable(attr):
+            return attr
+
+        recorder = self._recorder
+        def _record(*args, **kwargs):
+            recorder.call(name, args, kwargs)
+            result = attr(*args, **kwargs)
+            if name == 'getSensor':
+                return RecordingSensor(result, args[0], recorder)
+            if name == 'getPosture':
+                # Postures are read like a sensor, so they are replayed the same way
+                recorder.sensor(POSTURE, result if isinstance(result, (str, type(u''))) else None)
+            return result
+        return _record
+
+
+class ReplaySensor(object):
+    ''' A sensor that returns the recorded values in order (and then repeats the last value.) '''
+
+    def __init__(self, values):
+        self._values = values
+        self._last = None
+
+    def read(self):
+        if self._values:
+            self._last = self._values.popleft()
+        return self._last
+
+
+class ReplayRobot(SimulatedRobot):
+    ''' A simulated robot that returns the recorded sensor values. '''
+
+    def __init__(self, clock, sensors):
+        SimulatedRobot.__init__(self, clock)
+        self._sensors = sensors
+        self._postures = ReplaySensor(sensors[POSTURE]) if POSTURE in sensors else None
+
+    def getPosture(self):
+        if self._postures is None:
+            return SimulatedRobot.getPosture(self)
+        return self._postures.read()
+
+    def getSensor(self, name):
+        try:
+            values = self._sensors[name]
+        except KeyError:
+            values = deque()
+            self._sensors[name] = values
+        return ReplaySensor(values)
+
+
+class NullComms(object):
+    ''' Discards the messages sent during a replay. '''
+
+    def send(self, msg_type, data):
+        pass
+
+
+def _comparable(records):
+    ''' Generates the keys for comparing the records in a trace with a replay. '''
+    keys = []
+    for _, kind, name, value in records:
+        if kind in (CALL, SENSOR) or (kind == SEND and name != ROBOT_DEBUG_MESSAGE):
+            keys.append((kind, name, json.dumps(value, sort_keys=True)))
+    return keys
+
+
+def replay(records, backend='tree'):
+    ''' Replays the runs in a trace under the mock robot, feeding back the recorded sensor values.
+
+    The replay runs on a virtual clock, so waits return straight away. Triggered blocks are replayed after
+    the run they were recorded in. Returns the replayed records, the time taken (in seconds) and the index of the first robot call, sensor read or message (other than debug
+    messages) that differs, or None if they all match. '''
+    from engine import Engine
+
+    class ReplayEngine(Engine):
+        def __init__(self, sensors, recorder):
+            self._replay_sensors = sensors
+            Engine.__init__(self, NullComms(), use_robot=False, backend=backend, recorder=recorder, clock=VirtualClock())
+
+        def _create_robot(self, ip):
+            return ReplayRobot(self._clock, self._replay_sensors)
+
+    sensors = {}
+    for _, kind, name, value in records:
+        if kind == SENSOR:
+            sensors.setdefault(name, deque()).append(value)
+
+    # Each run starts when the engine is configured
+    runs = []
+    for _, kind, name, value in records:
+        if kind == OPTIONS:
+            runs.append([value, None, []])
+        elif kind == PROGRAM and runs:
+            runs[-1][1] = value
+        elif kind == TRIGGER and runs:
+            runs[-1][2].append((name, value))
+
+    output = io.BytesIO()
+    recorder = Recorder(output)
+    start = time.time()
+    engine = ReplayEngine(sensors, recorder)
+    for opts, ast, triggers in runs:
+        if ast is None:
+            continue
+        engine.configure(opts)
+        engine.run(engine.compile(ast))
+        for block_name, value in triggers:
+            engine.trigger(block_name, value)
+            while not engine._scheduler.is_idle():
+                time.sleep(0.001)
+    elapsed = time.time() - start
+
+    output.seek(0)
+    replayed = read(output)
+    expected = _comparable(records)
+    actual = _comparable(replayed)
+    difference = None
+    for index in range(max(len(expected), len(actual))):
+        if index >= len(expected) or index >= len(actual) or expected[index] != actual[index]:
+            difference = index
+            break
+    return replayed, elapsed, difference
+
+
+def _format(record):
+    elapsed, kind, name, value = record
+    labels = {CALL: 'call', SENSOR: 'sensor', SEND: 'send', PROGRAM: 'program', OPTIONS: 'options', TRIGGER: 'trigger'}
+    text = json.dumps(value)
+    if len(text) > 100:
+        text = text[:97] + '...'
+    return '%10.6f %-8s %s %s' % (elapsed, labels.get(kind, kind), '' if name is None else name, text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Dump or replay an engine trace.')
+    parser.add_argument('command', choices=['dump', 'replay'])
+    parser.add_argument('trace', help='The trace file')
+    parser.add_argument('--backend', help='The engine backend to replay with', choices=['tree', 'vm'], default='vm')
+    args = parser.parse_args()
+    logger.configure(logger.WARNING)
+
+    with open(args.trace, 'rb') as f:
+        records = read(f)
+
+    if args.command == 'dump':
+        for record in records:
+            print(_format(record))
+        return
+
+    replayed, elapsed, difference = replay(records, args.backend)
+    print('Replayed %d records in %.3fs (recorded over %.3fs)' % (
+        len(replayed), elapsed, records[-1][0] if records else 0))
+    if difference is None:
+        print('The replay matches the trace')
+    else:
+        print('The replay differs from the trace at event %d' % (difference, ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+''' Provides a pooled, keep-alive HTTP session for calling the server's REST API. '''
+import requests
+from requests.adapters import HTTPAdapter
+try:
+    from urllib3.util.retry import Retry
+except ImportError:
+    # Older versions of requests bundle their own copy of urllib3
+    from requests.packages.urllib3.util.retry import Retry
+
+import logger
+
+_log = logger.get_logger('Rest')
+
+# The default number of retries and the backoff between them (the waits are backoff, 2 * backoff, 4 * backoff, ...)
+RETRIES = 3
+BACKOFF = 0.5
+
+# The number of connections to keep open to the server
+POOL_SIZE = 2
+
+# The (connect, read) timeouts for each endpoint, in seconds: the longest matching prefix is used
+DEFAULT_TIMEOUT = (5, 30)
+TIMEOUTS = {
+    '/api/v1/version': (5, 10),
+    '/api/v1/session': (5, 10),
+    '/api/v1/robots/register': (5, 5),
+    '/api/v1/code/': (5, 30),
+    '/api/v1/robots/types/nao/package': (5, 120),
+}
+
+
+class RestClient(object):
+    ''' Calls a server's REST API through a single session.
+
+    The session keeps its connections open between calls, so only the first call to a server pays for
+    the TCP and TLS handshakes. Failed connections (and reads for GET requests) are retried with an
+    exponential backoff. Each call uses the timeout for its endpoint, unless it passes its own. '''
+
+    def __init__(self, base_address, verify=True, retries=RETRIES, backoff=BACKOFF, pool_size=POOL_SIZE, timeouts=None):
+        self.base_address = base_address.rstrip('/')
+        self.timeouts = dict(TIMEOUTS)
+        if timeouts:
+            self.timeouts.update(timeouts)
+        self._session = requests.Session()
+        self._session.verify = verify
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=Retry(total=retries, backoff_factor=backoff))
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    def url(self, path):
+        ''' Generates the full address for a path. '''
+        return self.base_address + path
+
+    def timeout(self, path):
+        ''' Retrieves the timeout for a path. '''
+        best = None
+        for prefix in self.timeouts:
+            if path.startswith(prefix) and (best is None or len(prefix) > len(best)):
+                best = prefix
+        return DEFAULT_TIMEOUT if best is None else self.timeouts[best]
+
+    def get(self, path, **kwargs):
+        ''' Sends a GET request. '''
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        ''' Sends a POST request. '''
+        return self.request('POST', path, **kwargs)
+
+    def request(self, method, path, **kwargs):
+        ''' Sends a request to a path on the server. '''
+        kwargs.setdefault('timeout', self.timeout(path))
+        _log.debug('%s %s', method, path)
+        return self._session.request(method, self.url(path), **kwargs)
+
+    def close(self):
+        ''' Closes the open connections. '''
+        self._session.close()
@@ -8,6 +8,8 @@ from PIL import Image
 import sensors
 import logger
 
+_log = logger.get_logger('Robot')
+
 class Robot(object):
     ''' Defines a common interface to a Nao robot.
 
@@ -43,7 +45,7 @@ r.say("Hello world").goToPosture(Robot.STAND).wait() '''
         self._ip = ip
         self._session = qi.Session()
         address = "tcp://" + ip + ":9559"
-        logger.log('[Robot] Connecting to ' + address)
+        _log.info('Connecting to %s', address)
         self._session.connect(address)
         self._audio = self._session.service("ALAudioDevice")
         self._behavior = self._session.service("ALBehaviorManager")
@@ -57,10 +59,13 @@ r.say("Hello world").goToPosture(Robot.STAND).wait() '''
         self._system = self._session.service("ALSystem")
         self._video = None
         self._promises = []
+        self._claims = []
+        self._claimed = None
         self._last_result = False
         self._resting = True
         self._last_volume = self._audio.getOutputVolume()
         self.name = self._system.robotName()
+        self._logger = logger.get_logger('Robot', 'Robot:' + self.name)
         self._sensors = {
             sensors.Sensor.HEAD_FRONT: sensors.BooleanSensor('Device/SubDeviceList/Head/Touch/Front/Sensor/Value', self._memory),
             sensors.Sensor.HEAD_MIDDLE: sensors.BooleanSensor('Device/SubDeviceList/Head/Touch/Middle/Sensor/Value', self._memory),
@@ -78,9 +83,6 @@ r.say("Hello world").goToPosture(Robot.STAND).wait() '''
         }
         self._sonars_on = False
 
-    def _log(self, msg):
-        logger.log('[Robot:' + self.name + '] ' + msg)
-
     def _moveHand(self, hand, openHand):
         handName = None
         if hand == Robot.RIGHT_HAND:
@@ -91,7 +93,7 @@ r.say("Hello world").goToPosture(Robot.STAND).wait() '''
             raise InvalidOperationError(
                 'moveHand', 'Unknown hand: ' + str(hand))
 
-        self._log('' + ('Opening ' if openHand else 'Closing ') + handName)
+        self._logger.debug('%s %s', 'Opening' if openHand else 'Closing', handName)
         if openHand:
             p = self._motion.openHand(handName, _async=True)
         else:
@@ -119,9 +121,28 @@ r.say("Hello world").goToPosture(Robot.STAND).wait() '''
         self.rest()
         self.setSonars(False)
 
+    def claim(self, resources):
+        ''' Waits for any in-flight actions that use the resources.
+
+Any actions started after this are assumed to use the resources, until the next claim or wait. Actions
+started before the first claim use every resource. '''
+        for p in self._promises:
+            self._claims.append((p, self._claimed))
+        self._promises = []
+
+        remaining = []
+        for p, used in self._claims:
+            if used is None or used & resources:
+                self._last_result = p.value()
+            else:
+                remaining.append((p, used))
+        self._claims = remaining
+        self._claimed = resources
+        return self
+
     def delay(self, duration):
         ''' Delays for the specified duration. '''
-        self._log('Delaying for ' + str(duration) + 's')
+        self._logger.debug('Delaying for %ss', duration)
         time.sleep(duration)
         return self
 
@@ -149,12 +170,12 @@ r.say("Hello world").goToPosture(Robot.STAND).wait() '''
 
     def getNotification(self, id):
         ''' Returns a notification on the robot. '''
-        self._log('Retrieving notification %d' % (id, ))
+        self._logger.debug('Retrieving notification %d', id)
         notification = self._notifications.notification(id)
         return Notification(notification, self)
 
     def addNotification(self, message, severity='info'):
-        self._log('Adding notification "%s" [%s]' % (message, severity))
+        self._logger.info('Adding notification "%s" [%s]', message, severity)
         self._notifications.add({"message": message, "severity": severity, "removeOnRead": True})
 
     def getPosture(self):
@@ -163,14 +184,12 @@ r.say("Hello world").goToPosture(Robot.STAND).wait() '''
 
     def getSensor(self, name):
         ''' Retrieves a sensor. '''
-        sensor = self._sensors[name]
-        sensor._log = self._log
-        return sensor
+        return self._sensors[name]
 
     def goToPosture(self, posture, wait=False):
         ''' Starts the robot moving to a posture. '''
         self._prepare()
-        self._log('Going to posture ' + posture)
+        self._logger.debug('Going to posture %s', posture)
         p = self._posture.goToPosture(posture, 0.8, _async=True)
         self._promises.append(p)
         return self.wait() if wait else self
@@ -208,14 +227,22 @@ This method can move either one or both hands. The possible movements are either
             angles += movement.angles()
             times += movement.times()
 
-        self._log('Performing movement(s)')
+        self._logger.debug('Performing movement(s)')
         p = self._motion.angleInterpolation(
             names, angles, times, True, _async=True)
         self._promises.append(p)
         return self.wait() if wait else self
 
+    def preloadBehaviour(self, behaviour):
+        self._logger.debug('Preloading behaviour "%s"', behaviour)
+        if not self._behavior.isBehaviorInstalled(behaviour):
+            self._logger.warning('Behaviour "%s" not found', behaviour)
+            return False
+        self._behavior.preloadBehavior(behaviour)
+        return True
+
     def rest(self):
-        self._log('Resting')
+        self._logger.debug('Resting')
         self._motion.rest()
         self._resting = True
         return self
@@ -225,7 +252,7 @@ This method can move either one or both hands. The possible movements are either
 
     def say(self, text, wait=False):
         text = str(text)
-        self._log('Saying ' + text)
+        self._logger.debug('Saying %s', text)
         p = self._speech.say(text, _async=True)
         self._promises.append(p)
         return self.wait() if wait else self
@@ -239,16 +266,16 @@ This method can move either one or both hands. The possible movements are either
 This method can take in either a boolean (True/False), or an integer between 0 and 2.
 If the argument is True, then the animations are set to contextual (2), if False then they are set to none (0)'''
         if on == True or on == False:
-            self._log('Animations are now ' + ('on' if on else 'off'))
+            self._logger.debug('Animations are now %s', 'on' if on else 'off')
             self._speech.setBodyLanguageMode(2 if on else 0)
         else:
-            self._log('Setting animations to ' + str(on))
+            self._logger.debug('Setting animations to %s', on)
             self._speech.setBodyLanguageMode(on)
         return self
 
     def setBreathing(self, on):
         ''' Turns breathing on or off. '''
-        self._log('Breathing is now ' + ('on' if on else 'off'))
+        self._logger.debug('Breathing is now %s', 'on' if on else 'off')
         self._motion.setBreathEnabled('Body', on)
         return self
 
@@ -263,7 +290,7 @@ If the argument is True, then the animations are set to contextual (2), if False
 
         colours = ['Red', 'Green', 'Blue']
         rgb = _rgb(colour)
-        self._log('Changing LED colour(s)')
+        self._logger.debug('Changing LED colour(s)')
         for ledSet in ledSets:
             for idx, colour_name in enumerate(colours):
                 if rgb[idx] >= 128:
@@ -283,12 +310,12 @@ If the argument is True, then the animations are set to contextual (2), if False
     def setSonars(self, on):
         if on:
             if not self._sonars_on:
-                self._log('Turning sonars on')
+                self._logger.debug('Turning sonars on')
                 self._sonar.subscribe("NaoRobotAPI")
                 self._sonars_on = True
         else:
             if self._sonars_on:
-                self._log('Turning sonars off')
+                self._logger.debug('Turning sonars off')
                 self._sonar.unsubscribe("NaoRobotAPI")
                 self._sonars_on = False
 
@@ -297,7 +324,7 @@ If the argument is True, then the animations are set to contextual (2), if False
         if skipCheck:
             startRun = True
         else:
-            self._log('Checking for behaviour "' + behaviour + '"')
+            self._logger.debug('Checking for behaviour "%s"', behaviour)
             if (self._behavior.isBehaviorInstalled(behaviour)):
                 if (not self._behavior.isBehaviorRunning(behaviour)):
                     startRun = True
@@ -309,7 +336,7 @@ If the argument is True, then the animations are set to contextual (2), if False
                     'startBehaviour', 'Behaviour not found')
 
         if startRun:
-            self._log('Starting behaviour "' + behaviour + '"')
+            self._logger.debug('Starting behaviour "%s"', behaviour)
             p = self._behavior.runBehavior(behaviour, _async=True)
             self._promises.append(p)
 
@@ -322,14 +349,18 @@ If the argument is True, then the animations are set to contextual (2), if False
         return self._video
 
     def wait(self):
-        self._log('Waiting')
+        self._logger.debug('Waiting')
+        for p, _ in self._claims:
+            self._last_result = p.value()
         for p in self._promises:
             self._last_result = p.value()
         self._promises = []
+        self._claims = []
+        self._claimed = None
         return self
 
     def wakeUp(self):
-        self._log('Waking up')
+        self._logger.debug('Waking up')
         self._motion.wakeUp()
         self._resting = False
         return self
@@ -352,8 +383,7 @@ If the argument is True, then the animations are set to contextual (2), if False
         if theta < -90:
             theta = -90
         self._prepare()
-        self._log('Starting walk (%f, %f, %f)' %
-                  (x_direction, y_direction, theta))
+        self._logger.debug('Starting walk (%f, %f, %f)', x_direction, y_direction, theta)
         posture = self._posture.getPostureFamily()
         if posture != 'Standing':
             raise InvalidOperationError('walkStart', 'Robot must be standing')
@@ -364,13 +394,13 @@ If the argument is True, then the animations are set to contextual (2), if False
 
     def walkStop(self):
         ''' Stops the robot from walking. '''
-        self._log('Stopping walk')
+        self._logger.debug('Stopping walk')
         self._motion.stopMove()
         return self
 
     def walkTo(self, x, y, theta, wait=False, useArms=True):
         self._prepare()
-        self._log('Walking')
+        self._logger.debug('Walking')
         posture = self._posture.getPostureFamily()
         if posture != 'Standing':
             raise InvalidOperationError('walkTo', 'Robot must be standing')
@@ -434,7 +464,7 @@ class VideoCamera(object):
     BOTTOM = 1
 
     def __init__(self, robot):
-        self._log = robot._log
+        self._logger = robot._logger
         self._closed = False
         self._lastCamera = -1
         self._video = robot._session.service('ALVideoDevice')
@@ -443,7 +473,7 @@ class VideoCamera(object):
         colorSpace = vision_definitions.kRGBColorSpace
         fps = 15
 
-        self._log('Subscribing to video cameras')
+        self._logger.debug('Subscribing to video cameras')
         self._nameID = self._video.subscribe(
             'RobotVideo', resolution, colorSpace, fps)
 
@@ -452,10 +482,10 @@ class VideoCamera(object):
 
     def close(self):
         if self._closed:
-            self._log('Camera already unsubscribed')
+            self._logger.debug('Camera already unsubscribed')
             return
 
-        self._log('Unsubscribing from camera')
+        self._logger.debug('Unsubscribing from camera')
         self._video.unsubscribe(self._nameID)
         self._closed = True
 
@@ -466,17 +496,17 @@ class VideoCamera(object):
     def capture(self, camera):
         if self._lastCamera != camera:
             cameraName = 'top' if camera == VideoCamera.TOP else 'bottom'
-            self._log('Changing camera to %s' % (cameraName))
+            self._logger.debug('Changing camera to %s', cameraName)
             self._video.setActiveCamera(camera)
             self._lastCamera = camera
 
-        self._log('Retrieving image')
+        self._logger.debug('Retrieving image')
         naoImage = self._video.getImageRemote(self._nameID)
         if naoImage is None:
-            self._log('Unable to retrieve image')
+            self._logger.warning('Unable to retrieve image')
             return None
 
-        self._log('Converting image')
+        self._logger.debug('Converting image')
         imageWidth = naoImage[0]
         imageHeight = naoImage[1]
         array = naoImage[6]
@@ -0,0 +1,195 @@
+''' Provides a cooperative scheduler for running event handlers. '''
+from collections import deque
+import threading
+
+import logger
+
+_log = logger.get_logger('Scheduler')
+
+# The policies for when a handler is triggered while it is still running
+QUEUE = 'queue'
+DROP = 'drop'
+RESTART = 'restart'
+POLICIES = (QUEUE, DROP, RESTART)
+
+
+class TaskCancelled(Exception):
+    ''' Raised at a checkpoint inside a step when the task has been cancelled. '''
+
+
+class Task(object):
+    ''' A cooperative task, which wraps a generator that yields after each step. '''
+
+    def __init__(self, name, generator):
+        self.name = name
+        self.is_cancelled = False
+        self._generator = generator
+
+    def cancel(self):
+        ''' Cancels the task: it will stop at its next checkpoint or before its next step. '''
+        self.is_cancelled = True
+
+    def step(self):
+        ''' Runs the next step of the task. Returns False when the task has finished. '''
+        if self.is_cancelled:
+            _log.debug('Task %s cancelled', self.name)
+            self._generator.close()
+            return False
+
+        try:
+            next(self._generator)
+            return True
+        except StopIteration:
+            return False
+        except TaskCancelled:
+            _log.debug('Task %s cancelled during a step', self.name)
+            return False
+        except Exception as e:
+            _log.error('Task %s failed: %s', self.name, e)
+            return False
+
+
+class Scheduler(object):
+    ''' Runs tasks so they take turns, one at a time.
+
+    Each task runs on its own thread (so it can give up its turn part way through a step), but only the
+    task that has the turn runs. A task gives up its turn after each step, and at each checkpoint inside
+    a step (e.g. each block in a loop body) when other tasks are waiting.
+
+    Only one task for each name is active at a time, the policy decides what happens when a task
+    is added while another task with the same name is active. '''
+
+    def __init__(self, policy=DROP):
+        self.policy = policy
+        self._condition = threading.Condition()
+        self._ready = deque()
+        self._active = {}
+        self._pending = {}
+        self._turn = None
+        self._local = threading.local()
+
+    def spawn(self, name, generator):
+        ''' Adds a task to the scheduler. Returns the task, or None if it was dropped. '''
+        self._condition.acquire()
+        try:
+            current = self._active.get(name)
+            if current is not None and not current.is_cancelled:
+                if self.policy == DROP:
+                    _log.info('Task %s is already running, dropping', name)
+                    generator.close()
+                    return None
+                if self.policy == QUEUE:
+                    _log.info('Task %s is already running, queueing', name)
+                    task = Task(name, generator)
+                    self._pending.setdefault(name, deque()).append(task)
+                    return task
+                _log.info('Task %s is already running, restarting', name)
+                current.cancel()
+
+            task = Task(name, generator)
+            self._active[name] = task
+            self._start(task)
+            return task
+        finally:
+            self._condition.release()
+
+    def cancel(self):
+        ''' Cancels all the tasks. '''
+        self._condition.acquire()
+        try:
+            for task in self._active.values():
+                task.cancel()
+            for tasks in self._pending.values():
+                for task in tasks:
+                    task.cancel()
+            self._pending = {}
+        finally:
+            self._condition.release()
+
+    def is_idle(self):
+        ''' Checks whether there are any tasks left to run. '''
+        self._condition.acquire()
+        try:
+            return not self._active
+        finally:
+            self._condition.release()
+
+    def checkpoint(self):
+        ''' Lets the other tasks take a turn, part way through a step of the current task.
+
+This does nothing when called outside a task. Raises TaskCancelled when the current task has been
+cancelled, so the step stops straight away. '''
+        task = getattr(self._local, 'task', None)
+        if task is None:
+            return
+        if self._ready:
+            self._condition.acquire()
+            try:
+                self._ready.append(task)
+                self._next_turn()
+                self._wait_for_turn(task)
+            finally:
+                self._condition.release()
+        if task.is_cancelled:
+            raise TaskCancelled()
+
+    def _start(self, task):
+        ''' Starts the thread for a task, which waits for its turn: the lock must be held. '''
+        if self._turn is None:
+            self._turn = task
+        else:
+            self._ready.append(task)
+        thread = threading.Thread(target=self._run, args=(task, ), name='Task ' + task.name)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, task):
+        ''' Runs the steps of a task, giving up its turn after each one. '''
+        self._local.task = task
+        self._condition.acquire()
+        try:
+            self._wait_for_turn(task)
+        finally:
+            self._condition.release()
+
+        try:
+            while task.step():
+                self._condition.acquire()
+                try:
+                    if self._ready:
+                        self._ready.append(task)
+                        self._next_turn()
+                        self._wait_for_turn(task)
+                finally:
+                    self._condition.release()
+        finally:
+            self._condition.acquire()
+            try:
+                self._finish(task)
+                self._next_turn()
+            finally:
+                self._condition.release()
+
+    def _wait_for_turn(self, task):
+        ''' Waits until it is the task's turn: the lock must be held. '''
+        while self._turn is not task:
+            self._condition.wait()
+
+    def _next_turn(self):
+        ''' Gives the turn to the next ready task (if any): the lock must be held. '''
+        self._turn = self._ready.popleft() if self._ready else None
+        self._condition.notify_all()
+
+    def _finish(self, task):
+        ''' Removes a finished task and starts the next queued task: the lock must be held. '''
+        if self._active.get(task.name) is not task:
+            return
+
+        pending = self._pending.get(task.name)
+        if pending:
+            next_task = pending.popleft()
+            self._active[task.name] = next_task
+            self._start(next_task)
+        else:
+            del self._active[task.name]
+            self._pending.pop(task.name, None)
@@ -1,5 +1,7 @@
 import logger
 
+_log = logger.get_logger('Sensors')
+
 class Sensor(object):
     ''' Encapsulates a sensor. '''
 
@@ -20,15 +22,11 @@ class Sensor(object):
     def __init__(self, name, service):
         self.name = name
         self._service = service
-        self._log = self._doLog
-
-    def _doLog(self, message):
-        logger.log(message)
 
     def read(self):
         ''' Reads the sensor value. '''
         value = self._service.getData(self.name)
-        self._log('Retrieved ' + str(value) + ' from ' + self.name)
+        _log.debug('Retrieved %s from %s', value, self.name)
         return self.format(value)
 
     def format(self, value):
@@ -56,5 +54,5 @@ class FootSensor(Sensor):
         ''' Reads the sensors for the foor bumpers. '''
         value = (self._service.getData('Device/SubDeviceList/' + self.name + '/Bumper/Left/Sensor/Value') +
                 self._service.getData('Device/SubDeviceList/' + self.name + '/Bumper/Right/Sensor/Value')) >= 1
-        self._log('Retrieved ' + str(value) + ' for ' + self.name)
+        _log.debug('Retrieved %s for %s', value, self.name)
         return value
@@ -0,0 +1,257 @@
+''' Provides a simulated robot that runs on a virtual clock.
+
+Waits advance the virtual clock straight away, and the robot actions advance it by how long they
+would take on a real robot, so programs run as fast as the engine allows while still reporting a
+realistic estimate of how long they would take.
+
+Usage: python simulation.py PROGRAM [PROGRAM ...] [--backend tree|vm] [--delay SECONDS]
+
+Each program is a JSON file containing either the nodes of a program or a program downloaded from
+the server (/api/v1/code/{user}/{program}.)
+'''
+import argparse
+import json
+import threading
+import time
+
+from core import Cancellation
+import logger
+from noRobot import RobotMock
+
+_log = logger.get_logger('Simulation')
+
+
+class VirtualClock(object):
+    ''' A clock that only moves when it is advanced. '''
+
+    def __init__(self, start=0.0):
+        self._now = start
+        self._lock = threading.Lock()
+
+    def time(self):
+        ''' Retrieves the current time (in seconds.) '''
+        return self._now
+
+    def advance(self, seconds):
+        ''' Moves the clock forward by a number of seconds. '''
+        if seconds > 0:
+            self._lock.acquire()
+            try:
+                self._now += seconds
+            finally:
+                self._lock.release()
+
+    def advance_to(self, when):
+        ''' Moves the clock forward to a time, if it is not already past it. '''
+        self._lock.acquire()
+        try:
+            if when > self._now:
+                self._now = when
+        finally:
+            self._lock.release()
+
+    def cancellation(self):
+        ''' Generates a cancellation whose waits advance this clock. '''
+        return VirtualCancellation(self)
+
+
+class VirtualCancellation(Cancellation):
+    ''' A cancellation where waiting advances the virtual clock instead of sleeping. '''
+
+    __slots__ = ('_clock', )
+
+    def __init__(self, clock):
+        Cancellation.__init__(self)
+        self._clock = clock
+
+    def wait(self, seconds):
+        if not self.is_cancelled:
+            self._clock.advance(seconds)
+        return self.is_cancelled
+
+
+class SimulatedSensor(object):
+    ''' A sensor that always returns the same value. '''
+
+    def __init__(self, value):
+        self._value = value
+
+    def read(self):
+        return self._value
+
+
+class SimulatedRobot(RobotMock):
+    ''' A mock robot where each action takes the time it would on a real robot.
+
+    Actions are started straight away and finish at a time on the virtual clock. Like the real robot,
+    claiming resources waits for the actions using them, and waiting waits for all the actions. '''
+
+    # How fast the robot speaks (in words per second)
+    SPEECH_RATE = 2.5
+
+    # How fast the robot walks (in metres per second) and turns (in degrees per second)
+    WALK_SPEED = 0.1
+    TURN_SPEED = 30.0
+
+    # The estimated time for actions that do not have a modelled duration (in seconds)
+    BEHAVIOUR_DURATION = 10.0
+    POSTURE_DURATION = 2.0
+    HAND_DURATION = 0.5
+
+    # The posture families for each posture
+    POSTURE_FAMILIES = {
+        'Stand': 'Standing',
+        'StandInit': 'Standing',
+        'StandZero': 'Standing',
+        'Sit': 'Sitting',
+        'SitRelax': 'Sitting',
+        'Crouch': 'Crouching',
+        'LyingBack': 'LyingBack',
+        'LyingBelly': 'LyingBelly',
+    }
+
+    # The sensor values: there are never any obstacles in a simulation
+    SENSOR_VALUES = {
+        'SONAR_LEFT': 5.0,
+        'SONAR_RIGHT': 5.0,
+        'FOOT_LEFT': False,
+        'FOOT_RIGHT': False,
+        'BATTERY': 1.0,
+    }
+
+    def __init__(self, clock, posture='Standing'):
+        self._clock = clock
+        self._posture = posture
+        self._pending = []
+        self._claimed = None
+
+    def claim(self, resources):
+        ''' Claims resources for the next actions, waiting for any actions that use them. '''
+        remaining = []
+        for finish, used in self._pending:
+            if used is None or used & resources:
+                self._clock.advance_to(finish)
+            else:
+                remaining.append((finish, used))
+        self._pending = remaining
+        self._claimed = resources
+        return self
+
+    def wait(self):
+        ''' Waits for all the actions to finish. '''
+        for finish, _ in self._pending:
+            self._clock.advance_to(finish)
+        self._pending = []
+        self._claimed = None
+        return self
+
+    def getPosture(self):
+        return self._posture
+
+    def getSensor(self, name):
+        return SimulatedSensor(SimulatedRobot.SENSOR_VALUES.get(name, 0))
+
+    def goToPosture(self, posture, wait=False):
+        self._posture = SimulatedRobot.POSTURE_FAMILIES.get(posture, posture)
+        return self._start(SimulatedRobot.POSTURE_DURATION, wait)
+
+    def moveHands(self, hands, openHand, wait=False):
+        return self._start(SimulatedRobot.HAND_DURATION, wait)
+
+    def performMovements(self, movements, wait=False):
+        try:
+            _ = iter(movements)
+        except TypeError:
+            movements = [movements]
+
+        duration = 0.0
+        for movement in movements:
+            for times in movement.times():
+                if times:
+                    duration = max(duration, times[-1])
+        return self._start(duration, wait)
+
+    def rest(self):
+        self._posture = 'Crouching'
+        return self._start(SimulatedRobot.POSTURE_DURATION, True)
+
+    def say(self, text, wait=False):
+        words = len(str(text).split())
+        return self._start(max(words, 1) / SimulatedRobot.SPEECH_RATE, wait)
+
+    def startBehaviour(self, behaviour, wait=False, skipCheck=False):
+        return self._start(SimulatedRobot.BEHAVIOUR_DURATION, wait)
+
+    def wakeUp(self):
+        self._posture = 'Standing'
+        return self._start(SimulatedRobot.POSTURE_DURATION, True)
+
+    def walkTo(self, x, y, theta, wait=False, useArms=True):
+        distance = (float(x) ** 2 + float(y) ** 2) ** 0.5
+        duration = distance / SimulatedRobot.WALK_SPEED + abs(float(theta)) / SimulatedRobot.TURN_SPEED
+        return self._start(duration, wait)
+
+    def _start(self, duration, wait):
+        ''' Starts an action that finishes after a duration. '''
+        self._pending.append((self._clock.time() + duration, self._claimed))
+        return self.wait() if wait else self
+
+
+class _Comms(object):
+    ''' Counts the messages sent during a simulation. '''
+
+    def __init__(self):
+        self.count = 0
+
+    def send(self, msg_type, data):
+        self.count += 1
+
+
+def load(path):
+    ''' Loads the nodes of a program from a file. '''
+    with open(path) as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = data['output']['nodes']
+    return data
+
+
+def simulate(nodes, opts=None, backend='tree'):
+    ''' Runs a program on the simulated robot.
+
+    Returns the estimated time the program would take on a robot, the time the simulation took and the
+    number of messages sent (the times are in seconds.) '''
+    from engine import Engine
+
+    clock = VirtualClock()
+    comms = _Comms()
+    engine = Engine(comms, use_robot=False, backend=backend, clock=clock)
+    program = engine.compile(nodes)
+    engine.configure(opts or {})
+    comms.count = 0
+    started = clock.time()
+    start = time.time()
+    engine.run(program)
+    return clock.time() - started, time.time() - start, comms.count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Estimate how long programs take to run on a robot.')
+    parser.add_argument('programs', help='The program files', nargs='+')
+    parser.add_argument('--backend', help='The engine backend to use', choices=['tree', 'vm'], default='vm')
+    parser.add_argument('--delay', help='The delay between blocks (in seconds)', type=float, default=0)
+    args = parser.parse_args()
+    logger.configure(logger.WARNING)
+
+    total_estimate = 0.0
+    total_elapsed = 0.0
+    for path in args.programs:
+        estimate, elapsed, messages = simulate(load(path), {'debug': True, 'delay': args.delay}, args.backend)
+        total_estimate += estimate
+        total_elapsed += elapsed
+        print('%s: estimated %.1fs (simulated in %.3fs, %d messages)' % (path, estimate, elapsed, messages))
+    print('Total: estimated %.1fs (simulated in %.3fs)' % (total_estimate, total_elapsed))
+
+
+if __name__ == '__main__':
+    main()
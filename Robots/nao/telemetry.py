@@ -0,0 +1,137 @@
+''' Provides batched telemetry for sending debug information to the server. '''
+import atexit
+import threading
+import time
+
+import core
+import logger
+
+_log = logger.get_logger('Telemetry')
+
+ROBOT_DEBUG_MESSAGE = 502
+
+# The telemetry levels
+OFF = core.TELEMETRY_OFF
+SUMMARY = core.TELEMETRY_SUMMARY
+FULL = core.TELEMETRY_FULL
+LEVELS = core.TELEMETRY_LEVELS
+
+parse_level = core.parse_telemetry
+
+# The channels with a running flusher thread: these are closed at exit, before the interpreter shuts down
+_running = []
+
+
+class DebugChannel(object):
+    ''' Buffers debug events and sends them to the server as a single message.
+
+    The buffer is flushed when it holds max_events events, when the oldest event is older than
+    interval milliseconds, or when flush() is called (e.g. when a program finishes). The interval is
+    handled by a single flusher thread, and the flushes are serialised so the batches are sent in order. '''
+
+    def __init__(self, comms, max_events=25, interval=250):
+        self._comms = comms
+        self._max_events = max_events
+        self._interval = interval / 1000.0
+        self._events = []
+        self._deadline = None
+        self._condition = threading.Condition()
+        self._send_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+    def record(self, source_id, status, func_name):
+        ''' Adds an event to the buffer. '''
+        event = [source_id, status, func_name, int(time.time() * 1000)]
+        self._condition.acquire()
+        try:
+            self._events.append(event)
+            is_full = len(self._events) >= self._max_events
+            if not is_full and self._deadline is None:
+                self._deadline = time.time() + self._interval
+                if self._thread is None and not self._closed:
+                    self._thread = threading.Thread(target=self._run, name='Telemetry')
+                    self._thread.daemon = True
+                    self._thread.start()
+                    _running.append(self)
+                self._condition.notify()
+        finally:
+            self._condition.release()
+
+        if is_full:
+            self.flush()
+
+    def flush(self):
+        ''' Sends any buffered events. '''
+        self._send_lock.acquire()
+        try:
+            self._condition.acquire()
+            try:
+                events = self._events
+                self._events = []
+                if self._deadline is not None:
+                    # Wake the flusher thread, so it is not left waiting for the old deadline
+                    self._deadline = None
+                    self._condition.notify()
+            finally:
+                self._condition.release()
+
+            if events:
+                self._send(events)
+        finally:
+            self._send_lock.release()
+
+    def close(self):
+        ''' Sends any buffered events and stops the flusher thread. '''
+        self.flush()
+        self._condition.acquire()
+        try:
+            self._closed = True
+            self._condition.notify()
+            thread = self._thread
+        finally:
+            self._condition.release()
+
+        if thread is not None:
+            thread.join(1.0)
+            try:
+                _running.remove(self)
+            except ValueError:
+                pass
+
+    def _run(self):
+        ''' Flushes the buffer when the oldest event reaches the interval. '''
+        self._condition.acquire()
+        try:
+            while not self._closed:
+                if self._deadline is None:
+                    self._condition.wait()
+                    continue
+
+                remaining = self._deadline - time.time()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+
+                self._condition.release()
+                try:
+                    self.flush()
+                finally:
+                    self._condition.acquire()
+        finally:
+            self._condition.release()
+
+    def _send(self, events):
+        _log.debug('Sending %d debug events', len(events))
+        try:
+            # The events are encoded when the message is sent (as JSON or in the binary encoding)
+            self._comms.send(ROBOT_DEBUG_MESSAGE, {'events': events})
+        except Exception as e:
+            _log.warning('Unable to send debug events: %s', e)
+
+
+def _close_all():
+    for channel in list(_running):
+        channel.close()
+
+atexit.register(_close_all)
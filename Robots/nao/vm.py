@@ -0,0 +1,588 @@
+''' Provides a bytecode backend for the execution engine.
+
+The AST is lowered into a flat list of instructions, with jumps for the control flow blocks (if,
+elseif, else, loop and while) and a small stack machine for the expressions. All other functions
+(e.g. the robot actions) are host calls into the engine's functions table. '''
+import logger
+
+_log = logger.get_logger('VM')
+
+# Op codes
+HALT = 0
+ENTER = 1
+LEAVE = 2
+PUSH = 3
+LOAD = 4
+STORE = 5
+ADD_TO = 6
+HOST = 7
+CALL = 8
+RETURN = 9
+DEFINE = 10
+JUMP = 11
+JUMP_IF_NOT_TRUE = 12
+LOOP_INIT = 13
+LOOP_NEXT = 14
+EQUAL = 15
+NOT_EQUAL = 16
+LESS_THAN = 17
+LESS_THAN_EQUAL = 18
+GREATER_THAN = 19
+GREATER_THAN_EQUAL = 20
+NOT = 21
+ROUND = 22
+ERROR = 23
+POP = 24
+
+_COMPARISONS = {
+    'equal': EQUAL,
+    'notEqual': NOT_EQUAL,
+    'lessThan': LESS_THAN,
+    'lessThanEqual': LESS_THAN_EQUAL,
+    'greaterThan': GREATER_THAN,
+    'greaterThanEqual': GREATER_THAN_EQUAL,
+}
+
+_UNARY = {
+    'not': NOT,
+    'round': ROUND,
+}
+
+
+class Region(object):
+    ''' Defines a block of code that is compiled out-of-line (e.g. a function body.)
+
+    A stepped region returns after each of its top level blocks, so it can also be run one block at a
+    time (e.g. an event handler, which takes turns with the other handlers.) Steps holds the entry for
+    each block. '''
+
+    def __init__(self, ast, stepped=False):
+        self.ast = ast
+        self.stepped = stepped
+        self.entry = None
+        self.steps = []
+
+
+class HostState(object):
+    ''' Defines the execution state for a host call, where the arguments have already been evaluated. '''
+
+    def __init__(self, ast, function, args, body):
+        self.function = function
+        self.ast = ast
+        self.parent = None
+        self.args = args
+        self.body = body
+        self.completed = False
+
+    def argument(self, index):
+        ''' Retrieves an evaluated argument. '''
+        return self.args[index]
+
+    def complete(self):
+        ''' Marks the state as completed. '''
+        self.completed = True
+
+
+class Compiler(object):
+    ''' Lowers an AST into a flat list of instructions. '''
+
+    def __init__(self, engine):
+        self._engine = engine
+        self._code = []
+        self._regions = []
+        self._tasks = []
+        self._lowered = {
+            'loop': self._loop,
+            'while': self._while,
+            'variable': self._variable,
+            'addTo': self._add_to,
+            'function': self._function_definition,
+            'if': self._single_clause,
+            'elseif': self._single_clause,
+            'else': self._single_clause,
+        }
+
+    def compile(self, ast):
+        ''' Compiles a program and returns the instructions. '''
+        self._block(ast, True)
+        self._drain(0)
+        self._emit(HALT)
+
+        # Out-of-line bodies can contain further bodies, so keep going until they are all done
+        pos = 0
+        while pos < len(self._regions):
+            region = self._regions[pos]
+            region.entry = len(self._code)
+            if region.stepped:
+                for block in region.ast or []:
+                    region.steps.append(len(self._code))
+                    self._block([block], False)
+                    self._drain(0)
+                    self._emit(RETURN)
+            else:
+                self._block(region.ast, False)
+                self._drain(0)
+            if not region.steps:
+                self._emit(RETURN)
+            pos += 1
+
+        _log.info('Compiled %d instructions', len(self._code))
+        return self._code
+
+    def _emit(self, op, arg=None):
+        self._code.append((op, arg))
+        return len(self._code) - 1
+
+    def _patch(self, pos, op, target=None):
+        self._code[pos] = (op, len(self._code) if target is None else target)
+
+    def _defer(self, ast, stepped=False):
+        region = Region(ast, stepped)
+        self._regions.append(region)
+        return region
+
+    def _block(self, ast, top_level):
+        ''' Schedules the nodes in a block for compilation.
+
+Nested blocks are compiled from a task stack rather than recursively, so deeply nested programs do
+not hit the recursion limit. As the stack is last in, first out, any work that must happen after
+the block needs to be scheduled (using _then) before calling this method. '''
+        for block in reversed(ast or []):
+            self._tasks.append((block, top_level))
+
+    def _then(self, task):
+        self._tasks.append(task)
+
+    def _drain(self, mark):
+        while len(self._tasks) > mark:
+            task = self._tasks.pop()
+            if isinstance(task, tuple):
+                self._node(task[0], task[1], False)
+            else:
+                task()
+
+    def _node(self, block, top_level, result):
+        node_type = block['type']
+        if node_type == 'Function':
+            self._function(block, top_level, result)
+        elif node_type == 'Compound':
+            if result:
+                self._then(self._push_none)
+            self._compound(block)
+        else:
+            self._emit(ERROR, 'Unknown node type: %s' % (node_type, ))
+            if result:
+                self._emit(PUSH, None)
+
+    def _push_none(self):
+        self._emit(PUSH, None)
+
+    def _function(self, block, top_level, result):
+        func_name = block['token']['value']
+        args = block.get('arguments') or []
+        debug = (block.get('sourceId'), func_name, not top_level)
+        func = self._engine._builtins.get(func_name)
+        if func is None:
+            # Custom functions are only added when their definition runs, so these are resolved at run time
+            self._emit(CALL, (func_name, debug))
+            if result:
+                self._emit(PUSH, None)
+            return
+
+        if func.top_level and not top_level:
+            self._emit(ERROR, 'Function ' + func_name + ' cannot be executed here')
+            if result:
+                self._emit(PUSH, None)
+            return
+
+        if func_name in _COMPARISONS and len(args) >= 2:
+            self._emit(ENTER, debug)
+            start = len(self._code)
+            self._expression(args[0])
+            self._expression(args[1])
+            if not self._fold(func, block, start):
+                self._emit(_COMPARISONS[func_name])
+            self._emit(LEAVE, debug)
+            if not result:
+                self._emit(POP)
+            return
+
+        if func_name in _UNARY and len(args) >= 1:
+            self._emit(ENTER, debug)
+            start = len(self._code)
+            self._expression(args[0])
+            if not self._fold(func, block, start):
+                self._emit(_UNARY[func_name])
+            self._emit(LEAVE, debug)
+            if not result:
+                self._emit(POP)
+            return
+
+        try:
+            lower = self._lowered[func_name]
+        except KeyError:
+            lower = None
+        mark = len(self._tasks)
+        if lower is not None and lower(block, args, debug):
+            if result:
+                self._tasks.insert(mark, self._push_none)
+            return
+
+        self._emit(ENTER, debug)
+        for arg in args:
+            self._expression(arg)
+        children = block.get('children')
+        body = self._defer(children, True) if children else None
+        self._emit(HOST, (func, len(args), body, block, result))
+        self._emit(LEAVE, debug)
+
+    def _fold(self, func, block, start):
+        ''' Replaces the arguments of a pure function with its result, if they are all constants. '''
+        code = self._code[start:]
+        if not func.pure or any(op != PUSH for op, _ in code):
+            return False
+
+        try:
+            value = func.execute(HostState(block, block['token']['value'], [arg for _, arg in code], None))
+        except Exception:
+            # Leave any errors until the block is run
+            return False
+
+        del self._code[start:]
+        self._emit(PUSH, value)
+        return True
+
+    def _expression(self, node):
+        node_type = node['token']['type']
+        node_value = node['token']['value']
+        if node_type == 'Text' or node_type == 'Constant':
+            self._emit(PUSH, str(node_value))
+        elif node_type == 'Number':
+            self._emit(PUSH, float(node_value))
+        elif node_type == 'Boolean':
+            self._emit(PUSH, node_value == 'TRUE')
+        elif node_type == 'Colour':
+            self._emit(PUSH, '#' + str(node_value))
+        elif node_type == 'Identifier':
+            # The value must be on the stack before the caller continues, so finish it now
+            mark = len(self._tasks)
+            self._node(node, False, True)
+            self._drain(mark)
+        elif node_type == 'Variable':
+            self._emit(LOAD, self._engine._variable_slot(node_value))
+        else:
+            _log.warning('Unknown expression type: %s', node_type)
+            self._emit(PUSH, None)
+
+    def _compound(self, block):
+        exits = []
+
+        def _patch_exits():
+            for pos in exits:
+                self._patch(pos, JUMP)
+
+        self._then(_patch_exits)
+        for clause in reversed(block.get('children') or []):
+            name = clause['token']['value']
+            args = clause.get('arguments') or []
+            if (name == 'if' or name == 'elseif') and args:
+                self._clause(clause, args[0], exits)
+            else:
+                self._tasks.append((clause, False))
+
+    def _clause(self, clause, condition, exits):
+        ''' Schedules a conditional clause in a compound. '''
+        debug = (clause.get('sourceId'), clause['token']['value'], True)
+        skip = []
+
+        def _start_clause():
+            self._emit(ENTER, debug)
+            self._expression(condition)
+            skip.append(self._emit(JUMP_IF_NOT_TRUE))
+
+        def _finish_clause():
+            self._emit(LEAVE, debug)
+            exits.append(self._emit(JUMP))
+            self._patch(skip[0], JUMP_IF_NOT_TRUE)
+            self._emit(LEAVE, debug)
+
+        self._then(_finish_clause)
+        self._block(clause.get('children'), False)
+        self._then(_start_clause)
+
+    def _single_clause(self, block, args, debug):
+        ''' Lowers an if, elseif or else block that is not part of a compound. '''
+        if block['token']['value'] == 'else':
+            self._emit(ENTER, debug)
+            self._then(lambda: self._emit(LEAVE, debug))
+            self._block(block.get('children'), False)
+            return True
+
+        if not args:
+            return False
+        self._compound({'children': [block]})
+        return True
+
+    def _loop(self, block, args, debug):
+        if not args:
+            return False
+        self._emit(ENTER, debug)
+        self._expression(args[0])
+        self._emit(LOOP_INIT)
+        start = self._emit(LOOP_NEXT)
+
+        def _finish_loop():
+            self._emit(JUMP, start)
+            self._patch(start, LOOP_NEXT)
+            self._emit(LEAVE, debug)
+
+        self._then(_finish_loop)
+        self._block(block.get('children'), False)
+        return True
+
+    def _while(self, block, args, debug):
+        if not args:
+            return False
+        self._emit(ENTER, debug)
+        start = len(self._code)
+        self._expression(args[0])
+        exit_jump = self._emit(JUMP_IF_NOT_TRUE)
+
+        def _finish_while():
+            self._emit(JUMP, start)
+            self._patch(exit_jump, JUMP_IF_NOT_TRUE)
+            self._emit(LEAVE, debug)
+
+        self._then(_finish_while)
+        self._block(block.get('children'), False)
+        return True
+
+    def _variable(self, block, args, debug):
+        if len(args) < 2:
+            return False
+        self._emit(ENTER, debug)
+        self._expression(args[1])
+        self._emit(STORE, self._slot(args[0]))
+        self._emit(LEAVE, debug)
+        return True
+
+    def _add_to(self, block, args, debug):
+        if len(args) < 2:
+            return False
+        self._emit(ENTER, debug)
+        self._expression(args[1])
+        self._emit(ADD_TO, self._slot(args[0]))
+        self._emit(LEAVE, debug)
+        return True
+
+    def _slot(self, node):
+        ''' Resolves a variable node to its slot and name. '''
+        name = node['token']['value']
+        return (self._engine._variable_slot(name), name)
+
+    def _function_definition(self, block, args, debug):
+        if not args:
+            return False
+        self._emit(ENTER, debug)
+        self._emit(DEFINE, (args[0]['token']['value'], self._defer(block.get('children'))))
+        self._emit(LEAVE, debug)
+        return True
+
+
+class Machine(object):
+    ''' Executes the instructions generated by a Compiler. '''
+
+    def __init__(self, engine, code):
+        self._engine = engine
+        self._defined = {}
+        self._code = []
+        for op, arg in code:
+            if op == HOST and arg[2] is not None:
+                arg = (arg[0], arg[1], self._stepped_subroutine(arg[2].steps), arg[3], arg[4])
+            elif op == DEFINE:
+                arg = (arg[0], arg[1].entry)
+            self._code.append((op, arg))
+
+    def execute(self, state):
+        ''' Executes the program from the start. '''
+        self._defined = {}
+        self.run(0)
+
+    def _subroutine(self, entry):
+        ''' Generates a closure that runs a block of code as if it were a compiled block. '''
+        def _run_subroutine(state):
+            self.run(entry)
+        return _run_subroutine
+
+    def _stepped_subroutine(self, entries):
+        ''' Generates a closure that runs a stepped region, with the steps to run each block on its own. '''
+        steps = [self._subroutine(entry) for entry in entries]
+        engine = self._engine
+
+        def _run_steps(state):
+            for step in steps:
+                if engine.is_cancelled:
+                    break
+                step(state)
+
+        _run_steps.steps = steps
+        return _run_steps
+
+    def run(self, pc):
+        ''' Runs the instructions from pc until the code halts, returns or is cancelled.
+
+When profiling, any blocks still open when the run stops early (cancelled or an error) are closed, so the
+profiler stack stays balanced. '''
+        profiler = self._engine._profiler
+        if profiler is None:
+            self._execute(pc, None)
+            return
+        opened = []
+        try:
+            self._execute(pc, opened)
+        finally:
+            while opened:
+                debug = opened.pop()
+                profiler.leave(debug[1], debug[0])
+
+    def _execute(self, pc, opened):
+        ''' Executes the instructions from pc, keeping the blocks entered in opened (when profiling.) '''
+        engine = self._engine
+        code = self._code
+        stack = []
+        frames = []
+        push = stack.append
+        pop = stack.pop
+        profiler = engine._profiler
+        # Event handlers give up their turn at each block and jump back, so a long loop does not hold up the others
+        checkpoint = engine._scheduler.checkpoint if engine._local.in_task else None
+        while True:
+            op, arg = code[pc]
+            pc += 1
+            if op == ENTER:
+                if engine.is_cancelled:
+                    return
+                if checkpoint is not None:
+                    checkpoint()
+                _log.debug('Executing function "%s"', arg[1])
+                if profiler is not None:
+                    profiler.enter()
+                    opened.append(arg)
+                engine._debug(arg[0], arg[1], 'start')
+            elif op == LEAVE:
+                if arg[2]:
+                    engine._do_delay()
+                engine._debug(arg[0], arg[1], 'end')
+                if profiler is not None:
+                    opened.pop()
+                    profiler.leave(arg[1], arg[0])
+            elif op == PUSH:
+                push(arg)
+            elif op == LOAD:
+                push(engine._read_variable(arg))
+            elif op == JUMP:
+                if engine.is_cancelled:
+                    return
+                if checkpoint is not None and arg < pc:
+                    checkpoint()
+                pc = arg
+            elif op == JUMP_IF_NOT_TRUE:
+                if pop() is not True:
+                    pc = arg
+            elif op == LOOP_NEXT:
+                index = stack[-1]
+                if engine.is_cancelled:
+                    return
+                if index >= stack[-2]:
+                    del stack[-2:]
+                    pc = arg
+                else:
+                    engine._change_state('loop', index)
+                    stack[-1] = index + 1
+            elif op == HOST:
+                func, count, body, block, result = arg
+                if count:
+                    args = stack[-count:]
+                    del stack[-count:]
+                else:
+                    args = []
+                value = func.execute(HostState(block, block['token']['value'], args, body))
+                if result:
+                    push(value)
+            elif op == STORE:
+                value = pop()
+                engine._variables[arg[0]] = value
+                engine._change_state(arg[1], value)
+            elif op == ADD_TO:
+                engine._increase_variable(arg[0], pop())
+            elif op == EQUAL:
+                value = pop()
+                stack[-1] = stack[-1] == value
+            elif op == LESS_THAN:
+                value = pop()
+                stack[-1] = stack[-1] < value
+            elif op == NOT:
+                stack[-1] = not stack[-1]
+            elif op == ROUND:
+                stack[-1] = round(stack[-1], 0)
+            elif op == NOT_EQUAL:
+                value = pop()
+                stack[-1] = stack[-1] != value
+            elif op == LESS_THAN_EQUAL:
+                value = pop()
+                stack[-1] = stack[-1] <= value
+            elif op == GREATER_THAN:
+                value = pop()
+                stack[-1] = stack[-1] > value
+            elif op == GREATER_THAN_EQUAL:
+                value = pop()
+                stack[-1] = stack[-1] >= value
+            elif op == LOOP_INIT:
+                stack[-1] = int(stack[-1])
+                push(0)
+            elif op == CALL:
+                name, debug = arg
+                func = engine._functions.get(name)
+                if func is None:
+                    engine._error('Unknown function: ' + name)
+                    continue
+                _log.debug('Executing function "%s"', name)
+                if profiler is not None:
+                    profiler.enter()
+                    opened.append(debug)
+                engine._debug(debug[0], debug[1], 'start')
+                defined = self._defined.get(name)
+                if defined is not None and defined[0] is func:
+                    engine._check_depth(len(frames))
+                    frames.append((pc, debug))
+                    pc = defined[1]
+                else:
+                    # Not defined by this program, so treat it as a host function
+                    func.execute(HostState(None, name, [], None))
+                    if debug[2]:
+                        engine._do_delay()
+                    engine._debug(debug[0], debug[1], 'end')
+                    if profiler is not None:
+                        opened.pop()
+                        profiler.leave(debug[1], debug[0])
+            elif op == RETURN:
+                if not frames:
+                    return
+                pc, debug = frames.pop()
+                if debug[2]:
+                    engine._do_delay()
+                engine._debug(debug[0], debug[1], 'end')
+                if profiler is not None:
+                    opened.pop()
+                    profiler.leave(debug[1], debug[0])
+            elif op == DEFINE:
+                name, entry = arg
+                func = engine._add_function(name, self._subroutine(entry))
+                if func is not None:
+                    self._defined[name] = (func, entry)
+            elif op == POP:
+                pop()
+            elif op == ERROR:
+                engine._error(arg)
+            elif op == HALT:
+                return
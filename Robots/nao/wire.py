@@ -0,0 +1,269 @@
+''' Provides the compact binary encoding for the high-frequency robot messages.
+
+The state updates (501) and debug messages (502) make up most of the traffic to the server, so when the
+server supports it (this is negotiated when the robot authenticates) they are sent as binary frames
+instead of JSON. Every other message is still sent as JSON, and the server only sends JSON.
+
+A frame is:
+* the format version (1 byte) and flags (1 byte, RESET clears the string table)
+* the message type (uint16) and the conversation id (varint)
+* the new strings for the string table (a varint count, then each string as a varint length and UTF-8)
+* the body: for a state update, a varint count then each value as a string id and a tagged value; for
+  debug events, a varint count then the source id, status and function of each event as tagged values,
+  and the time as a zigzag varint (the difference from the previous event's time)
+
+The names, source ids, statuses and functions are added to the table the first time they are sent, so
+they are only sent once per program: the table is cleared at the start of each program. Other string
+values (e.g. text a program builds) are always sent in full, so they do not grow the table. All the
+numbers are little endian.
+'''
+import json
+import struct
+
+# The name of the format, as negotiated with the server
+FORMAT = 'binary1'
+VERSION = 1
+
+# The frame flags
+RESET = 1
+
+# The message types that can be encoded
+ROBOT_STATE_UPDATE = 501
+ROBOT_DEBUG_MESSAGE = 502
+
+# The value tags
+NULL = 0
+TRUE = 1
+FALSE = 2
+INTEGER = 3
+FLOAT = 4
+STRING = 5
+INTERNED = 6
+
+# The longest name (or source id or function) that is added to the string table: longer strings are sent
+# in full each time
+MAX_INTERNED = 64
+
+_HEADER = struct.Struct('<BBH')
+_FLOAT = struct.Struct('<d')
+
+try:
+    _TEXT = (str, unicode)
+    _INTEGERS = (int, long)
+except NameError:
+    _TEXT = (str, )
+    _INTEGERS = (int, )
+
+
+def _utf8(text):
+    return text if isinstance(text, bytes) else text.encode('utf-8')
+
+
+def _write_varint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _write_signed(out, value):
+    _write_varint(out, value * 2 if value >= 0 else -value * 2 - 1)
+
+
+def _read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _read_signed(data, pos):
+    value, pos = _read_varint(data, pos)
+    return (value >> 1) if not value & 1 else -((value + 1) >> 1), pos
+
+
+class Encoder(object):
+    ''' Encodes messages as binary frames.
+
+    The string table is shared by all the frames, so they must be sent in the order they were encoded:
+    if a frame is lost (e.g. the socket write failed), call reset() so the next frame starts a new table. '''
+
+    def __init__(self):
+        self._strings = {}
+        self._reset = True
+
+    def reset(self):
+        ''' Clears the string table before the next frame. This can be called from any thread. '''
+        self._reset = True
+
+    def encode(self, msg_type, conversation_id, values):
+        ''' Encodes a message. Returns None if the message cannot be encoded (it must be sent as JSON.) '''
+        if msg_type == ROBOT_STATE_UPDATE:
+            body = self._encode_values
+        elif msg_type == ROBOT_DEBUG_MESSAGE and 'events' in values:
+            body = self._encode_events
+        else:
+            return None
+
+        flags = 0
+        if self._reset:
+            self._reset = False
+            self._strings = {}
+            flags = RESET
+
+        new_strings = []
+        out = bytearray()
+        body(out, values, new_strings)
+
+        frame = bytearray(_HEADER.pack(VERSION, flags, msg_type))
+        _write_varint(frame, conversation_id or 0)
+        _write_varint(frame, len(new_strings))
+        for text in new_strings:
+            _write_varint(frame, len(text))
+            frame.extend(text)
+        frame.extend(out)
+        return bytes(frame)
+
+    def _intern(self, out, text, new_strings):
+        ''' Writes the id for a string, adding it to the table if it is new. '''
+        try:
+            _write_varint(out, self._strings[text])
+        except KeyError:
+            index = len(self._strings)
+            self._strings[text] = index
+            new_strings.append(_utf8(text))
+            _write_varint(out, index)
+
+    def _encode_value(self, out, value, new_strings, interned=False):
+        ''' Writes a tagged value. Only interned values (names, source ids and functions) can be added to
+the string table: the other strings are written in full. '''
+        if value is None:
+            out.append(NULL)
+        elif value is True:
+            out.append(TRUE)
+        elif value is False:
+            out.append(FALSE)
+        elif isinstance(value, _INTEGERS):
+            out.append(INTEGER)
+            _write_signed(out, value)
+        elif isinstance(value, float):
+            out.append(FLOAT)
+            out.extend(_FLOAT.pack(value))
+        else:
+            if not isinstance(value, _TEXT):
+                value = json.dumps(value)
+            if interned and len(value) <= MAX_INTERNED:
+                out.append(INTERNED)
+                self._intern(out, value, new_strings)
+            else:
+                out.append(STRING)
+                text = _utf8(value)
+                _write_varint(out, len(text))
+                out.extend(text)
+
+    def _encode_values(self, out, values, new_strings):
+        _write_varint(out, len(values))
+        for key, value in values.items():
+            self._intern(out, key, new_strings)
+            self._encode_value(out, value, new_strings)
+
+    def _encode_events(self, out, values, new_strings):
+        events = values['events']
+        if isinstance(events, _TEXT):
+            events = json.loads(events)
+        _write_varint(out, len(events))
+        last_time = 0
+        for source_id, status, func_name, event_time in events:
+            self._encode_value(out, source_id, new_strings, True)
+            self._encode_value(out, status, new_strings, True)
+            self._encode_value(out, func_name, new_strings, True)
+            _write_signed(out, event_time - last_time)
+            last_time = event_time
+
+
+class Decoder(object):
+    ''' Decodes binary frames into messages (in the same form as the JSON messages.)
+
+    The client never receives binary frames: this is the reference for the server's decoder, and is used
+    by the encoding benchmark. '''
+
+    def __init__(self):
+        self._strings = []
+
+    def decode(self, data):
+        ''' Decodes a frame into a message. '''
+        data = bytearray(data)
+        version, flags, msg_type = _HEADER.unpack_from(bytes(data[:_HEADER.size]))
+        if version != VERSION:
+            raise ValueError('Unknown frame version ' + str(version))
+        if flags & RESET:
+            self._strings = []
+
+        pos = _HEADER.size
+        conversation_id, pos = _read_varint(data, pos)
+        count, pos = _read_varint(data, pos)
+        for _ in range(count):
+            length, pos = _read_varint(data, pos)
+            self._strings.append(bytes(data[pos:pos + length]).decode('utf-8'))
+            pos += length
+
+        if msg_type == ROBOT_STATE_UPDATE:
+            values = {}
+            count, pos = _read_varint(data, pos)
+            for _ in range(count):
+                index, pos = _read_varint(data, pos)
+                values[self._strings[index]], pos = self._decode_value(data, pos)
+        elif msg_type == ROBOT_DEBUG_MESSAGE:
+            events = []
+            count, pos = _read_varint(data, pos)
+            last_time = 0
+            for _ in range(count):
+                source_id, pos = self._decode_value(data, pos)
+                status, pos = self._decode_value(data, pos)
+                func_name, pos = self._decode_value(data, pos)
+                delta, pos = _read_signed(data, pos)
+                last_time += delta
+                events.append([source_id, status, func_name, last_time])
+            values = {'events': events}
+        else:
+            raise ValueError('Unknown message type ' + str(msg_type))
+        return {'type': msg_type, 'conversationId': conversation_id, 'values': values}
+
+    def _decode_value(self, data, pos):
+        tag = data[pos]
+        pos += 1
+        if tag == NULL:
+            return None, pos
+        if tag == TRUE:
+            return True, pos
+        if tag == FALSE:
+            return False, pos
+        if tag == INTEGER:
+            return _read_signed(data, pos)
+        if tag == FLOAT:
+            return _FLOAT.unpack_from(bytes(data[pos:pos + _FLOAT.size]))[0], pos + _FLOAT.size
+        if tag == INTERNED:
+            index, pos = _read_varint(data, pos)
+            return self._strings[index], pos
+        if tag == STRING:
+            length, pos = _read_varint(data, pos)
+            return bytes(data[pos:pos + length]).decode('utf-8'), pos + length
+        raise ValueError('Unknown value tag ' + str(tag))
+
+
+def encode_json(msg_type, conversation_id, values):
+    ''' Encodes a message as JSON. Debug events are sent as a JSON encoded string. '''
+    events = values.get('events') if msg_type == ROBOT_DEBUG_MESSAGE else None
+    if events is not None and not isinstance(events, _TEXT):
+        values = dict(values)
+        values['events'] = json.dumps(events)
+    return json.dumps({
+        'type': msg_type,
+        'conversationId': conversation_id,
+        'values': values
+    })
@@ -0,0 +1,72 @@
+''' Provides a worker that runs jobs in order on a single long-lived thread. '''
+from collections import deque
+import threading
+
+import logger
+
+_log = logger.get_logger('Worker')
+
+
+class Worker(object):
+    ''' Runs jobs one at a time, in the order they were submitted, on a single thread.
+
+    The thread is started with the first job and then kept for the life of the worker, so submitting a
+    job never blocks the caller and never starts another thread. '''
+
+    def __init__(self, name):
+        self.name = name
+        self._condition = threading.Condition()
+        self._jobs = deque()
+        self._thread = None
+        self._closed = False
+
+    def submit(self, func, *args):
+        ''' Adds a job to the end of the queue. '''
+        self._condition.acquire()
+        try:
+            if self._closed:
+                _log.warning('Worker %s is closed, ignoring job', self.name)
+                return
+            self._jobs.append((func, args))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def pending(self):
+        ''' Retrieves the number of jobs waiting to run. '''
+        self._condition.acquire()
+        try:
+            return len(self._jobs)
+        finally:
+            self._condition.release()
+
+    def close(self):
+        ''' Stops the worker once the current job has finished: any queued jobs are discarded. '''
+        self._condition.acquire()
+        try:
+            self._closed = True
+            self._jobs.clear()
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def _run(self):
+        while True:
+            self._condition.acquire()
+            try:
+                while not self._jobs and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                func, args = self._jobs.popleft()
+            finally:
+                self._condition.release()
+
+            try:
+                func(*args)
+            except Exception as e:
+                _log.error('Job in %s failed: %s', self.name, e)
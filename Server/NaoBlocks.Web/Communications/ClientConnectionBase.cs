@@ -55,6 +55,14 @@ namespace NaoBlocks.Web.Communications
         /// </summary>
         public ClientStatus Status { get; protected set; } = new ClientStatus();
 
+        /// <summary>
+        /// Gets whether this connection can receive binary encoded messages.
+        /// </summary>
+        public virtual bool SupportsBinaryEncoding
+        {
+            get { return false; }
+        }
+
         /// <summary>
         /// Gets the type of connection.
         /// </summary>
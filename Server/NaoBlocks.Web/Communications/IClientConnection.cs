@@ -49,6 +49,11 @@ namespace NaoBlocks.Web.Communications
         /// </summary>
         ClientStatus Status { get; }
 
+        /// <summary>
+        /// Gets whether this connection can receive binary encoded messages (see <see cref="BinaryMessageDecoder"/>.)
+        /// </summary>
+        bool SupportsBinaryEncoding { get; }
+
         /// <summary>
         /// Gets the type of connection.
         /// </summary>
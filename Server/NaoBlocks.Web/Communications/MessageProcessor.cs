@@ -5,6 +5,7 @@ using NaoBlocks.Engine.Data;
 using NaoBlocks.Engine.Queries;
 using System.Globalization;
 using System.IdentityModel.Tokens.Jwt;
+using System.Text.Json;
 
 namespace NaoBlocks.Web.Communications
 {
@@ -35,8 +36,8 @@ namespace NaoBlocks.Web.Communications
                 { ClientMessageType.StopProgram, this.StopProgram },
                 { ClientMessageType.ProgramDownloaded, this.ProgramDownloaded },
                 { ClientMessageType.ProgramStarted, this.BroadcastMessage(ClientMessageType.ProgramStarted, "Program started") },
-                { ClientMessageType.ProgramFinished, this.BroadcastMessage(ClientMessageType.ProgramFinished, "Program finished") },
-                { ClientMessageType.ProgramStopped, this.BroadcastMessage(ClientMessageType.ProgramStopped, "Program stopped") },
+                { ClientMessageType.ProgramFinished, this.BroadcastMessage(ClientMessageType.ProgramFinished, "Program finished", true) },
+                { ClientMessageType.ProgramStopped, this.BroadcastMessage(ClientMessageType.ProgramStopped, "Program stopped", true) },
                 { ClientMessageType.RobotDebugMessage, this.RobotDebugMessage },
                 { ClientMessageType.RobotError, this.BroadcastMessage(ClientMessageType.RobotError, "An unexpected error has occurred", true) },
                 { ClientMessageType.RobotStateUpdate, this.UpdateRobotState },
@@ -166,6 +167,15 @@ namespace NaoBlocks.Web.Communications
             }
         }
 
+        /// <summary>
+        /// Checks whether a client has offered an encoding (the encodings are a comma separated list.)
+        /// </summary>
+        private static bool SupportsEncoding(ClientMessage message, string encoding)
+        {
+            if (!message.Values.TryGetValue("encodings", out string? encodings)) return false;
+            return encodings.Split(',').Any(e => e.Trim() == encoding);
+        }
+
         /// <summary>
         /// Validates and executes a command.
         /// </summary>
@@ -442,7 +452,13 @@ namespace NaoBlocks.Web.Communications
 
             client.LogMessage(msg);
             this.hub.SendToMonitors(msg);
-            client.SendMessage(GenerateResponse(message, ClientMessageType.Authenticated));
+            var response = GenerateResponse(message, ClientMessageType.Authenticated);
+            if (userSession.IsRobot && client.SupportsBinaryEncoding && SupportsEncoding(message, BinaryMessageDecoder.Format))
+            {
+                response.Values["encoding"] = BinaryMessageDecoder.Format;
+            }
+
+            client.SendMessage(response);
         }
 
         /// <summary>
@@ -545,6 +561,11 @@ namespace NaoBlocks.Web.Communications
             {
                 { "ProgramId", client.RobotDetails?.LastProgramId?.ToString(CultureInfo.InvariantCulture) ?? "0" }
             };
+            if (message.Values.TryGetValue("diagnostics", out string? diagnostics) && !string.IsNullOrWhiteSpace(diagnostics))
+            {
+                valuesToCopy["diagnostics"] = diagnostics;
+            }
+
             await this.DoBroadcastMessage(engine, client, message, ClientMessageType.ProgramTransferred, "Program has been transferred", valuesToCopy);
         }
 
@@ -585,14 +606,17 @@ namespace NaoBlocks.Web.Communications
         /// </summary>
         private async Task RobotDebugMessage(IExecutionEngine engine, IClientConnection client, ClientMessage message)
         {
-            await this.DoBroadcastMessage(engine, client, message, ClientMessageType.RobotDebugMessage, "Debug information received", message.Values);
-            if (client.RobotDetails != null)
+            if (message.Values.TryGetValue("events", out string? events))
             {
-                if (message.Values.TryGetValue("sourceID", out string? sourceId) && !string.IsNullOrWhiteSpace(sourceId))
+                foreach (var values in UnpackDebugEvents(events))
                 {
-                    client.RobotDetails.SourceIds.Add(sourceId);
+                    await this.RecordDebugMessage(engine, client, message, values);
                 }
             }
+            else
+            {
+                await this.RecordDebugMessage(engine, client, message, message.Values);
+            }
 
             if (client.RobotDetails != null)
             {
@@ -600,6 +624,57 @@ namespace NaoBlocks.Web.Communications
             }
         }
 
+        /// <summary>
+        /// Broadcasts a single debug event and records the source ID.
+        /// </summary>
+        private async Task RecordDebugMessage(IExecutionEngine engine, IClientConnection client, ClientMessage message, IDictionary<string, string> values)
+        {
+            await this.DoBroadcastMessage(engine, client, message, ClientMessageType.RobotDebugMessage, "Debug information received", values);
+            if (client.RobotDetails != null)
+            {
+                if (values.TryGetValue("sourceID", out string? sourceId) && !string.IsNullOrWhiteSpace(sourceId))
+                {
+                    client.RobotDetails.SourceIds.Add(sourceId);
+                }
+            }
+        }
+
+        /// <summary>
+        /// Unpacks a batch of debug events.
+        /// </summary>
+        /// <param name="events">The JSON encoded events: each event is an array of source ID, status, function and time.</param>
+        /// <returns>The values for each event.</returns>
+        private IEnumerable<IDictionary<string, string>> UnpackDebugEvents(string? events)
+        {
+            if (string.IsNullOrWhiteSpace(events)) return Array.Empty<IDictionary<string, string>>();
+
+            JsonElement[][]? items;
+            try
+            {
+                items = JsonSerializer.Deserialize<JsonElement[][]>(events);
+            }
+            catch (JsonException error)
+            {
+                this.Logger.LogWarning($"Unable to unpack debug events: {error.Message}");
+                return Array.Empty<IDictionary<string, string>>();
+            }
+
+            var output = new List<IDictionary<string, string>>();
+            foreach (var item in items ?? Array.Empty<JsonElement[]>())
+            {
+                var values = new Dictionary<string, string>();
+                var names = new[] { "sourceID", "status", "function", "time" };
+                for (var loop = 0; loop < Math.Min(names.Length, item.Length); loop++)
+                {
+                    values[names[loop]] = item[loop].ToString();
+                }
+
+                output.Add(values);
+            }
+
+            return output;
+        }
+
         /// <summary>
         /// Attempts to start a conversation for the message stream.
         /// </summary>
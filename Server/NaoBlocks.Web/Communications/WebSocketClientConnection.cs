@@ -10,6 +10,7 @@ namespace NaoBlocks.Web.Communications
         : ClientConnectionBase, IClientConnection, IStartableClientConnection
     {
         private readonly CancellationTokenSource cancellationSource = new();
+        private readonly BinaryMessageDecoder decoder = new();
         private readonly ILogger<WebSocketClientConnection> logger;
         private readonly IMessageProcessor messageProcessor;
         private readonly WebSocket socket;
@@ -30,6 +31,14 @@ namespace NaoBlocks.Web.Communications
             this.logger = logger;
         }
 
+        /// <summary>
+        /// Gets whether this connection can receive binary encoded messages.
+        /// </summary>
+        public override bool SupportsBinaryEncoding
+        {
+            get { return true; }
+        }
+
         /// <summary>
         /// Closes the connection.
         /// </summary>
@@ -69,7 +78,10 @@ namespace NaoBlocks.Web.Communications
 
                     if (message.Any())
                     {
-                        var msg = ClientMessage.FromArray(message.ToArray());
+                        var data = message.ToArray();
+                        var msg = response.MessageType == WebSocketMessageType.Binary && BinaryMessageDecoder.IsBinary(data)
+                            ? this.decoder.Decode(data)
+                            : ClientMessage.FromArray(data);
                         await this.messageProcessor.ProcessAsync(this, msg);
                     }
                 }
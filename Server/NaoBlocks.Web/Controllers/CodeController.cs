@@ -1,11 +1,15 @@
 ﻿using Microsoft.AspNetCore.Authorization;
 using Microsoft.AspNetCore.Mvc;
+using Microsoft.Net.Http.Headers;
 using NaoBlocks.Common;
 using NaoBlocks.Engine;
 using NaoBlocks.Engine.Commands;
 using NaoBlocks.Engine.Queries;
 using NaoBlocks.Web.Authorization;
 using NaoBlocks.Web.Helpers;
+using System.Net;
+using System.Security.Cryptography;
+using System.Text;
 using System.Text.Json;
 using System.Text.Json.Serialization;
 using Data = NaoBlocks.Engine.Data;
@@ -95,7 +99,10 @@ namespace NaoBlocks.Web.Controllers
         /// </summary>
         /// <param name="user">The user to retrieve the program for.</param>
         /// <param name="program">The identifier of the program.</param>
-        /// <returns>A <see cref="Transfer.CompiledCodeProgram"/> instance containing the compiled program.</returns>
+        /// <returns>A <see cref="Transfer.CompiledCodeProgram"/> instance containing the compiled program, or a 304 (not modified) if the If-None-Match header matches the ETag.</returns>
+        /// <remarks>
+        /// The ETag is set on both responses, and If-None-Match is matched using the weak comparison from RFC 7232.
+        /// </remarks>
         [HttpGet("{user}/{program}")]
         [RequireTeacherOrRobot]
         public async Task<ActionResult<ExecutionResult<Transfer.CompiledCodeProgram?>>> Get(string user, long program)
@@ -114,6 +121,14 @@ namespace NaoBlocks.Web.Controllers
                 .ConfigureAwait(false);
             if (programDetails == null) return NotFound();
 
+            var etag = GenerateETag(programDetails.Code);
+            if (this.Response != null) this.Response.Headers[HeaderNames.ETag] = etag;
+            if (MatchesETag(this.Request, etag))
+            {
+                this._logger.LogInformation("Program {program} for {user} has not changed", program, user);
+                return StatusCode((int)HttpStatusCode.NotModified);
+            }
+
             this._logger.LogInformation("Compiling code");
             var compileCommand = new CompileCode
             {
@@ -123,5 +138,39 @@ namespace NaoBlocks.Web.Controllers
                 compileCommand,
                 Transfer.CompiledCodeProgram.FromModel);
         }
+
+        /// <summary>
+        /// Generates the ETag for a program.
+        /// </summary>
+        /// <param name="code">The code of the program.</param>
+        /// <returns>The ETag (including quotes.)</returns>
+        /// <remarks>
+        /// The version is included, so any change to the compiler invalidates the cached programs.
+        /// </remarks>
+        private static string GenerateETag(string? code)
+        {
+            using var shaHash = SHA256.Create();
+            var data = Encoding.UTF8.GetBytes(ControllerHelpers.GetVersion() + "\n" + (code ?? string.Empty));
+            return "\"" + Convert.ToBase64String(shaHash.ComputeHash(data)) + "\"";
+        }
+
+        /// <summary>
+        /// Checks whether the If-None-Match header in a request matches an ETag.
+        /// </summary>
+        /// <param name="request">The request to check.</param>
+        /// <param name="etag">The current ETag (including quotes.)</param>
+        /// <returns>True if any of the entity tags in the header (or *) match the ETag, false otherwise.</returns>
+        /// <remarks>
+        /// The header can contain a list of entity tags, and weak tags match (RFC 7232 uses the weak comparison for If-None-Match.)
+        /// </remarks>
+        private static bool MatchesETag(HttpRequest? request, string etag)
+        {
+            if (request == null) return false;
+            var tags = request.GetTypedHeaders().IfNoneMatch;
+            if (tags.Count == 0) return false;
+
+            var current = EntityTagHeaderValue.Parse(etag);
+            return tags.Any(tag => tag.Equals(EntityTagHeaderValue.Any) || tag.Compare(current, false));
+        }
     }
 }
\ No newline at end of file
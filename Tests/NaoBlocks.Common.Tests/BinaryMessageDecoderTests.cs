@@ -0,0 +1,89 @@
+﻿using System;
+using Xunit;
+
+namespace NaoBlocks.Common.Tests
+{
+    public class BinaryMessageDecoderTests
+    {
+        // The frames were generated by the encoder in the Nao client (wire.py): earlier versions also added the string values to the table
+        private static readonly byte[] stateFrame = new byte[] { 1, 1, 245, 1, 3, 2, 5, 115, 116, 97, 116, 101, 7, 82, 117, 110, 110, 105, 110, 103, 1, 0, 6, 1 };
+        private static readonly byte[] inlineStateFrame = new byte[] { 1, 1, 245, 1, 3, 1, 5, 115, 116, 97, 116, 101, 1, 0, 5, 7, 82, 117, 110, 110, 105, 110, 103 };
+        private static readonly byte[] variableFrame = new byte[] { 1, 1, 245, 1, 0, 3, 4, 110, 97, 109, 101, 4, 108, 111, 111, 112, 5, 118, 97, 108, 117, 101, 2, 0, 6, 1, 2, 3, 4 };
+        private static readonly byte[] floatFrame = new byte[] { 1, 0, 245, 1, 0, 0, 2, 0, 6, 1, 2, 4, 0, 0, 0, 0, 0, 0, 248, 63 };
+        private static readonly byte[] boolFrame = new byte[] { 1, 0, 245, 1, 0, 0, 2, 0, 6, 1, 2, 1 };
+        private static readonly byte[] debugFrame = new byte[] { 1, 1, 246, 1, 7, 4, 2, 97, 49, 5, 115, 116, 97, 114, 116, 3, 115, 97, 121, 3, 101, 110, 100, 2, 6, 0, 6, 1, 6, 2, 208, 15, 6, 0, 6, 3, 6, 2, 19 };
+
+        [Theory]
+        [InlineData(new byte[] { 1, 0, 245, 1 }, true)]
+        [InlineData(new byte[] { 123, 125 }, false)]
+        [InlineData(new byte[0], false)]
+        public void IsBinaryChecksVersion(byte[] data, bool expected)
+        {
+            Assert.Equal(expected, BinaryMessageDecoder.IsBinary(data));
+        }
+
+        [Fact]
+        public void DecodeHandlesStateUpdate()
+        {
+            var decoder = new BinaryMessageDecoder();
+            var msg = decoder.Decode(stateFrame);
+            Assert.Equal(ClientMessageType.RobotStateUpdate, msg.Type);
+            Assert.Equal(3, msg.ConversationId);
+            Assert.Equal("Running", Assert.Contains("state", msg.Values));
+        }
+
+        [Fact]
+        public void DecodeHandlesInlineStrings()
+        {
+            var decoder = new BinaryMessageDecoder();
+            var msg = decoder.Decode(inlineStateFrame);
+            Assert.Equal(ClientMessageType.RobotStateUpdate, msg.Type);
+            Assert.Equal(3, msg.ConversationId);
+            Assert.Equal("Running", Assert.Contains("state", msg.Values));
+        }
+
+        [Fact]
+        public void DecodeReusesStringTable()
+        {
+            var decoder = new BinaryMessageDecoder();
+            var first = decoder.Decode(variableFrame);
+            var second = decoder.Decode(floatFrame);
+            var third = decoder.Decode(boolFrame);
+            Assert.Equal("loop", Assert.Contains("name", first.Values));
+            Assert.Equal("2", Assert.Contains("value", first.Values));
+            Assert.Equal("loop", Assert.Contains("name", second.Values));
+            Assert.Equal("1.5", Assert.Contains("value", second.Values));
+            Assert.Equal("true", Assert.Contains("value", third.Values));
+        }
+
+        [Fact]
+        public void DecodeFailsWithoutStringTable()
+        {
+            var decoder = new BinaryMessageDecoder();
+            Assert.Throws<ArgumentException>(() => decoder.Decode(floatFrame));
+        }
+
+        [Fact]
+        public void DecodeConvertsDebugEventsToJson()
+        {
+            var decoder = new BinaryMessageDecoder();
+            var msg = decoder.Decode(debugFrame);
+            Assert.Equal(ClientMessageType.RobotDebugMessage, msg.Type);
+            Assert.Equal(7, msg.ConversationId);
+            Assert.Equal(
+                "[[\"a1\",\"start\",\"say\",1000],[\"a1\",\"end\",\"say\",990]]",
+                Assert.Contains("events", msg.Values));
+        }
+
+        [Theory]
+        [InlineData(new byte[] { 2, 0, 245, 1, 0, 0, 0 })]
+        [InlineData(new byte[] { 1, 0, 245 })]
+        [InlineData(new byte[] { 1, 1, 245, 1, 0, 0, 1, 0 })]
+        [InlineData(new byte[] { 1, 1, 1, 0, 0, 0, 0 })]
+        public void DecodeChecksFrame(byte[] data)
+        {
+            var decoder = new BinaryMessageDecoder();
+            Assert.Throws<ArgumentException>(() => decoder.Decode(data));
+        }
+    }
+}
@@ -133,6 +133,25 @@ namespace NaoBlocks.Web.Tests.Communications
             Assert.Equal("14916", output.Values["programId"]);
         }
 
+        [Theory]
+        [InlineData(ClientMessageType.ProgramFinished)]
+        [InlineData(ClientMessageType.ProgramStopped)]
+        public async Task ProgramEndCopiesSummary(ClientMessageType messageType)
+        {
+            // Arrange
+            var (_, processor, client) = InitialiseTestProcessor();
+            var listener = InitialiseListener(client);
+
+            // Act
+            var msg = new ClientMessage(messageType, new { blocks = 42, profile = "{}" });
+            await processor.ProcessAsync(client, msg);
+
+            // Assert
+            var output = listener.RetrievePendingMessages().First();
+            Assert.Equal("42", output.Values["blocks"]);
+            Assert.Equal("{}", output.Values["profile"]);
+        }
+
         [Fact]
         public async Task BroadcastLogsToRobotFailsWithoutAConversation()
         {
@@ -314,6 +333,36 @@ namespace NaoBlocks.Web.Tests.Communications
                 ConvertMessageValuesToTestableValues(receivedMessage));
         }
 
+        [Fact]
+        public async Task ProgramDownloadedCopiesDiagnostics()
+        {
+            // Arrange
+            var hub = new Mock<IHub>();
+            ClientMessage? receivedMessage = null;
+            hub.Setup(h => h.SendToMonitors(It.IsAny<ClientMessage>()))
+                .Callback((ClientMessage m) =>
+                {
+                    receivedMessage = m;
+                })
+                .Verifiable();
+            var (_, processor, client) = InitialiseTestProcessor(ClientConnectionType.Robot, hub.Object);
+            client.Robot = new Data.Robot { MachineName = "Mihīni" };
+            client.RobotDetails = new RobotStatus { LastProgramId = 11235 };
+
+            // Act
+            var msg = new ClientMessage(ClientMessageType.ProgramDownloaded, new { diagnostics = "[]" })
+            {
+                ConversationId = 963
+            };
+            await processor.ProcessAsync(client, msg);
+
+            // Assert
+            hub.VerifyAll();
+            Assert.Equal<string[]>(
+                new[] { "diagnostics=>[]", "ProgramId=>11235", "SourceClientId=>0", "SourceName=>Mihīni", "SourceType=>Robot" },
+                ConvertMessageValuesToTestableValues(receivedMessage));
+        }
+
         [Theory]
         [InlineData(ClientMessageType.StopProgram)]
         [InlineData(ClientMessageType.RequestRobot)]
@@ -616,6 +665,40 @@ namespace NaoBlocks.Web.Tests.Communications
             Assert.Empty(client!.RobotDetails!.SourceIds);
         }
 
+        [Fact]
+        public async Task RobotDebugMessageUnpacksEvents()
+        {
+            // Arrange
+            var (_, processor, client) = InitialiseTestProcessor();
+            client.RobotDetails = new RobotStatus();
+
+            // Act
+            var events = "[[\"ABC1234\",\"start\",\"say\",1],[\"DEF5678\",\"end\",\"say\",2]]";
+            var msg = new ClientMessage(ClientMessageType.RobotDebugMessage, new { events });
+            await processor.ProcessAsync(client, msg);
+
+            // Assert
+            Assert.Equal(new[] { "ABC1234", "DEF5678" }, client!.RobotDetails!.SourceIds.OrderBy(id => id).ToArray());
+        }
+
+        [Theory]
+        [InlineData("")]
+        [InlineData("[]")]
+        [InlineData("not json")]
+        public async Task RobotDebugMessageHandlesInvalidEvents(string events)
+        {
+            // Arrange
+            var (_, processor, client) = InitialiseTestProcessor();
+            client.RobotDetails = new RobotStatus();
+
+            // Act
+            var msg = new ClientMessage(ClientMessageType.RobotDebugMessage, new { events });
+            await processor.ProcessAsync(client, msg);
+
+            // Assert
+            Assert.Empty(client!.RobotDetails!.SourceIds);
+        }
+
         [Theory]
         [InlineData(ClientMessageType.StartMonitoring)]
         [InlineData(ClientMessageType.StopMonitoring)]
@@ -1027,6 +1110,45 @@ namespace NaoBlocks.Web.Tests.Communications
             Assert.Equal(new[] { ClientMessageType.Authenticated }, msgs.Select(m => m.Type).ToArray());
         }
 
+        [Theory]
+        [InlineData(null, null)]
+        [InlineData("", null)]
+        [InlineData("binary1", "binary1")]
+        [InlineData("binary2, binary1", "binary1")]
+        [InlineData("binary2", null)]
+        public async Task AuthenticateNegotiatesEncodingForRobot(string? encodings, string? expected)
+        {
+            // Arrange
+            var (engine, processor, client) = InitialiseTestProcessor();
+            var token = GenerateJwtToken(sessionId);
+            var sessionQuery = new Mock<SessionData>();
+            sessionQuery.Setup(q => q.RetrieveByIdAsync(sessionId))
+                .Returns(Task.FromResult<Data.Session?>(new Data.Session
+                {
+                    WhenExpires = DateTime.MaxValue,
+                    IsRobot = true,
+                    UserId = "robots/1"
+                }));
+            engine.RegisterQuery(sessionQuery.Object);
+            engine.ExpectCommand<StartRobotConversation>(CommandResult.New(1, new Data.Conversation { ConversationId = 2 }));
+            engine.ExpectCommand<AddToRobotLog>();
+            var robotQuery = new Mock<RobotData>();
+            robotQuery.Setup(q => q.RetrieveByIdAsync("robots/1"))
+                .Returns(Task.FromResult<Data.Robot?>(new Data.Robot()));
+            engine.RegisterQuery(robotQuery.Object);
+
+            // Act
+            var msg = new ClientMessage(ClientMessageType.Authenticate, new { token });
+            if (encodings != null) msg.Values["encodings"] = encodings;
+            await processor.ProcessAsync(client, msg);
+
+            // Assert
+            var response = Assert.Single(client.RetrievePendingMessages());
+            Assert.Equal(ClientMessageType.Authenticated, response.Type);
+            response.Values.TryGetValue("encoding", out var encoding);
+            Assert.Equal(expected, encoding);
+        }
+
         [Fact]
         public async Task AuthenticateSetsRobotValues()
         {
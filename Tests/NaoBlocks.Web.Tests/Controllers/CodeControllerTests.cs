@@ -1,4 +1,6 @@
-﻿using Microsoft.AspNetCore.Mvc;
+﻿using Microsoft.AspNetCore.Http;
+using Microsoft.AspNetCore.Mvc;
+using Microsoft.Net.Http.Headers;
 using Moq;
 using NaoBlocks.Common;
 using NaoBlocks.Engine;
@@ -7,6 +9,7 @@ using NaoBlocks.Engine.Queries;
 using NaoBlocks.Parser;
 using NaoBlocks.Web.Controllers;
 using System.Linq;
+using System.Net;
 using System.Threading.Tasks;
 using Xunit;
 
@@ -45,6 +48,109 @@ namespace NaoBlocks.Web.Tests.Controllers
             Assert.True(response.Value?.Successful);
         }
 
+        [Fact]
+        public async Task GetProgramSetsETag()
+        {
+            // Arrange
+            var controller = InitialiseGetProgram();
+
+            // Act
+            var response = await controller.Get("Mia", 1);
+
+            // Assert
+            Assert.True(response.Value?.Successful);
+            Assert.False(string.IsNullOrEmpty(controller.Response.Headers[HeaderNames.ETag]));
+        }
+
+        [Fact]
+        public async Task GetProgramChecksETag()
+        {
+            // Arrange
+            var first = InitialiseGetProgram();
+            await first.Get("Mia", 1);
+            var etag = first.Response.Headers[HeaderNames.ETag].ToString();
+            var controller = InitialiseGetProgram();
+            controller.SetRequestHeader(HeaderNames.IfNoneMatch, etag);
+
+            // Act
+            var response = await controller.Get("Mia", 1);
+
+            // Assert
+            var result = Assert.IsType<StatusCodeResult>(response.Result);
+            Assert.Equal((int)HttpStatusCode.NotModified, result.StatusCode);
+        }
+
+        [Theory]
+        [InlineData("\"old\", {0}")]
+        [InlineData("{0}, \"old\"")]
+        [InlineData("W/{0}")]
+        [InlineData("\"old\", W/{0}")]
+        [InlineData("*")]
+        public async Task GetProgramChecksIfNoneMatchValues(string format)
+        {
+            // Arrange
+            var first = InitialiseGetProgram();
+            await first.Get("Mia", 1);
+            var etag = first.Response.Headers[HeaderNames.ETag].ToString();
+            var controller = InitialiseGetProgram();
+            controller.SetRequestHeader(HeaderNames.IfNoneMatch, string.Format(format, etag));
+
+            // Act
+            var response = await controller.Get("Mia", 1);
+
+            // Assert
+            var result = Assert.IsType<StatusCodeResult>(response.Result);
+            Assert.Equal((int)HttpStatusCode.NotModified, result.StatusCode);
+        }
+
+        [Fact]
+        public async Task GetProgramSetsETagWhenNotModified()
+        {
+            // Arrange
+            var first = InitialiseGetProgram();
+            await first.Get("Mia", 1);
+            var etag = first.Response.Headers[HeaderNames.ETag].ToString();
+            var controller = InitialiseGetProgram();
+            controller.SetRequestHeader(HeaderNames.IfNoneMatch, etag);
+
+            // Act
+            await controller.Get("Mia", 1);
+
+            // Assert
+            Assert.Equal(etag, controller.Response.Headers[HeaderNames.ETag].ToString());
+        }
+
+        [Theory]
+        [InlineData("\"old\"")]
+        [InlineData("\"old\", W/\"older\"")]
+        [InlineData("not-an-etag")]
+        public async Task GetProgramIgnoresOtherETags(string value)
+        {
+            // Arrange
+            var controller = InitialiseGetProgram();
+            controller.SetRequestHeader(HeaderNames.IfNoneMatch, value);
+
+            // Act
+            var response = await controller.Get("Mia", 1);
+
+            // Assert
+            Assert.True(response.Value?.Successful);
+        }
+
+        [Fact]
+        public async Task GetProgramIgnoresOldETag()
+        {
+            // Arrange
+            var controller = InitialiseGetProgram();
+            controller.SetRequestHeader(HeaderNames.IfNoneMatch, "\"old\"");
+
+            // Act
+            var response = await controller.Get("Mia", 1);
+
+            // Assert
+            Assert.True(response.Value?.Successful);
+        }
+
         [Fact]
         public async Task GetProgramRetrievesUserHandlesMissingUser()
         {
@@ -170,5 +276,29 @@ namespace NaoBlocks.Web.Tests.Controllers
             Assert.True(response.Value?.Successful);
             Assert.Equal(14916, response.Value?.Output?.ProgramId);
         }
+
+        private static CodeController InitialiseGetProgram()
+        {
+            var logger = new FakeLogger<CodeController>();
+            var engine = new FakeEngine();
+            var userQuery = new Mock<UserData>();
+            var codeQuery = new Mock<CodeData>();
+            engine.RegisterQuery(userQuery.Object);
+            engine.RegisterQuery(codeQuery.Object);
+            userQuery.Setup(q => q.RetrieveByNameAsync("Mia"))
+                .Returns(Task.FromResult((Data.User?)new Data.User { Id = "users/1", Name = "Mia" }));
+            codeQuery.Setup(q => q.RetrieveCodeAsync("users/1", 1))
+                .Returns(Task.FromResult((Data.CodeProgram?)new Data.CodeProgram { Code = "go()" }));
+            engine.ExpectCommand<CompileCode>(
+                CommandResult.New(1, new Data.CompiledCodeProgram(new ParseResult())));
+            var controller = new CodeController(
+                logger,
+                engine);
+            controller.ControllerContext = new ControllerContext
+            {
+                HttpContext = new DefaultHttpContext()
+            };
+            return controller;
+        }
     }
 }
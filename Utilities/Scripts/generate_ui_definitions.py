@@ -27,6 +27,12 @@ import argparse
 import json
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# The (connect, read) timeouts in seconds: uploading a definition can take a while on a large definition
+DEFAULT_TIMEOUT = (5, 30)
+UPLOAD_TIMEOUT = (5, 120)
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Unified Interface Definition Splitter.')
@@ -220,13 +226,20 @@ def generate_topCodes(json_definition, output):
 
     save_definition(output, definition, 'topCodes')
 
-def upload_definition(server, type, headers, output, definition):
+def create_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(max_retries=Retry(total=3, backoff_factor=0.5))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def upload_definition(session, server, type, headers, output, definition):
     filename = os.path.join(output, definition + '.json')
     print(f'-> Uploading "{type}" definition from {filename}...')
     with open(filename, 'r') as input_file:
         json_definition = json.load(input_file)
     
-    resp = requests.post(f'{server}api/v1/ui/{type}?replace=yes', headers=headers, json=json_definition)
+    resp = session.post(f'{server}api/v1/ui/{type}?replace=yes', headers=headers, json=json_definition, timeout=UPLOAD_TIMEOUT)
     if resp.status_code >= 400:
         print(resp.text)
         resp.raise_for_status()
@@ -237,8 +250,13 @@ def upload_to_server(server, user, output):
         server += '/'
     print(f'Attempting to upload to {server}')
 
+    # All the calls go through one session, so they share a single keep-alive connection
+    with create_session() as session:
+        upload_with_session(session, server, user, output)
+
+def upload_with_session(session, server, user, output):
     print('-> Pinging server')
-    resp = requests.get(f'{server}api/v1/version')
+    resp = session.get(f'{server}api/v1/version', timeout=DEFAULT_TIMEOUT)
     resp.raise_for_status()
     version = resp.json()['version']
     print(f'-> Server version is {version}')
@@ -250,24 +268,24 @@ def upload_to_server(server, user, output):
 
     parts = user.split(':')
     print(f'-> Authenticating "{parts[0]}"')
-    resp = requests.post(f'{server}api/v1/session', json={
+    resp = session.post(f'{server}api/v1/session', json={
         'name': parts[0],
         'password': parts[1]
-    })
+    }, timeout=DEFAULT_TIMEOUT)
     resp.raise_for_status()
     token = resp.json()['output']['token']
     headers['Authorization'] = f'Bearer {token}'
 
     print('-> Verifying role')
-    resp = requests.get(f'{server}api/v1/session', headers=headers)
+    resp = session.get(f'{server}api/v1/session', headers=headers, timeout=DEFAULT_TIMEOUT)
     resp.raise_for_status()
     if resp.json()['role'] != 'Administrator':
         print('-> User must have administrator role')
         return
 
     print('-> Role is valid')
-    upload_definition(server, 'angular', headers, output, 'angular')
-    upload_definition(server, 'tangibles', headers, output, 'topCodes')
+    upload_definition(session, server, 'angular', headers, output, 'angular')
+    upload_definition(session, server, 'tangibles', headers, output, 'topCodes')
     print('Upload completed')
 
 def main():